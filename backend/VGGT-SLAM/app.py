@@ -10,8 +10,13 @@ from tqdm import tqdm
 
 import vggt_slam.slam_utils as utils
 from vggt_slam.solver import Solver
+from vggt_slam.synthetic import StubImageRetrieval, SyntheticVGGT
 from vggt.models.vggt import VGGT
 
+# "synthetic" swaps VGGT and the retrieval model for the scripted CPU
+# stand-ins, as VGGT_MODEL does for the backend server
+MODEL_KIND = os.environ.get("VGGT_MODEL", "vggt")
+
 
 def run_slam(
     image_zip,
@@ -44,17 +49,22 @@ def run_slam(
 
     use_optical_flow_downsample = True
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    synthetic = MODEL_KIND == "synthetic"
 
     solver = Solver(
         init_conf_threshold=conf_threshold,
         use_point_map=False,
         use_sim3=use_sim3,
-        gradio_mode=True
+        gradio_mode=True,
+        image_retrieval=StubImageRetrieval() if synthetic else None,
     )
 
-    model = VGGT()
-    _URL = "https://huggingface.co/facebook/VGGT-1B/resolve/main/model.pt"
-    model.load_state_dict(torch.hub.load_state_dict_from_url(_URL))
+    if synthetic:
+        model = SyntheticVGGT()
+    else:
+        model = VGGT()
+        _URL = "https://huggingface.co/facebook/VGGT-1B/resolve/main/model.pt"
+        model.load_state_dict(torch.hub.load_state_dict_from_url(_URL))
     model.eval()
     model = model.to(device)
 
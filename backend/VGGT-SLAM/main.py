@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 
 import vggt_slam.slam_utils as utils
 from vggt_slam.solver import Solver
+from vggt_slam.synthetic import StubImageRetrieval, SyntheticVGGT
 
 from vggt.models.vggt import VGGT
 
@@ -32,6 +33,7 @@ parser.add_argument("--use_point_map", action="store_true", help="Use point map
 parser.add_argument("--conf_threshold", type=float, default=25.0, help="Initial percentage of low-confidence points to filter out")
 parser.add_argument("--vis_stride", type=int, default=1, help="Stride interval in the 3D point cloud image for visualization. Try increasing (such as 4) to reduce lag in visualizing large maps.")
 parser.add_argument("--vis_point_size", type=float, default=0.003, help="Visualization point size")
+parser.add_argument("--synthetic", action="store_true", help="Use the scripted CPU stand-in for VGGT and the retrieval model (for benchmarking)")
 
 def main():
     """
@@ -49,14 +51,18 @@ def main():
         gradio_mode=False,
         vis_stride = args.vis_stride,
         vis_point_size = args.vis_point_size,
+        image_retrieval=StubImageRetrieval() if args.synthetic else None,
     )
 
     print("Initializing and loading VGGT model...")
     # model = VGGT.from_pretrained("facebook/VGGT-1B")
 
-    model = VGGT()
-    _URL = "https://huggingface.co/facebook/VGGT-1B/resolve/main/model.pt"
-    model.load_state_dict(torch.hub.load_state_dict_from_url(_URL))
+    if args.synthetic:
+        model = SyntheticVGGT()
+    else:
+        model = VGGT()
+        _URL = "https://huggingface.co/facebook/VGGT-1B/resolve/main/model.pt"
+        model.load_state_dict(torch.hub.load_state_dict_from_url(_URL))
 
     model.eval()
     model = model.to(device)
@@ -8,6 +8,8 @@ from gtsam import NonlinearFactorGraph, Values, noiseModel
 from gtsam import SL4, PriorFactorSL4, BetweenFactorSL4
 from gtsam.symbol_shorthand import X
 
+from vggt_slam.instrumentation import timed
+
 class PoseGraph:
     def __init__(self):
         """Initialize a factor graph for Pose3 nodes with BetweenFactors."""
@@ -66,6 +68,7 @@ class PoseGraph:
         node_id = X(node_id)
         return self.values.atSL4(node_id)
     
+    @timed("graph.optimize")
     def optimize(self):
         """Optimize the graph and update estimates."""
         optimizer = gtsam.LevenbergMarquardtOptimizer(self.graph, self.values)
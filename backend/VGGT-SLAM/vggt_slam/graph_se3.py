@@ -5,6 +5,8 @@ from mpl_toolkits.mplot3d import Axes3D
 from gtsam import Pose3, Rot3, Point3, NonlinearFactorGraph, Values, noiseModel, PriorFactorPose3
 from gtsam.symbol_shorthand import X
 
+from vggt_slam.instrumentation import timed
+
 class PoseGraph:
     def __init__(self):
         """Initialize a factor graph for Pose3 nodes with BetweenFactors."""
@@ -47,6 +49,7 @@ class PoseGraph:
         node_id = X(node_id)
         return self.values.atPose3(node_id)
 
+    @timed("graph.optimize")
     def optimize(self):
         """Optimize the graph and update estimates."""
         optimizer = gtsam.LevenbergMarquardtOptimizer(self.graph, self.values)
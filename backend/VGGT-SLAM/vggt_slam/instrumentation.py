@@ -0,0 +1,75 @@
+import functools
+import threading
+import time
+
+# Named timing spans around the expensive steps of the solver. Nothing is
+# measured unless an observer is registered, so instrumented code costs one
+# attribute check per span when nobody is listening.
+#
+# An observer is called as observer(name, start, duration) when a span ends,
+# where start is a time.perf_counter() timestamp and duration is in seconds.
+
+_observers = []
+_lock = threading.Lock()
+
+
+def add_observer(observer):
+    global _observers
+    with _lock:
+        if observer not in _observers:
+            # Copy on write so spans never iterate a list being modified
+            _observers = _observers + [observer]
+
+
+def remove_observer(observer):
+    global _observers
+    with _lock:
+        _observers = [o for o in _observers if o is not observer]
+
+
+def enabled():
+    """True while at least one observer is registered."""
+    return bool(_observers)
+
+
+def record(name, start, duration):
+    """Report a span measured elsewhere."""
+    for observer in _observers:
+        try:
+            observer(name, start, duration)
+        except Exception as e:
+            print(f"Warning: instrumentation observer failed for {name}: {e}")
+
+
+class span:
+    """Context manager that times a block and reports it to the observers."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _observers:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is not None:
+            record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+def timed(name):
+    """Decorator form of ``span``."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Skip creating the span at all while nobody is listening
+            if not enabled():
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
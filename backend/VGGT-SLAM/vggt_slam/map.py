@@ -1,14 +1,71 @@
 import os
+import time
+from collections import OrderedDict, deque
+
 import numpy as np
 import torch
 import open3d as o3d
 import cv2
 from scipy.spatial.transform import Rotation as R
 
+from vggt_slam.slam_utils import load_depth_mm
+from vggt_slam.pointcloud_io import colors_to_uint8, get_format
+from vggt_slam.instrumentation import timed
+
+# Default byte budget for encoded export chunks kept between exports
+EXPORT_CACHE_BYTES = 256 * 1024 * 1024
+
+# Submap attributes holding per-frame data, reported by memory_report()
+SUBMAP_ARRAY_FIELDS = (
+    "frames",
+    "pointclouds",
+    "colors",
+    "conf",
+    "conf_masks",
+    "retrieval_vectors",
+    "voxelized_points",
+    "depth_maps",
+)
+
+
+def nbytes(obj):
+    """Bytes held by an array, tensor, Open3D point cloud or a list of them."""
+    if obj is None:
+        return 0
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, torch.Tensor):
+        return int(obj.element_size() * obj.nelement())
+    if isinstance(obj, o3d.geometry.PointCloud):
+        return sum(np.asarray(a).nbytes for a in (obj.points, obj.colors, obj.normals))
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(o) for o in obj)
+    return 0
+
+
+class StaleExportError(RuntimeError):
+    """A submap's points changed between an export snapshot and its encoding."""
+
+
 class GraphMap:
-    def __init__(self):
+    def __init__(self, export_cache_bytes=EXPORT_CACHE_BYTES):
         self.submaps = dict()
         self.global_scale = 1.0
+        # Per submap: the homography at its last reported change, so changes
+        # are measured against it and cannot creep below the tolerance given
+        # to update_submap_homographies one optimization at a time. Exports
+        # use it too, so an export is the same for the same map version.
+        self.versioned_homographies = dict()
+        # Bumped on any change that alters exported points: new submaps,
+        # moved homographies, a new global scale or rebuilt points.
+        self.version = 0
+        # Encoded export chunk per submap, reused while its inputs are unchanged.
+        # Least recently used first; trimmed to export_cache_bytes.
+        self._export_cache = OrderedDict()
+        self._export_cache_size = 0
+        self.export_cache_bytes = export_cache_bytes
+        # (time, total bytes) of recent memory reports, for the growth rate
+        self._memory_history = deque(maxlen=64)
     
     def get_num_submaps(self):
         return len(self.submaps)
@@ -16,6 +73,7 @@ class GraphMap:
     def add_submap(self, submap):
         submap_id = submap.get_id()
         self.submaps[submap_id] = submap
+        self.version += 1
     
     def get_largest_key(self):
         if len(self.submaps) == 0:
@@ -65,25 +123,59 @@ class GraphMap:
         
         return frames
     
-    def update_submap_homographies(self, graph):
+    def update_submap_homographies(self, graph, tolerance=0.0):
+        """Pull optimized homographies from the graph.
+
+        Returns the ids of submaps whose homography changed by more than
+        ``tolerance`` (max absolute element difference) since its last
+        version bump, including submaps seen for the first time. Smaller
+        moves update the reference homographies but not the map version.
+        """
+        changed = []
         for submap_key in self.submaps.keys():
             submap = self.submaps[submap_key]
-            submap.set_reference_homography(graph.get_homography(submap_key).matrix())
+            H_world_map = graph.get_homography(submap_key).matrix()
+            submap.set_reference_homography(H_world_map)
+
+            H_versioned = self.versioned_homographies.get(submap_key)
+            if H_versioned is None or np.max(np.abs(H_world_map - H_versioned)) > tolerance:
+                self.versioned_homographies[submap_key] = np.array(H_world_map, copy=True)
+                changed.append(submap_key)
+        if changed:
+            self.version += 1
+        return changed
     
     def get_submaps(self):
         return self.submaps.values()
 
-    def set_global_scale(self, scale: float):
+    def set_global_scale(self, scale: float, tolerance: float = 0.0):
         """Set a global scale factor applied on export.
+
+        Changes within ``tolerance`` (relative to the current scale) are
+        ignored, so re-estimating the scale from a few more samples does not
+        rebuild every depth submap and invalidate every cached export chunk.
         """
-        self.global_scale = float(scale)
+        scale = float(scale)
+        if scale == self.global_scale:
+            return
+        if self.global_scale != 0 and abs(scale - self.global_scale) <= tolerance * abs(self.global_scale):
+            return
+        self.version += 1
+        self.global_scale = scale
 
     def ordered_submaps_by_key(self):
         for k in sorted(self.submaps):
             yield self.submaps[k]
 
+    @timed("map.refine_points_with_depth")
     def refine_points_with_depth(self):
         """Rebuild submap point clouds using captured depth + predicted poses.
+
+        Runs after every batch, but a submap is only rebuilt (and its points
+        version bumped) when something the rebuild reads has changed since
+        its last rebuild: its depth maps, poses, intrinsics or points, or the
+        global scale. Unchanged submaps keep their export cache entries and
+        in-flight exports of them stay valid.
         """
 
         if self.get_num_submaps() == 0:
@@ -92,7 +184,7 @@ class GraphMap:
         scale = float(self.global_scale) if self.global_scale != 0 else 1.0
 
         for submap in self.ordered_submaps_by_key():
-            depth_paths = getattr(submap, "depth_paths", None)
+            depth_maps = getattr(submap, "depth_maps", None)
             poses = getattr(submap, "poses", None)
             pointclouds = getattr(submap, "pointclouds", None)
             intrinsics = getattr(submap, "vggt_intrinscs", None)
@@ -100,8 +192,8 @@ class GraphMap:
             conf = getattr(submap, "conf", None)
             conf_masks = getattr(submap, "conf_masks", None)
 
-            # Require poses, intrinsics, and depth paths to rebuild points
-            if depth_paths is None or poses is None or intrinsics is None:
+            # Require poses, intrinsics, and depth maps to rebuild points
+            if depth_maps is None or poses is None or intrinsics is None:
                 continue
 
             last_non_loop = submap.get_last_non_loop_frame_index()
@@ -117,34 +209,27 @@ class GraphMap:
             if pointclouds is None:
                 continue
 
-            num_frames = min(len(depth_paths), last_non_loop + 1, pointclouds.shape[0])
+            num_frames = min(len(depth_maps), last_non_loop + 1, pointclouds.shape[0])
             if num_frames <= 0:
                 continue
 
-            for frame_idx in range(num_frames):
-                depth_path = depth_paths[frame_idx]
-                if (depth_path is None) or (not os.path.exists(depth_path)):
-                    pointclouds[frame_idx] = 0.0
-                    if conf is not None:
-                        conf[frame_idx] = 0.0
-                    if conf_masks is not None:
-                        conf_masks[frame_idx] = False
-                    continue
-
-                try:
-                    captured_depth_mm = np.load(depth_path)
-                except Exception:
-                    pointclouds[frame_idx] = 0.0
-                    if conf is not None:
-                        conf[frame_idx] = 0.0
-                    if conf_masks is not None:
-                        conf_masks[frame_idx] = False
-                    continue
+            # Depth maps are held by the submap, so their ids are stable while
+            # they are in use; poses and intrinsics are small enough to copy.
+            inputs = (
+                submap.points_version,
+                scale,
+                num_frames,
+                tuple(id(d) for d in depth_maps[:num_frames]),
+                np.asarray(poses[:num_frames]).tobytes(),
+                np.asarray(intrinsics[:num_frames]).tobytes(),
+            )
+            if submap.refined_inputs == inputs:
+                continue
 
-                if captured_depth_mm.ndim > 2:
-                    captured_depth_mm = np.squeeze(captured_depth_mm)
-                if captured_depth_mm.ndim != 2:
-                    # Invalid depth shape; drop existing points for this frame.
+            for frame_idx in range(num_frames):
+                captured_depth_mm = load_depth_mm(depth_maps[frame_idx])
+                if captured_depth_mm is None:
+                    # Missing or invalid depth; drop existing points for this frame.
                     pointclouds[frame_idx] = 0.0
                     if conf is not None:
                         conf[frame_idx] = 0.0
@@ -156,11 +241,14 @@ class GraphMap:
                 H, W = pointclouds.shape[1:3]
 
                 # Resize captured depth to match color resolution
-                depth_resized = cv2.resize(
-                    captured_depth_mm,
-                    (W, H),
-                    interpolation=cv2.INTER_NEAREST,
-                )
+                if captured_depth_mm.shape != (H, W):
+                    depth_resized = cv2.resize(
+                        captured_depth_mm,
+                        (W, H),
+                        interpolation=cv2.INTER_NEAREST,
+                    )
+                else:
+                    depth_resized = captured_depth_mm
 
                 # Valid metric depth in millimeters
                 mask_valid = (depth_resized > 0) & (depth_resized < 8300)
@@ -227,6 +315,9 @@ class GraphMap:
                 submap.conf_threshold = 0.5
             if conf_masks is not None:
                 submap.conf_masks = conf_masks
+            submap.points_version += 1
+            submap.refined_inputs = (submap.points_version,) + inputs[1:]
+            self.version += 1
 
     def write_poses_to_file(self, file_name):
         with open(file_name, "w") as f:
@@ -250,20 +341,135 @@ class GraphMap:
                 np.savez(f"{file_name}/{frame_id}.npz", pointcloud=pointcloud * self.global_scale, mask=conf_masks)
                 
 
-    def write_points_to_file(self, file_name):
-        pcd_all = []
-        colors_all = []
+    def export_snapshot(self):
+        """Freeze what a streamed export will contain.
+
+        Returns ``(entries, scale, version)`` where each entry is
+        ``(submap_id, H_world_map, num_points, points_version)``; the point
+        counts come from the confidence masks, so the file header can be
+        written before any point is transformed. Homographies are the ones
+        recorded at the last version bump.
+        """
+        entries = []
         for submap in self.ordered_submaps_by_key():
-            pcd = submap.get_points_in_world_frame()
-            pcd = pcd.reshape(-1, 3)
-            pcd_all.append(pcd)
-            colors_all.append(submap.get_points_colors())
-        pcd_all = np.concatenate(pcd_all, axis=0)
-        # Apply global scale to exported points
-        pcd_all = pcd_all * self.global_scale
-        colors_all = np.concatenate(colors_all, axis=0)
-        if colors_all.max() > 1.0:
-            colors_all = colors_all / 255.0
-        pcd_all = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(pcd_all))
-        pcd_all.colors = o3d.utility.Vector3dVector(colors_all)
-        o3d.io.write_point_cloud(file_name, pcd_all)
\ No newline at end of file
+            H_world_map = self.versioned_homographies.get(submap.get_id())
+            if H_world_map is None:
+                H_world_map = submap.get_reference_homography()
+            entries.append((
+                submap.get_id(),
+                np.array(H_world_map, copy=True),
+                submap.count_confident_points(),
+                submap.points_version,
+            ))
+        return entries, self.global_scale, self.version
+
+    def encode_export_chunk(self, entry, scale, fmt=".ply"):
+        """Transform and encode one submap of an export snapshot.
+
+        The result is cached per submap and reused while the submap's
+        homography, points and the global scale stay the same. A stale entry
+        is replaced; past ``export_cache_bytes`` the least recently used
+        submaps are evicted.
+        """
+        submap_id, H_world_map, num_points, points_version = entry
+        key = (fmt, H_world_map.tobytes(), points_version, scale, num_points)
+        cached = self._export_cache.get(submap_id)
+        if cached is not None and cached[0] == key:
+            self._export_cache.move_to_end(submap_id)
+            return cached[1]
+        data = self._encode_export_chunk(submap_id, H_world_map, num_points, points_version, scale, fmt)
+        self._cache_export_chunk(submap_id, key, data)
+        return data
+
+    def _cache_export_chunk(self, submap_id, key, data):
+        stale = self._export_cache.pop(submap_id, None)
+        if stale is not None:
+            self._export_cache_size -= len(stale[1])
+        if len(data) > self.export_cache_bytes:
+            return
+        self._export_cache[submap_id] = (key, data)
+        self._export_cache_size += len(data)
+        while self._export_cache_size > self.export_cache_bytes:
+            _, (_, evicted) = self._export_cache.popitem(last=False)
+            self._export_cache_size -= len(evicted)
+
+    def _encode_export_chunk(self, submap_id, H_world_map, num_points, points_version, scale, fmt):
+        _, records, _ = get_format(fmt)
+        submap = self.get_submap(submap_id)
+        # Chunks are encoded in separate solver-thread calls, so depth
+        # refinement may have rebuilt this submap since the snapshot. Its
+        # points no longer match the header; the export has to start over.
+        if submap.points_version != points_version:
+            raise StaleExportError(
+                f"Submap {submap_id} changed during export (points version {points_version} -> {submap.points_version})"
+            )
+        points = submap.get_points_in_world_frame(H_world_map=H_world_map) * scale
+        colors = colors_to_uint8(submap.get_points_colors())
+        if points.shape[0] != num_points:
+            raise StaleExportError(f"Submap {submap_id} has {points.shape[0]} points, the snapshot has {num_points}")
+        return records(points, colors)
+
+    def iter_encoded_points(self, fmt=".ply"):
+        """Yield the merged cloud as a header followed by one chunk per submap."""
+        header, _, _ = get_format(fmt)
+        entries, scale, _ = self.export_snapshot()
+        yield header(sum(entry[2] for entry in entries))
+        for entry in entries:
+            yield self.encode_export_chunk(entry, scale, fmt)
+
+    def write_points_to_file(self, file_name):
+        fmt = os.path.splitext(file_name)[1].lower()
+        with open(file_name, "wb") as f:
+            for chunk in self.iter_encoded_points(fmt):
+                f.write(chunk)
+
+    def memory_report(self, graph=None, record=True):
+        """Bytes held by the map, per submap and per field.
+
+        Tensors are counted wherever they live; ``devices`` splits the total
+        between host and GPU memory. If the pose ``graph`` is given, its
+        factor and value counts are included (gtsam does not expose bytes).
+        The growth rate is measured against the oldest of the recent reports;
+        with ``record=False`` this report is not added to that history.
+        """
+        fields = {field: 0 for field in SUBMAP_ARRAY_FIELDS}
+        devices = {}
+        submaps = {}
+        for submap_id, submap in list(self.submaps.items()):
+            usage = {}
+            for field in SUBMAP_ARRAY_FIELDS:
+                value = getattr(submap, field, None)
+                size = nbytes(value)
+                usage[field] = size
+                fields[field] += size
+                device = value.device.type if isinstance(value, torch.Tensor) else "cpu"
+                devices[device] = devices.get(device, 0) + size
+            usage["total"] = sum(usage.values())
+            submaps[submap_id] = usage
+
+        export_cache = self._export_cache_size
+        total = sum(fields.values()) + export_cache
+        now = time.time()
+        if record:
+            self._memory_history.append((now, total))
+        growth = 0.0
+        if self._memory_history:
+            then, total_then = self._memory_history[0]
+            if now > then:
+                growth = (total - total_then) / (now - then)
+
+        report = {
+            "submaps": submaps,
+            "fields": fields,
+            "devices": devices,
+            "export_cache": export_cache,
+            "total": total,
+            "bytes_per_submap": total // len(submaps) if submaps else 0,
+            "growth_bytes_per_second": growth,
+        }
+        if graph is not None:
+            report["pose_graph"] = {
+                "factors": int(graph.graph.size()),
+                "values": int(graph.values.size()),
+            }
+        return report
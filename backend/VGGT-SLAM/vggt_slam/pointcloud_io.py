@@ -0,0 +1,108 @@
+import numpy as np
+
+# Binary PLY / PCD encoding straight from NumPy arrays: float32 xyz and uint8
+# rgb, written into memory without going through Open3D or a temp file.
+
+PLY_VERTEX_DTYPE = np.dtype([
+    ("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+    ("red", "u1"), ("green", "u1"), ("blue", "u1"),
+])
+
+PCD_POINT_DTYPE = np.dtype([
+    ("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("rgb", "<u4"),
+])
+
+
+def colors_to_uint8(colors):
+    """Convert (N, 3) colors in [0, 1] or [0, 255] (any dtype) to uint8."""
+    colors = np.asarray(colors).reshape(-1, 3)
+    if colors.dtype == np.uint8:
+        return colors
+    colors = colors.astype(np.float32, copy=False)
+    if colors.size and colors.max() <= 1.0:
+        colors = colors * 255.0
+    return np.clip(np.rint(colors), 0, 255).astype(np.uint8)
+
+
+def ply_header(num_points):
+    return (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {int(num_points)}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        "property uchar red\n"
+        "property uchar green\n"
+        "property uchar blue\n"
+        "end_header\n"
+    ).encode("ascii")
+
+
+def ply_vertices(points, colors):
+    """Pack (N, 3) points and colors into PLY vertex records (no header)."""
+    points = np.asarray(points).reshape(-1, 3)
+    colors = colors_to_uint8(colors)
+    if points.shape[0] != colors.shape[0]:
+        raise ValueError(f"Got {points.shape[0]} points but {colors.shape[0]} colors")
+    vertices = np.empty(points.shape[0], dtype=PLY_VERTEX_DTYPE)
+    vertices["x"] = points[:, 0]
+    vertices["y"] = points[:, 1]
+    vertices["z"] = points[:, 2]
+    vertices["red"] = colors[:, 0]
+    vertices["green"] = colors[:, 1]
+    vertices["blue"] = colors[:, 2]
+    return vertices.tobytes()
+
+
+def encode_ply(points, colors):
+    """Encode a colored point cloud as binary little-endian PLY bytes."""
+    body = ply_vertices(points, colors)
+    return ply_header(len(body) // PLY_VERTEX_DTYPE.itemsize) + body
+
+
+def pcd_header(num_points):
+    n = int(num_points)
+    return (
+        "# .PCD v0.7 - Point Cloud Data file format\n"
+        "VERSION 0.7\n"
+        "FIELDS x y z rgb\n"
+        "SIZE 4 4 4 4\n"
+        "TYPE F F F F\n"
+        "COUNT 1 1 1 1\n"
+        f"WIDTH {n}\n"
+        "HEIGHT 1\n"
+        "VIEWPOINT 0 0 0 1 0 0 0\n"
+        f"POINTS {n}\n"
+        "DATA binary\n"
+    ).encode("ascii")
+
+
+def pcd_points(points, colors):
+    """Pack (N, 3) points and colors into PCD point records (no header)."""
+    points = np.asarray(points).reshape(-1, 3)
+    colors = colors_to_uint8(colors).astype(np.uint32)
+    if points.shape[0] != colors.shape[0]:
+        raise ValueError(f"Got {points.shape[0]} points but {colors.shape[0]} colors")
+    records = np.empty(points.shape[0], dtype=PCD_POINT_DTYPE)
+    records["x"] = points[:, 0]
+    records["y"] = points[:, 1]
+    records["z"] = points[:, 2]
+    records["rgb"] = (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+    return records.tobytes()
+
+
+# Per format: header for a point count, record packer, bytes per point.
+# The header and records can be written separately to stream a cloud whose
+# size is known up front.
+FORMATS = {
+    ".ply": (ply_header, ply_vertices, PLY_VERTEX_DTYPE.itemsize),
+    ".pcd": (pcd_header, pcd_points, PCD_POINT_DTYPE.itemsize),
+}
+
+
+def get_format(fmt):
+    fmt = fmt if fmt.startswith(".") else "." + fmt
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported point cloud format {fmt!r}, expected one of {sorted(FORMATS)}")
+    return FORMATS[fmt]
@@ -1,6 +1,11 @@
 import os
 import re
 
+import numpy as np
+import torch
+import torchvision.transforms as TF
+from PIL import Image
+
 def slice_with_overlap(lst, n, k):
     if n <= 0 or k < 0:
         raise ValueError("n must be greater than 0 and k must be non-negative")
@@ -32,4 +37,80 @@ def downsample_images(image_names, downsample_factor):
     Returns:
         list of str: Downsampled list of image filenames.
     """
-    return image_names[::downsample_factor]
\ No newline at end of file
+    return image_names[::downsample_factor]
+
+def load_and_preprocess_image_arrays(images, target_size=518):
+    """
+    In-memory counterpart of vggt's `load_and_preprocess_images` (crop mode).
+
+    Args:
+        images (list of np.ndarray): Decoded BGR uint8 images of shape (H, W, 3), as returned by cv2.
+        target_size (int): Network input width.
+
+    Returns:
+        torch.Tensor: Batched tensor of shape (N, 3, H, W) with values in [0, 1].
+    """
+    if len(images) == 0:
+        raise ValueError("At least 1 image is required")
+
+    to_tensor = TF.ToTensor()
+    tensors = []
+    shapes = set()
+    for image in images:
+        img = Image.fromarray(np.ascontiguousarray(image[..., ::-1]))  # BGR -> RGB
+        width, height = img.size
+        new_width = target_size
+        new_height = round(height * (new_width / width) / 14) * 14
+
+        img = to_tensor(img.resize((new_width, new_height), Image.Resampling.BICUBIC))
+        if new_height > target_size:
+            start_y = (new_height - target_size) // 2
+            img = img[:, start_y : start_y + target_size, :]
+
+        shapes.add((img.shape[1], img.shape[2]))
+        tensors.append(img)
+
+    if len(shapes) > 1:
+        # Pad to a common shape with white, matching vggt's loader
+        print(f"Warning: Found images with different shapes: {shapes}")
+        max_height = max(shape[0] for shape in shapes)
+        max_width = max(shape[1] for shape in shapes)
+        padded = []
+        for img in tensors:
+            h_padding = max_height - img.shape[1]
+            w_padding = max_width - img.shape[2]
+            if h_padding > 0 or w_padding > 0:
+                pad_top = h_padding // 2
+                pad_left = w_padding // 2
+                img = torch.nn.functional.pad(
+                    img, (pad_left, w_padding - pad_left, pad_top, h_padding - pad_top), mode="constant", value=1.0
+                )
+            padded.append(img)
+        tensors = padded
+
+    return torch.stack(tensors)
+
+def load_depth_mm(source):
+    """
+    Load a captured depth map given either an in-memory array or a path to a .npy file.
+
+    Returns:
+        np.ndarray or None: 2D depth map in millimetres, or None if unavailable or malformed.
+    """
+    if source is None:
+        return None
+    if isinstance(source, np.ndarray):
+        depth = source
+    else:
+        if not os.path.exists(source):
+            return None
+        try:
+            depth = np.load(source)
+        except Exception:
+            return None
+
+    if depth.ndim > 2:
+        depth = np.squeeze(depth)
+    if depth.ndim != 2:
+        return None
+    return depth
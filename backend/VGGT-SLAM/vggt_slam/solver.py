@@ -1,4 +1,3 @@
-import os
 import numpy as np
 import cv2
 import gtsam
@@ -19,6 +18,8 @@ from vggt_slam.map import GraphMap
 from vggt_slam.submap import Submap
 from vggt_slam.h_solve import ransac_projective
 from vggt_slam.gradio_viewer import TrimeshViewer
+from vggt_slam.slam_utils import load_and_preprocess_image_arrays, load_depth_mm
+from vggt_slam.instrumentation import span, timed
 
 def color_point_cloud_by_confidence(pcd, confidence, cmap='viridis'):
     """
@@ -145,7 +146,8 @@ class Solver:
         use_sim3: bool = False,
         gradio_mode: bool = False,
         vis_stride: int = 1,         # represents how much the visualized point clouds are sparsified
-        vis_point_size: float = 0.001):
+        vis_point_size: float = 0.001,
+        image_retrieval: ImageRetrieval = None):  # shared encoder; loaded here if not given
         
         self.init_conf_threshold = init_conf_threshold
         self.use_point_map = use_point_map
@@ -166,7 +168,7 @@ class Solver:
             from vggt_slam.graph import PoseGraph
         self.graph = PoseGraph()
 
-        self.image_retrieval = ImageRetrieval()
+        self.image_retrieval = image_retrieval if image_retrieval is not None else ImageRetrieval()
         self.current_working_submap = None
 
         self.first_edge = True
@@ -228,7 +230,8 @@ class Solver:
         self.set_submap_point_cloud(submap)
         self.set_submap_poses(submap)
 
-    def add_points(self, pred_dict, depth_paths=None):
+    @timed("solver.add_points")
+    def add_points(self, pred_dict, depth_maps=None):
         """
         Args:
             pred_dict (dict):
@@ -241,6 +244,8 @@ class Solver:
                 "extrinsic": (S, 3, 4),
                 "intrinsic": (S, 3, 3),
             }
+            depth_maps (list, optional): Captured depth per frame in millimetres, either as
+                2D arrays or as paths to .npy files. Entries may be None.
         """
         # Unpack prediction dict
         images = pred_dict["images"]  # (S, 3, H, W)
@@ -267,29 +272,22 @@ class Solver:
         # Flatten
         cam_to_world = closed_form_inverse_se3(extrinsics_cam)  # shape (S, 4, 4)
 
-        # If depth paths are provided, accumulate per-frame depth ratios
+        # If depth maps are provided, accumulate per-frame depth ratios
         # between captured depth and predicted depth, and store the depth
-        # paths on the current submap for later refinement at the map
-        # level (GraphMap.refine_points_with_depth).
-        if depth_paths is not None and len(depth_paths) > 0:
+        # maps (resized to the network grid) on the current submap for later
+        # refinement at the map level (GraphMap.refine_points_with_depth).
+        if depth_maps is not None and len(depth_maps) > 0:
             S = world_points.shape[0]
             depth_map = pred_dict.get("depth")
             Hp, Wp = world_points.shape[1:3]
             ratios_all = []
+            resized_depth_maps = []
             for i in range(S):
-                if i >= len(depth_paths):
+                if i >= len(depth_maps):
                     break
-                depth_path = depth_paths[i]
-                if depth_path is None or (not os.path.exists(depth_path)):
-                    continue
-                try:
-                    captured_mm = np.load(depth_path)
-                except Exception:
-                    continue
-
-                if captured_mm.ndim > 2:
-                    captured_mm = np.squeeze(captured_mm)
-                if captured_mm.ndim != 2:
+                captured_mm = load_depth_mm(depth_maps[i])
+                if captured_mm is None:
+                    resized_depth_maps.append(None)
                     continue
 
                 # Resize captured depth to match network / world_points
@@ -301,6 +299,7 @@ class Solver:
                     )
                 else:
                     captured_mm_resized = captured_mm
+                resized_depth_maps.append(captured_mm_resized)
 
                 # Predicted depth either from network or geometric depth
                 if depth_map is not None:
@@ -329,9 +328,9 @@ class Solver:
             if ratios_all:
                 self.depth_scale_samples.extend(ratios_all)
 
-            # Keep the depth paths for map-level refinement later.
-            if hasattr(self.current_working_submap, "set_depth_paths"):
-                self.current_working_submap.set_depth_paths(depth_paths)
+            # Keep the depth maps for map-level refinement later.
+            if hasattr(self.current_working_submap, "set_depth_maps"):
+                self.current_working_submap.set_depth_maps(resized_depth_maps)
 
         # estimate focal length from points
         points_in_first_cam = world_points[0,...]
@@ -502,24 +501,41 @@ class Solver:
             return None
         return float(np.median(all_ratios))
 
-    def run_predictions(self, image_names, model, max_loops):
+    @timed("solver.run_predictions")
+    def run_predictions(self, image_names, model, max_loops, frame_ids=None):
+        """
+        Args:
+            image_names (list): Image paths, or decoded BGR uint8 arrays of shape (H, W, 3).
+            frame_ids (list, optional): Frame id per image. Required when passing arrays;
+                when passing paths the ids are parsed from the file names.
+        """
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        images = load_and_preprocess_images(image_names).to(device)
+        with span("solver.preprocess"):
+            if len(image_names) > 0 and isinstance(image_names[0], np.ndarray):
+                if frame_ids is None:
+                    raise ValueError("frame_ids must be provided when passing image arrays")
+                images = load_and_preprocess_image_arrays(image_names).to(device)
+            else:
+                images = load_and_preprocess_images(image_names).to(device)
         print(f"Preprocessed images shape: {images.shape}")
 
         # print("Running inference...")
-        dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+        if device == "cuda":
+            dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+        else:
+            dtype = torch.bfloat16
 
         # Check for loop closures
         new_pcd_num = self.map.get_largest_key() + 1
         new_submap = Submap(new_pcd_num)
         # new_submap.add_all_frames(images)
         new_submap.add_all_frames(images)
-        new_submap.set_frame_ids(image_names)
-        new_submap.set_all_retrieval_vectors(self.image_retrieval.get_all_submap_embeddings(new_submap))
+        new_submap.set_frame_ids(image_names if frame_ids is None else frame_ids)
+        with span("solver.retrieval"):
+            new_submap.set_all_retrieval_vectors(self.image_retrieval.get_all_submap_embeddings(new_submap))
 
-        # TODO implement this
-        detected_loops = self.image_retrieval.find_loop_closures(self.map, new_submap, max_loop_closures=max_loops)
+            # TODO implement this
+            detected_loops = self.image_retrieval.find_loop_closures(self.map, new_submap, max_loop_closures=max_loops)
         if len(detected_loops) > 0:
             print(colored("detected_loops", "yellow"), detected_loops)
         retrieved_frames = self.map.get_frames_from_loops(detected_loops)
@@ -536,17 +552,20 @@ class Solver:
 
         self.current_working_submap = new_submap
 
-        with torch.no_grad():
-            with torch.cuda.amp.autocast(dtype=dtype):
-                predictions = model(images)
-
-        extrinsic, intrinsic = pose_encoding_to_extri_intri(predictions["pose_enc"], images.shape[-2:])
-        predictions["extrinsic"] = extrinsic
-        predictions["intrinsic"] = intrinsic
-        predictions["detected_loops"] = detected_loops
-
-        for key in predictions.keys():
-            if isinstance(predictions[key], torch.Tensor):
-                predictions[key] = predictions[key].cpu().numpy().squeeze(0)  # remove batch dimension and convert to numpy
+        # Includes the copy back to the CPU, which waits for the GPU to finish
+        with span("solver.vggt_forward"):
+            with torch.no_grad():
+                # Mixed precision on the GPU only; CPU runs (e.g. SyntheticVGGT) stay in float32
+                with torch.autocast(device_type=device, dtype=dtype, enabled=device == "cuda"):
+                    predictions = model(images)
+
+            extrinsic, intrinsic = pose_encoding_to_extri_intri(predictions["pose_enc"], images.shape[-2:])
+            predictions["extrinsic"] = extrinsic
+            predictions["intrinsic"] = intrinsic
+            predictions["detected_loops"] = detected_loops
+
+            for key in predictions.keys():
+                if isinstance(predictions[key], torch.Tensor):
+                    predictions[key] = predictions[key].cpu().numpy().squeeze(0)  # remove batch dimension and convert to numpy
 
         return predictions
\ No newline at end of file
@@ -19,10 +19,12 @@ class Submap:
         self.conf_masks = None # (S, H, W)
         self.conf_threshold = None
         self.pointclouds = None # (S, H, W, 3)
-        self.depth_paths = None  # Optional list of depth map paths aligned with frames
+        self.depth_maps = None  # Optional list of captured depth maps (mm) aligned with frames
         self.voxelized_points = None
         self.last_non_loop_frame_index = None
         self.frame_ids = None
+        self.points_version = 0  # bumped whenever pointclouds/colors/conf are replaced or rebuilt
+        self.refined_inputs = None  # what refine_points_with_depth last rebuilt the points from
     
     def add_all_poses(self, poses):
         self.poses = poses
@@ -33,12 +35,13 @@ class Submap:
         self.conf = conf
         self.conf_threshold = np.percentile(self.conf, conf_threshold_percentile)
         self.vggt_intrinscs = intrinsics
+        self.points_version += 1
             
     def add_all_frames(self, frames):
         self.frames = frames
 
-    def set_depth_paths(self, depth_paths):
-        self.depth_paths = list(depth_paths)
+    def set_depth_maps(self, depth_maps):
+        self.depth_maps = list(depth_maps)
     
     def add_all_retrieval_vectors(self, retrieval_vectors):
         self.retrieval_vectors = retrieval_vectors
@@ -82,12 +85,16 @@ class Submap:
     def set_frame_ids(self, file_paths):
         """
         Extract the frame number (integer or decimal) from the file names, 
-        removing any leading zeros, and add them all to a list.
+        removing any leading zeros, and add them all to a list. Numeric
+        entries (e.g. sequence numbers of in-memory frames) are used as is.
 
         Note: This does not include any of the loop closure frames.
         """
         frame_ids = []
         for path in file_paths:
+            if isinstance(path, (int, float, np.integer, np.floating)):
+                frame_ids.append(float(path))
+                continue
             filename = os.path.basename(path)
             match = re.search(r'\d+(?:\.\d+)?', filename)  # matches integers and decimals
             if match:
@@ -145,14 +152,24 @@ class Submap:
                 break
         return point_list, frame_id_list, frame_conf_mask
 
-    def get_points_in_world_frame(self, stride = 1):
+    def get_points_in_local_frame(self, stride = 1):
         points = self.filter_data_by_confidence(self.pointclouds, stride)
+        return points.reshape(-1, 3)
+
+    def get_points_in_world_frame(self, stride = 1, H_world_map = None):
+        points = self.filter_data_by_confidence(self.pointclouds, stride)
+        if H_world_map is None:
+            H_world_map = self.H_world_map
 
         points_flat = points.reshape(-1, 3)
         points_homogeneous = np.hstack([points_flat, np.ones((points_flat.shape[0], 1))])
-        points_transformed = (self.H_world_map @ points_homogeneous.T).T
+        points_transformed = (H_world_map @ points_homogeneous.T).T
         return points_transformed[:, :3] / points_transformed[:, 3:]
 
+    def count_confident_points(self):
+        """Number of points get_points_in_world_frame() returns at stride 1."""
+        return int(np.count_nonzero(self.conf >= self.conf_threshold))
+
     def get_voxel_points_in_world_frame(self, voxel_size, nb_points=8, factor_for_outlier_rejection=2.0):
         if self.voxelized_points is None:
             if voxel_size > 0.0:
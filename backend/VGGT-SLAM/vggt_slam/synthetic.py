@@ -0,0 +1,113 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+# Deterministic CPU stand-ins for VGGT and the SALAD retrieval encoder, so the
+# pipeline downstream of inference (alignment, pose graph, depth refinement,
+# export and streaming) can be benchmarked and regression-tested without the
+# checkpoints or a GPU.
+#
+# The scripted scene is a corrugated wall z = depth + amplitude * sin(frequency * y),
+# extruded along x, and the camera dollies along +x at a constant speed while
+# looking down +z. Every frame therefore sees the same non-planar surface, so
+# the overlapping frames of consecutive submaps agree exactly and the
+# alignment has a well-posed (non-coplanar) set of points to work with.
+
+
+class SyntheticVGGT(torch.nn.Module):
+    """Drop-in replacement for ``vggt.models.vggt.VGGT`` producing scripted predictions.
+
+    Returns the same keys and shapes as VGGT: ``pose_enc`` (B, S, 9) in the
+    absT_quaR_FoV encoding, ``depth`` (B, S, H, W, 1), ``depth_conf``
+    (B, S, H, W), ``world_points`` (B, S, H, W, 3), ``world_points_conf``
+    (B, S, H, W) and ``images`` (B, S, 3, H, W). Poses are relative to the
+    first frame of the batch, as with VGGT.
+    """
+
+    def __init__(self, step=0.05, depth=2.0, amplitude=0.3, frequency=1.5, fov=math.radians(60.0)):
+        super().__init__()
+        self.step = step
+        self.depth = depth
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.fov = fov
+        # Lets .to(device) and .eval() behave as they do on the real model
+        self.register_buffer("_device_anchor", torch.zeros(1), persistent=False)
+
+    def _surface_depth(self, y_over_z):
+        # Intersect each pixel ray with the wall; a few fixed-point steps
+        # converge since amplitude * frequency * |y/z| < 1.
+        d = torch.full_like(y_over_z, self.depth)
+        for _ in range(8):
+            d = self.depth + self.amplitude * torch.sin(self.frequency * y_over_z * d)
+        return d
+
+    def forward(self, images):
+        if images.dim() == 4:
+            images = images.unsqueeze(0)
+        B, S, _, H, W = images.shape
+        device = images.device
+
+        fy = (H / 2.0) / math.tan(self.fov / 2.0)
+        fx = fy
+        fov_w = 2.0 * math.atan((W / 2.0) / fx)
+        v, u = torch.meshgrid(
+            torch.arange(H, device=device, dtype=torch.float32),
+            torch.arange(W, device=device, dtype=torch.float32),
+            indexing="ij",
+        )
+        x_over_z = (u - (W - 1) / 2.0) / fx
+        y_over_z = (v - (H - 1) / 2.0) / fy
+        depth = self._surface_depth(y_over_z)  # (H, W), identical for every frame
+
+        # Confidence varies smoothly over the image so percentile thresholds
+        # keep a stable share of the points.
+        conf = 1.0 + 4.0 * (0.5 + 0.5 * torch.cos(2.0 * math.pi * u / W) * torch.cos(2.0 * math.pi * v / H))
+
+        offsets = torch.arange(S, device=device, dtype=torch.float32) * self.step  # camera x per frame
+        cam_points = torch.stack([x_over_z * depth, y_over_z * depth, depth], dim=-1)  # (H, W, 3)
+        world_points = cam_points.expand(S, H, W, 3).clone()
+        world_points[..., 0] += offsets.view(S, 1, 1)
+
+        # World-to-camera translation with identity rotation (quaternion xyzw)
+        pose_enc = torch.zeros(S, 9, device=device)
+        pose_enc[:, 0] = -offsets
+        pose_enc[:, 6] = 1.0
+        pose_enc[:, 7] = self.fov
+        pose_enc[:, 8] = fov_w
+
+        def batched(t):
+            return t.unsqueeze(0).expand(B, *t.shape).contiguous()
+
+        return {
+            "pose_enc": batched(pose_enc),
+            "depth": batched(depth.expand(S, H, W).unsqueeze(-1)),
+            "depth_conf": batched(conf.expand(S, H, W)),
+            "world_points": batched(world_points),
+            "world_points_conf": batched(conf.expand(S, H, W)),
+            "images": images.float(),
+        }
+
+
+class StubImageRetrieval:
+    """Cheap stand-in for ``ImageRetrieval``: no checkpoint, no loop closures.
+
+    Embeddings are a normalized thumbnail of each frame, so submaps still carry
+    retrieval vectors of a realistic shape. The scripted trajectory never
+    revisits a place, so no loop closures are reported.
+    """
+
+    def __init__(self, thumbnail_size=16):
+        self.thumbnail_size = thumbnail_size
+
+    def get_batch_descriptors(self, imgs):
+        with torch.no_grad():
+            thumbs = F.adaptive_avg_pool2d(imgs.float(), self.thumbnail_size).flatten(1)
+            return F.normalize(thumbs, dim=1)
+
+    def get_all_submap_embeddings(self, submap):
+        return self.get_batch_descriptors(submap.get_all_frames())
+
+    def find_loop_closures(self, map, submap, max_similarity_thres=0.80, max_loop_closures=0):
+        return []
@@ -0,0 +1,150 @@
+"""Compact depth transport between the capture bridge and /ws/upload.
+
+Depth frames are sent as uint16 millimetres behind a small header instead of
+float32 ``.npy`` payloads:
+
+    offset  size  field
+    0       4     magic b"VDPT"
+    4       1     version (1)
+    5       1     codec (0 raw, 1 png, 2 lz4)
+    6       2     reserved
+    8       4     uint32 sequence number of the image the depth belongs to
+    12      2     uint16 height
+    14      2     uint16 width
+    16      ...   payload
+
+``raw`` is H*W little-endian uint16, ``lz4`` is the same LZ4-frame compressed
+and ``png`` is a 16-bit grayscale PNG. Depths are rounded to whole
+millimetres; invalid values (NaN, inf, negative) become 0.
+
+Negotiation: the client sends ``config:depth_codec:<codec>`` and keeps sending
+``.npy`` depth until the server confirms with ``status:depth_codec:<codec>``.
+A server without the codec answers ``error:...`` instead; older servers do not
+answer at all.
+"""
+
+import io
+import struct
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+try:
+    import lz4.frame  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    lz4 = None  # type: ignore
+
+
+DEPTH_MAGIC = b"VDPT"
+DEPTH_VERSION = 1
+DEPTH_CODECS = ("raw", "png", "lz4")
+DEPTH_CODEC_CONFIG = "config:depth_codec:"
+DEPTH_CODEC_STATUS = "status:depth_codec:"
+_DEPTH_HEADER = struct.Struct("<4sBBHIHH")
+
+
+def available_codecs() -> Tuple[str, ...]:
+    """Codecs this process can encode and decode."""
+    return tuple(c for c in DEPTH_CODECS if c != "lz4" or lz4 is not None)
+
+
+def to_uint16_mm(depth_mm: np.ndarray) -> np.ndarray:
+    depth = np.nan_to_num(np.asarray(depth_mm, dtype=np.float32), nan=0.0, posinf=0.0, neginf=0.0)
+    return np.clip(np.rint(depth), 0, 65535).astype("<u2")
+
+
+def encode_depth(depth_mm: np.ndarray, seq: int, codec: str = "png") -> bytes:
+    """Pack an (H, W) depth map in millimetres for image ``seq``."""
+    if depth_mm.ndim != 2:
+        raise ValueError("depth_mm must be 2D (H, W)")
+    if codec not in available_codecs():
+        raise ValueError(f"Unsupported depth codec {codec!r}, expected one of {available_codecs()}")
+    depth = to_uint16_mm(depth_mm)
+    h, w = depth.shape
+    if codec == "png":
+        ok, png = cv2.imencode(".png", depth)
+        if not ok:
+            raise RuntimeError("PNG encoding of depth map failed")
+        payload = png.tobytes()
+    else:
+        payload = depth.tobytes()
+        if codec == "lz4":
+            payload = lz4.frame.compress(payload)
+    header = _DEPTH_HEADER.pack(DEPTH_MAGIC, DEPTH_VERSION, DEPTH_CODECS.index(codec), 0, seq, h, w)
+    return header + payload
+
+
+def is_depth_frame(data: bytes) -> bool:
+    return data[:4] == DEPTH_MAGIC
+
+
+def depth_header(data: bytes) -> Tuple[str, int, Tuple[int, int]]:
+    """``(codec, seq, (height, width))`` of an encoded depth frame."""
+    if len(data) < _DEPTH_HEADER.size:
+        raise ValueError("Truncated depth header")
+    magic, version, codec_id, _, seq, h, w = _DEPTH_HEADER.unpack_from(data)
+    if magic != DEPTH_MAGIC:
+        raise ValueError("Not an encoded depth frame")
+    if version != DEPTH_VERSION:
+        raise ValueError(f"Unsupported depth frame version {version}")
+    if codec_id >= len(DEPTH_CODECS):
+        raise ValueError(f"Unknown depth codec id {codec_id}")
+    return DEPTH_CODECS[codec_id], seq, (h, w)
+
+
+def decode_depth(data: bytes) -> Tuple[int, np.ndarray]:
+    """Returns ``(seq, depth)`` with depth as (H, W) uint16 millimetres."""
+    codec, seq, (h, w) = depth_header(data)
+    payload = memoryview(data)[_DEPTH_HEADER.size:]
+    if codec == "png":
+        depth = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if depth is None or depth.dtype != np.uint16:
+            raise ValueError("Depth PNG is not a 16-bit grayscale image")
+    else:
+        if codec == "lz4":
+            if lz4 is None:
+                raise RuntimeError("lz4 is required to decode this depth frame")
+            payload = lz4.frame.decompress(payload)
+        if len(payload) != h * w * 2:
+            raise ValueError(f"Expected {h * w * 2} depth bytes, got {len(payload)}")
+        depth = np.frombuffer(payload, dtype="<u2")
+    if depth.size != h * w:
+        raise ValueError(f"Depth payload has {depth.size} values, header says {h}x{w}")
+    return seq, depth.reshape(h, w)
+
+
+class DepthCodecNegotiation:
+    """Client-side codec choice for one upload connection.
+
+    ``encode()`` produces legacy float32 ``.npy`` bytes until the server has
+    confirmed the requested codec. If the server rejects lz4, png is
+    requested instead.
+    """
+
+    def __init__(self, preferred: Optional[str] = None):
+        if preferred is None:
+            preferred = "lz4" if lz4 is not None else "png"
+        self.requested = preferred
+        self.codec: Optional[str] = None
+
+    def config_message(self) -> str:
+        return DEPTH_CODEC_CONFIG + self.requested
+
+    def handle_text(self, text: str) -> Optional[str]:
+        """Process a server message; returns a config message to send next, if any."""
+        if text.startswith(DEPTH_CODEC_STATUS):
+            codec = text[len(DEPTH_CODEC_STATUS):].strip()
+            if codec in available_codecs():
+                self.codec = codec
+        elif text.startswith("error:") and "depth codec" in text and self.codec is None and self.requested != "png":
+            self.requested = "png"
+            return self.config_message()
+        return None
+
+    def encode(self, depth_mm: np.ndarray, seq: int) -> bytes:
+        if self.codec is None:
+            buf = io.BytesIO()
+            np.save(buf, np.asarray(depth_mm, dtype=np.float32))
+            return buf.getvalue()
+        return encode_depth(depth_mm, seq, self.codec)
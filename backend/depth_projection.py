@@ -1,5 +1,7 @@
+import functools
 import os
-from typing import Tuple
+import time
+from typing import Dict, Iterable, Tuple, Union
 
 import cv2
 import numpy as np
@@ -7,6 +9,24 @@ import numpy as np
 
 CALIBRATION_FILE = os.path.join(os.path.dirname(__file__), "VGGT-SLAM", "camera_and_R_T_matrices.yml")
 
+# Network input width; must match target_size in vggt_slam's
+# load_and_preprocess_image_arrays (and vggt's load_and_preprocess_images).
+VGGT_INPUT_SIZE = 518
+
+
+def vggt_grid(rgb_shape: Tuple[int, ...], target_size: int = VGGT_INPUT_SIZE) -> Tuple[float, float, int, Tuple[int, int]]:
+    """How VGGT preprocessing maps an RGB frame onto the network grid.
+
+    Crop mode: resize to ``target_size`` wide with the height rounded to a
+    multiple of 14, then centre-crop the height to ``target_size``. Returns
+    ``(scale_x, scale_y, crop_top, (height, width))``.
+    """
+    H, W = rgb_shape[:2]
+    new_w = target_size
+    new_h = round(H * (new_w / W) / 14) * 14
+    crop_top = (new_h - target_size) // 2 if new_h > target_size else 0
+    return new_w / W, new_h / H, crop_top, (min(new_h, target_size), new_w)
+
 
 def load_calibration(filename: str = CALIBRATION_FILE):
     if not os.path.exists(filename):
@@ -28,6 +48,153 @@ def load_calibration(filename: str = CALIBRATION_FILE):
     return calib
 
 
+class DepthProjector:
+    """Helios-to-GoPro depth projection bound to one calibration and output grid.
+
+    Everything that depends only on the calibration is computed once: the
+    undistorted iToF pixel rays (per depth resolution) rotated into the RGB
+    frame, and the translation. Projecting a frame is then a multiply-add,
+    one ``cv2.projectPoints`` and a z-buffer splat.
+    """
+
+    def __init__(
+        self,
+        calib: Dict[str, np.ndarray],
+        output_shape: Tuple[int, ...],
+        fill_radius: int = 0,
+        max_depth_mm: float = 8300.0,
+    ):
+        self.K_iToF = np.asarray(calib["K_iToF"], dtype=np.float64)
+        self.dist_iToF = np.asarray(calib["dist_iToF"], dtype=np.float64)
+        self.K_RGB = np.asarray(calib["K_RGB"], dtype=np.float64)
+        self.dist_RGB = np.asarray(calib["dist_RGB"], dtype=np.float64)
+        self.R = np.asarray(calib["R"], dtype=np.float64).reshape(3, 3)
+        self.T = np.asarray(calib["T"], dtype=np.float64).reshape(3, 1)
+        self.output_shape = tuple(output_shape[:2])
+        self.fill_radius = fill_radius
+        self.max_depth_mm = max_depth_mm
+        self._rays: Dict[Tuple[int, int], np.ndarray] = {}
+
+    @classmethod
+    def for_vggt_grid(cls, calib: Dict[str, np.ndarray], rgb_shape: Tuple[int, ...], target_size: int = VGGT_INPUT_SIZE, **kwargs) -> "DepthProjector":
+        """Projector straight onto the preprocessed VGGT grid of ``rgb_shape`` frames.
+
+        The RGB intrinsics are scaled and shifted the way preprocessing
+        resizes and crops the image, so the result lines up pixel for pixel
+        with the network's depth and point maps without a later resize.
+        """
+        scale_x, scale_y, crop_top, grid_shape = vggt_grid(rgb_shape, target_size)
+        K = np.asarray(calib["K_RGB"], dtype=np.float64).copy()
+        # Pixel centres: u' + 0.5 = (u + 0.5) * scale
+        K[0, :] *= scale_x
+        K[1, :] *= scale_y
+        K[0, 2] += 0.5 * (scale_x - 1.0)
+        K[1, 2] += 0.5 * (scale_y - 1.0) - crop_top
+        return cls(dict(calib, K_RGB=K), grid_shape, **kwargs)
+
+    def rays(self, depth_shape: Tuple[int, int]) -> np.ndarray:
+        """(3, h*w) undistorted iToF rays with z = 1, rotated into the RGB frame."""
+        depth_shape = tuple(depth_shape[:2])
+        rays = self._rays.get(depth_shape)
+        if rays is None:
+            h, w = depth_shape
+            u, v = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+            pixels = np.stack((u.reshape(-1), v.reshape(-1)), axis=-1).reshape(-1, 1, 2)
+            undistorted = cv2.undistortPoints(pixels, self.K_iToF, self.dist_iToF)[:, 0, :]
+            rays_iToF = np.vstack((undistorted.T, np.ones((1, h * w), dtype=np.float32)))
+            rays = np.ascontiguousarray(self.R @ rays_iToF)
+            self._rays[depth_shape] = rays
+        return rays
+
+    def project(self, depth_mm: np.ndarray) -> np.ndarray:
+        """Project one (h, w) Helios depth map; returns (H, W) float32 millimetres."""
+        if depth_mm.ndim != 2:
+            raise ValueError("depth_mm must be 2D (H, W)")
+        H, W = self.output_shape
+
+        # Metres; R @ (ray * Z) + T == (R @ ray) * Z + T
+        Z = depth_mm.astype(np.float32).reshape(1, -1) / np.float32(1000.0)
+        points_RGB = self.rays(depth_mm.shape) * Z + self.T  # 3 x N
+
+        u_rgb, v_rgb = self._project_rgb(points_RGB)
+        depth_z = points_RGB[2]
+
+        valid = (
+            (u_rgb >= 0)
+            & (u_rgb < W)
+            & (v_rgb >= 0)
+            & (v_rgb < H)
+            & (depth_z > 0)
+            & np.isfinite(depth_z)
+        )
+        # Clamp to expected operating range and keep nearest depth per pixel
+        d_mm = np.clip((depth_z[valid] * 1000.0).astype(np.float32), 0.0, self.max_depth_mm)
+        depth_proj_mm = splat_nearest_depth(
+            u_rgb[valid].astype(np.int32), v_rgb[valid].astype(np.int32), d_mm, (H, W)
+        )
+        if self.fill_radius > 0:
+            depth_proj_mm = fill_depth_holes(depth_proj_mm, self.fill_radius)
+        return depth_proj_mm
+
+    def _project_rgb(self, points_RGB: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Pixel coordinates of 3 x N RGB-frame points, with lens distortion.
+
+        Evaluates the k1, k2, p1, p2, k3 model directly; ``cv2.projectPoints``
+        also computes the full Jacobian, which costs several times more.
+        Other distortion models go through OpenCV.
+        """
+        dist = self.dist_RGB.reshape(-1)
+        if dist.size > 5:
+            proj, _ = cv2.projectPoints(
+                points_RGB.T.astype(np.float32),
+                np.zeros(3, dtype=np.float32),
+                np.zeros(3, dtype=np.float32),
+                self.K_RGB,
+                self.dist_RGB,
+            )
+            return proj[:, 0, 0], proj[:, 0, 1]
+        k1, k2, p1, p2, k3 = np.pad(dist, (0, 5 - dist.size))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = points_RGB[0] / points_RGB[2]
+            y = points_RGB[1] / points_RGB[2]
+        r2 = x * x + y * y
+        radial = 1.0 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        xd = x * radial + 2.0 * p1 * x * y + p2 * (r2 + 2.0 * x * x)
+        yd = y * radial + p1 * (r2 + 2.0 * y * y) + 2.0 * p2 * x * y
+        K = self.K_RGB
+        return K[0, 0] * xd + K[0, 1] * yd + K[0, 2], K[1, 1] * yd + K[1, 2]
+
+    def project_batch(self, depths: Union[np.ndarray, Iterable[np.ndarray]]) -> np.ndarray:
+        """Project an (N, h, w) stack or an iterable of (h, w) depth maps.
+
+        Returns (N, H, W) float32 millimetres. Rays are computed once per
+        depth resolution and shared by every frame.
+        """
+        depths = list(depths)
+        out = np.empty((len(depths),) + self.output_shape, dtype=np.float32)
+        for i, depth_mm in enumerate(depths):
+            out[i] = self.project(depth_mm)
+        return out
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_calibration(filename: str):
+    return load_calibration(filename)
+
+
+@functools.lru_cache(maxsize=8)
+def get_projector(rgb_shape: Tuple[int, ...], vggt: bool = False, filename: str = CALIBRATION_FILE) -> DepthProjector:
+    """Shared projector per RGB frame size, so the calibration is parsed once per process.
+
+    With ``vggt``, the projector targets the preprocessed network grid
+    instead of the full RGB grid.
+    """
+    calib = _cached_calibration(filename)
+    if vggt:
+        return DepthProjector.for_vggt_grid(calib, rgb_shape)
+    return DepthProjector(calib, rgb_shape)
+
+
 def project_depth_onto_rgb(
     depth_mm: np.ndarray,
     K_iToF: np.ndarray,
@@ -37,83 +204,100 @@ def project_depth_onto_rgb(
     R: np.ndarray,
     T: np.ndarray,
     rgb_shape: Tuple[int, int, int],
+    fill_radius: int = 0,
 ) -> np.ndarray:
     """Project Helios depth map onto GoPro RGB grid with iToF undistortion.
 
-    Returns depth_proj_mm with shape (H_rgb, W_rgb) in millimetres.
+    Returns depth_proj_mm with shape (H_rgb, W_rgb) in millimetres. With
+    ``fill_radius`` > 0, empty pixels take the nearest depth found within
+    that many pixels (see ``fill_depth_holes``). Rebuilds the rays on every
+    call; use a ``DepthProjector`` for repeated projection.
     """
-    H_rgb, W_rgb = rgb_shape[:2]
-
-    if depth_mm.ndim != 2:
-        raise ValueError("depth_mm must be 2D (H, W)")
-
-    # Convert to metres
-    Z = depth_mm.astype(np.float32) / 1000.0
-
-    h, w = Z.shape
-    u, v = np.meshgrid(
-        np.arange(w, dtype=np.float32),
-        np.arange(h, dtype=np.float32),
-    )
-
-    Z_flat = Z.reshape(-1)
-
-    # Pack distorted pixel coords (u, v) for OpenCV undistortPoints
-    pixels = np.stack((u.reshape(-1), v.reshape(-1)), axis=-1)
-    pixels = pixels.reshape(-1, 1, 2)  # (N, 1, 2)
-
-    # Undistort to normalized rays in Helios camera frame
-    undistorted = cv2.undistortPoints(pixels, K_iToF, dist_iToF)
-    x = undistorted[:, 0, 0]
-    y = undistorted[:, 0, 1]
-
-    # Back-project to 3D in Helios frame
-    X = x * Z_flat
-    Y = y * Z_flat
-    points_iToF = np.vstack((X, Y, Z_flat))  # 3 x N
-
-    # Transform to GoPro (RGB) coordinate system
-    points_RGB = (R @ points_iToF) + T  # 3 x N
-
-    # Project to GoPro image plane with distortion
-    points_RGB_3d = points_RGB.T.astype(np.float32)
-
-    proj, _ = cv2.projectPoints(
-        points_RGB_3d,
-        np.zeros(3, dtype=np.float32),
-        np.zeros(3, dtype=np.float32),
-        K_RGB,
-        dist_RGB,
-    )
-
-    u_rgb = proj[:, 0, 0]
-    v_rgb = proj[:, 0, 1]
-    depth_z = points_RGB[2]
-
-    depth_proj_mm = np.zeros((H_rgb, W_rgb), dtype=np.float32)
-
-    valid = (
-        (u_rgb >= 0)
-        & (u_rgb < W_rgb)
-        & (v_rgb >= 0)
-        & (v_rgb < H_rgb)
-        & (depth_z > 0)
-        & np.isfinite(depth_z)
-    )
-
-    if not np.any(valid):
-        return depth_proj_mm
+    calib = {"K_iToF": K_iToF, "dist_iToF": dist_iToF, "K_RGB": K_RGB, "dist_RGB": dist_RGB, "R": R, "T": T}
+    return DepthProjector(calib, rgb_shape, fill_radius=fill_radius).project(depth_mm)
+
 
-    u_int = u_rgb[valid].astype(np.int32)
-    v_int = v_rgb[valid].astype(np.int32)
-    d_mm = (depth_z[valid] * 1000.0).astype(np.float32)
+def splat_nearest_depth(u: np.ndarray, v: np.ndarray, depth: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """Z-buffer splat: write each depth to pixel (v, u), keeping the nearest.
+
+    ``u``/``v`` must already be inside ``shape``. Pixels that receive no depth
+    stay 0.
+    """
+    H, W = shape
+    out = np.full(H * W, np.inf, dtype=np.float32)
+    index = v.astype(np.intp) * W + u.astype(np.intp)
+    np.minimum.at(out, index, depth.astype(np.float32, copy=False))
+    out[np.isinf(out)] = 0.0
+    return out.reshape(H, W)
 
-    # Clamp to expected operating range and keep nearest depth per pixel
-    d_mm = np.clip(d_mm, 0.0, 8300.0)
 
-    for ui, vi, di in zip(u_int, v_int, d_mm):
-        current = depth_proj_mm[vi, ui]
+def fill_depth_holes(depth_mm: np.ndarray, radius: int = 1) -> np.ndarray:
+    """Fill empty (0) pixels with the nearest depth within ``radius`` pixels.
+
+    Splatting a lower-resolution depth map onto a larger grid leaves gaps
+    between samples; taking the minimum of the neighbourhood keeps
+    foreground edges from being filled with background depth.
+    """
+    empty = depth_mm <= 0
+    if radius <= 0 or not empty.any():
+        return depth_mm
+    far = np.where(empty, np.float32(np.inf), depth_mm).astype(np.float32, copy=False)
+    kernel = np.ones((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    # Only empty pixels take the neighbourhood minimum; measured ones are kept
+    filled = np.where(empty, cv2.erode(far, kernel, borderType=cv2.BORDER_REPLICATE), far)
+    # Holes wider than the radius stay empty
+    filled[np.isinf(filled)] = 0.0
+    return filled
+
+
+def _splat_nearest_depth_loop(u, v, depth, shape):
+    """Reference per-point implementation, kept for the benchmark below."""
+    out = np.zeros(shape, dtype=np.float32)
+    for ui, vi, di in zip(u, v, depth):
+        current = out[vi, ui]
         if current == 0 or di < current:
-            depth_proj_mm[vi, ui] = di
+            out[vi, ui] = di
+    return out
+
+
+def _benchmark(repeats: int = 5) -> None:
+    """Compare the vectorized splat against the per-point loop on Helios-sized input."""
+    rng = np.random.default_rng(0)
+    H, W = 1080, 1920
+    n = 640 * 480  # one Helios frame
+    u = rng.integers(0, W, n).astype(np.int32)
+    v = rng.integers(0, H, n).astype(np.int32)
+    d = rng.uniform(300.0, 8300.0, n).astype(np.float32)
+
+    def best_of(fn):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - t0)
+        return min(times), result
+
+    t_loop, expected = best_of(lambda: _splat_nearest_depth_loop(u, v, d, (H, W)))
+    t_vec, actual = best_of(lambda: splat_nearest_depth(u, v, d, (H, W)))
+    t_fill, _ = best_of(lambda: fill_depth_holes(actual, 1))
+    if not np.array_equal(expected, actual):
+        raise AssertionError("vectorized splat differs from the reference loop")
+    print(f"{n} points onto {W}x{H}:")
+    print(f"  loop splat        {t_loop * 1000.0:8.1f} ms")
+    print(f"  vectorized splat  {t_vec * 1000.0:8.1f} ms  ({t_loop / t_vec:.0f}x)")
+    print(f"  hole fill (r=1)   {t_fill * 1000.0:8.1f} ms")
+
+    if os.path.exists(CALIBRATION_FILE):
+        calib = load_calibration(CALIBRATION_FILE)
+        depth_mm = rng.uniform(300.0, 8300.0, (480, 640)).astype(np.float32)
+        projector = DepthProjector(calib, (H, W))
+        projector.project(depth_mm)  # builds the rays
+        t_call, _ = best_of(lambda: project_depth_onto_rgb(depth_mm, *(calib[k] for k in ("K_iToF", "dist_iToF", "K_RGB", "dist_RGB", "R", "T")), (H, W)))
+        t_proj, _ = best_of(lambda: projector.project(depth_mm))
+        print("640x480 depth frame onto 1920x1080:")
+        print(f"  project_depth_onto_rgb   {t_call * 1000.0:8.1f} ms")
+        print(f"  DepthProjector.project   {t_proj * 1000.0:8.1f} ms")
+
 
-    return depth_proj_mm
+if __name__ == "__main__":
+    _benchmark()
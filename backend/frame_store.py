@@ -0,0 +1,85 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+
+@dataclass
+class StoredFrame:
+    """A decoded frame held in memory for the lifetime of a session."""
+
+    seq: int
+    image: np.ndarray  # (H, W, 3) uint8, BGR as returned by cv2
+    depth_mm: Optional[np.ndarray] = None  # (H, W) float32 millimetres
+    timestamp: Optional[float] = None  # capture time from the client, if sent
+
+
+def decode_image(data: bytes) -> Optional[np.ndarray]:
+    """Decode encoded image bytes (JPEG/PNG) to a BGR array, or None on failure."""
+    if not data:
+        return None
+    buf = np.frombuffer(data, dtype=np.uint8)
+    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if img is None or img.size == 0:
+        return None
+    return img
+
+
+class FrameStore:
+    """Session-scoped store of accepted frames keyed by sequence number.
+
+    Frames are decoded once on arrival and kept in memory until they have
+    been handed to the solver, so the per-frame path never touches disk.
+    When ``spill_dir`` is set, each frame is additionally written there
+    (without fsync) for offline inspection; nothing is ever read back.
+    """
+
+    def __init__(self, spill_dir: Optional[str] = None):
+        self.spill_dir = spill_dir
+        self._frames: Dict[int, StoredFrame] = {}
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __contains__(self, seq: int) -> bool:
+        return seq in self._frames
+
+    def add_image(
+        self, seq: int, image: np.ndarray, encoded: Optional[bytes] = None, timestamp: Optional[float] = None
+    ) -> StoredFrame:
+        frame = StoredFrame(seq=seq, image=image, timestamp=timestamp)
+        self._frames[seq] = frame
+        if self.spill_dir:
+            path = os.path.join(self.spill_dir, f"frame_{seq:06d}.png")
+            if encoded is not None:
+                with open(path, "wb") as f:
+                    f.write(encoded)
+            else:
+                cv2.imwrite(path, image)
+        return frame
+
+    def set_depth(self, seq: int, depth_mm: np.ndarray) -> bool:
+        """Attach a depth map to an accepted frame. Returns False if the frame is unknown."""
+        frame = self._frames.get(seq)
+        if frame is None:
+            return False
+        frame.depth_mm = depth_mm.astype(np.float32, copy=False)
+        if self.spill_dir:
+            np.save(os.path.join(self.spill_dir, f"frame_{seq:06d}_depth_proj_mm.npy"), frame.depth_mm)
+        return True
+
+    def get(self, seq: int) -> Optional[StoredFrame]:
+        return self._frames.get(seq)
+
+    def pop(self, seq: int) -> Optional[StoredFrame]:
+        return self._frames.pop(seq, None)
+
+    def sequences(self) -> List[int]:
+        return sorted(self._frames)
+
+    def clear(self) -> None:
+        self._frames.clear()
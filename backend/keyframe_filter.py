@@ -0,0 +1,120 @@
+"""Client-side keyframe pre-filter for /ws/upload.
+
+The backend keeps a frame only if the mean Lucas-Kanade displacement of the
+last keyframe's corners exceeds a threshold (``FrameTracker`` in
+``vggt_slam.frame_overlap``). Most frames of a 30 fps camera fail that test,
+after paying for JPEG encoding, transfer, decoding and, with depth, a full
+projection. ``KeyframePreFilter`` runs the same test on a downscaled
+grayscale copy before any of that, so only candidates are sent.
+
+The two trackers stay consistent because the filter only moves its keyframe
+when the backend's ack says a sent frame was accepted. The threshold is
+taken from ``status:keyframe_disparity:<pixels>``, scaled to the reduced
+resolution and lowered by ``margin`` so that frames the backend would keep
+are not filtered out by the cheaper estimate.
+"""
+
+import json
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+from upload_protocol import ACK_PREFIX, KEYFRAME_DISPARITY_STATUS
+
+# Threshold used until the backend announces its own (older backends never do)
+DEFAULT_MIN_DISPARITY = 97.0
+# Pending candidates kept while waiting for their acks
+MAX_PENDING = 64
+MAX_CORNERS = 300
+
+
+class KeyframePreFilter:
+    def __init__(self, scale: float = 0.25, margin: float = 0.8, min_disparity: float = DEFAULT_MIN_DISPARITY):
+        if not 0.0 < scale <= 1.0:
+            raise ValueError("scale must be in (0, 1]")
+        self.scale = scale
+        self.margin = margin
+        self.min_disparity = min_disparity
+        self._kf_gray: Optional[np.ndarray] = None
+        self._kf_pts: Optional[np.ndarray] = None
+        # seq -> downscaled gray frame sent as a candidate, awaiting its ack
+        self._pending: Dict[int, np.ndarray] = {}
+        self.checked = 0
+        self.candidates = 0
+
+    @property
+    def threshold(self) -> float:
+        """Displacement threshold in downscaled pixels."""
+        return self.min_disparity * self.scale * self.margin
+
+    def _gray(self, frame: np.ndarray) -> np.ndarray:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self.scale == 1.0:
+            return gray
+        return cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def _set_keyframe(self, gray: np.ndarray) -> None:
+        self._kf_gray = gray
+        # FrameTracker's corner settings with distances scaled down, and fewer
+        # corners: only their mean displacement is used, and LK cost is
+        # proportional to the corner count
+        self._kf_pts = cv2.goodFeaturesToTrack(
+            gray,
+            maxCorners=MAX_CORNERS,
+            qualityLevel=0.01,
+            minDistance=max(8 * self.scale, 1.0),
+            blockSize=max(int(round(7 * self.scale)) | 1, 3),
+        )
+
+    def is_candidate(self, frame: np.ndarray) -> bool:
+        """True if the backend may accept ``frame`` as a keyframe."""
+        self.checked += 1
+        if self._kf_pts is None or len(self._kf_pts) < 10:
+            # No accepted keyframe yet (or too little texture to track), which
+            # the backend treats as a keyframe too
+            self.candidates += 1
+            return True
+        gray = self._gray(frame)
+        next_pts, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._kf_gray, gray, self._kf_pts, None,
+            winSize=(21, 21), maxLevel=3,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+        )
+        ok = status.flatten() == 1
+        if ok.sum() < 10:
+            self.candidates += 1
+            return True
+        disparity = float(np.mean(np.linalg.norm(next_pts[ok] - self._kf_pts[ok], axis=-1)))
+        if disparity > self.threshold:
+            self.candidates += 1
+            return True
+        return False
+
+    def sent(self, seq: int, frame: np.ndarray) -> None:
+        """Record that ``frame`` went out as image ``seq``."""
+        self._pending[seq] = self._gray(frame)
+        while len(self._pending) > MAX_PENDING:
+            del self._pending[min(self._pending)]
+
+    def handle_text(self, text: str) -> bool:
+        """Consume the threshold announcement and frame acks. Returns True if
+        ``text`` was the announcement."""
+        if text.startswith(KEYFRAME_DISPARITY_STATUS):
+            try:
+                self.min_disparity = float(text[len(KEYFRAME_DISPARITY_STATUS):])
+            except ValueError:
+                pass
+            return True
+        if text.startswith(ACK_PREFIX):
+            try:
+                ack = json.loads(text[len(ACK_PREFIX):])
+            except ValueError:
+                return False
+            gray = self._pending.pop(ack.get("seq"), None)
+            if gray is not None and ack.get("accepted"):
+                self._set_keyframe(gray)
+                # Older candidates were compared against an outdated keyframe
+                for seq in [s for s in self._pending if s < ack["seq"]]:
+                    del self._pending[seq]
+        return False
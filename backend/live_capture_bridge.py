@@ -1,18 +1,21 @@
 import argparse
 import asyncio
-import base64
 import io
-import json
 import os
 import signal
 import sys
 import threading
+import time
 from typing import Optional, Tuple
 
 import cv2
 import numpy as np
 
-from depth_projection import CALIBRATION_FILE, load_calibration, project_depth_onto_rgb
+from depth_projection import CALIBRATION_FILE, DepthProjector, load_calibration
+from upload_protocol import FLOW_CONTROL_CONFIG, CreditWindow, TypedFraming, pack_frame
+from depth_codec import DEPTH_CODECS, DepthCodecNegotiation
+from keyframe_filter import KeyframePreFilter
+from preview_channel import PREVIEW_FORMATS, PreviewChannel
 
 try:
     import websockets  # type: ignore
@@ -27,11 +30,9 @@ except ImportError:  # pragma: no cover
 
 try:
     from arena_api.system import system  # type: ignore
-    from arena_api.buffer import BufferFactory  # type: ignore
     from arena_api.enums import PixelFormat  # type: ignore
 except ImportError:  # pragma: no cover
     system = None  # type: ignore
-    BufferFactory = None  # type: ignore
     PixelFormat = None  # type: ignore
 
 
@@ -203,64 +204,85 @@ def _start_helios_thread(device, z_scale: float, z_offset: float) -> threading.T
     return t
 
 
-def helios_grab_depth_mm(device, z_scale: float, z_offset: float) -> Optional[np.ndarray]:
-    """Grab one Helios frame and convert to depth in mm.
-
-    Returns a 2D array (H, W) in millimetres, or None on failure.
+async def _drain_backend_messages(
+    ws,
+    window: CreditWindow,
+    depth_link: Optional[DepthCodecNegotiation] = None,
+    framing: Optional[TypedFraming] = None,
+    keyframes: Optional[KeyframePreFilter] = None,
+) -> None:
+    """Read backend messages so credits, acks and negotiation replies are processed promptly.
     """
-    if BufferFactory is None:
-        return None
-
-    with device.start_stream():  # type: ignore[attr-defined]
-        try:
-            buffer = device.get_buffer(timeout=200)  # type: ignore[attr-defined]
-        except Exception:
-            return None
-
-        try:
-            copied = BufferFactory.copy(buffer)  # type: ignore[operator]
-            device.requeue_buffer(buffer)  # type: ignore[attr-defined]
-        except Exception:
-            return None
-
     try:
-        data_bytes = bytes(copied)
-    except TypeError:
-        return None
+        async for msg in ws:
+            if isinstance(msg, str):
+                window.handle_text(msg)
+                if keyframes is not None:
+                    keyframes.handle_text(msg)
+                if framing is not None:
+                    framing.handle_text(msg)
+                if depth_link is not None:
+                    reply = depth_link.handle_text(msg)
+                    if reply is not None:
+                        await ws.send(reply)
+    except Exception:
+        pass
 
-    data = np.frombuffer(data_bytes, dtype=np.uint16)
-    if data.size % 4 != 0:
-        return None
-    data = data.reshape(-1, 4)
-    depth_raw = data[:, 2].astype(np.int32)
-    depth_m = depth_raw * z_scale + z_offset
-    depth_mm = np.clip(depth_m * 1000.0, 0, 8300).astype(np.float32)
 
-    return depth_mm
+async def _open_flow_control(
+    ws,
+    capture_fps: float = 30.0,
+    depth_link: Optional[DepthCodecNegotiation] = None,
+    framing: Optional[TypedFraming] = None,
+    keyframes: Optional[KeyframePreFilter] = None,
+) -> Tuple[CreditWindow, "asyncio.Task"]:
+    """Enable credit-based flow control (plus depth codec and framing negotiation) on an upload connection.
+    """
+    window = CreditWindow(min_interval=1.0 / capture_fps)
+    await ws.send(FLOW_CONTROL_CONFIG)
+    if depth_link is not None:
+        await ws.send(depth_link.config_message())
+    if framing is not None:
+        await ws.send(framing.config_message())
+    recv_task = asyncio.create_task(_drain_backend_messages(ws, window, depth_link, framing, keyframes))
+    return window, recv_task
 
 
- 
+def encode_jpeg(image: np.ndarray, quality: int = 80) -> Optional[bytes]:
+    """JPEG used for both the backend and the preview, so each frame is encoded once."""
+    ok, jpg = cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return jpg.tobytes() if ok else None
 
 
-def colorize_depth(depth_mm: np.ndarray) -> np.ndarray:
-    """Create a colored depth visualization from a depth map in mm."""
+def depth_preview_jpeg(depth_mm: np.ndarray) -> Optional[bytes]:
+    """Grayscale depth intensity preview (brighter is farther) as a JPEG."""
     if depth_mm.size == 0:
-        return np.zeros((1, 1, 3), dtype=np.uint8)
-
-    depth = depth_mm.copy()
-    depth[~np.isfinite(depth)] = 0
-    depth = np.clip(depth, 0, 8300)
-    if depth.max() <= 0:
-        return np.zeros((*depth.shape, 3), dtype=np.uint8)
-
-    depth_norm = (depth / depth.max() * 255.0).astype(np.uint8)
-    colored = cv2.applyColorMap(depth_norm, cv2.COLORMAP_TURBO)
-    return colored
-
-
-async def stream_gopro_only(backend_ws_url: Optional[str] = None, preview_only: bool = False):
+        return None
+    depth = np.clip(np.nan_to_num(depth_mm, nan=0.0, posinf=0.0, neginf=0.0), 0, 8300)
+    max_depth = float(depth.max())
+    if max_depth > 0:
+        depth_norm = cv2.convertScaleAbs(depth, alpha=255.0 / max_depth)
+    else:
+        depth_norm = np.zeros(depth.shape, dtype=np.uint8)
+    return encode_jpeg(depth_norm)
+
+
+async def stream_gopro_only(
+    backend_ws_url: Optional[str] = None,
+    preview_only: bool = False,
+    keyframe_scale: Optional[float] = None,
+    preview: Optional[PreviewChannel] = None,
+):
+    """Stream GoPro frames to the backend.
+
+    With ``keyframe_scale`` set, frames are checked against the backend's
+    keyframe test at that fraction of the resolution and only candidates
+    are encoded and sent. Previews go to ``preview`` at its own rate and
+    reuse the backend JPEG when the frame was sent.
+    """
     if websockets is None and not preview_only:
         raise RuntimeError("websockets package is required for live capture bridge")
+    preview = preview or PreviewChannel()
 
     global _latest_frame
     _latest_frame = None
@@ -273,19 +295,16 @@ async def stream_gopro_only(backend_ws_url: Optional[str] = None, preview_only:
         # Preview-only mode
         while not _stop:
             await asyncio.sleep(0.01)
+            if not preview.due():
+                continue
             with _latest_frame_lock:
                 frame = None if _latest_frame is None else _latest_frame.copy()
             if frame is None:
                 continue
 
-            ok_jpg, jpg = cv2.imencode(".jpg", frame)
-            if ok_jpg:
-                msg = {
-                    "type": "rgb",
-                    "jpeg_b64": base64.b64encode(jpg).decode("ascii"),
-                }
-                sys.stdout.write(json.dumps(msg) + "\n")
-                sys.stdout.flush()
+            jpg = encode_jpeg(frame)
+            if jpg is not None:
+                preview.send(jpg)
     else:
         url = backend_ws_url or get_backend_ws_url()
 
@@ -293,6 +312,11 @@ async def stream_gopro_only(backend_ws_url: Optional[str] = None, preview_only:
             await ws.send("config:use_depth_maps:0")
 
             await ws.send("config:live_stream:1")
+            keyframes = KeyframePreFilter(keyframe_scale) if keyframe_scale else None
+            window, recv_task = await _open_flow_control(ws, keyframes=keyframes)
+            last_send = 0.0
+            # Images sent so far; matches the backend's sequence numbers
+            sent_images = 0
 
             while not _stop:
                 # Yield to event loop
@@ -303,20 +327,31 @@ async def stream_gopro_only(backend_ws_url: Optional[str] = None, preview_only:
                     await asyncio.sleep(0.01)
                     continue
 
-                ok_jpg_backend, jpg_backend = cv2.imencode(
-                    ".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-                )
-                if ok_jpg_backend:
-                    await ws.send(jpg_backend.tobytes())
-
-                ok_jpg_preview, jpg_preview = cv2.imencode(".jpg", frame)
-                if ok_jpg_preview:
-                    msg = {
-                        "type": "rgb",
-                        "jpeg_b64": base64.b64encode(jpg_preview).decode("ascii"),
-                    }
-                    sys.stdout.write(json.dumps(msg) + "\n")
-                    sys.stdout.flush()
+                # Send only when the backend has granted a credit and we are
+                # not ahead of its pace; otherwise skip this frame rather than
+                # letting it queue up on the server.
+                now = time.monotonic()
+                jpg = None
+                if (
+                    now - last_send >= window.send_interval()
+                    and (keyframes is None or keyframes.is_candidate(frame))
+                    and window.try_acquire()
+                ):
+                    jpg = encode_jpeg(frame)
+                    if jpg is not None:
+                        await ws.send(jpg)
+                        if keyframes is not None:
+                            keyframes.sent(sent_images, frame)
+                        sent_images += 1
+                        last_send = now
+                    else:
+                        window.release()
+
+                if preview.due():
+                    if jpg is None:
+                        jpg = encode_jpeg(frame)
+                    if jpg is not None:
+                        preview.send(jpg)
 
                 # Throttle; ~30 fps
                 await asyncio.sleep(1.0 / 30.0)
@@ -325,6 +360,7 @@ async def stream_gopro_only(backend_ws_url: Optional[str] = None, preview_only:
                 await ws.send("done")
             except Exception:
                 pass
+            recv_task.cancel()
 
     # Cleanup GoPro
     try:
@@ -343,17 +379,34 @@ async def stream_gopro_only(backend_ws_url: Optional[str] = None, preview_only:
     cap.release()
 
 
-async def stream_gopro_helios(backend_ws_url: Optional[str] = None, preview_only: bool = False):
+async def stream_gopro_helios(
+    backend_ws_url: Optional[str] = None,
+    preview_only: bool = False,
+    full_res_depth: bool = False,
+    depth_codec: Optional[str] = None,
+    keyframe_scale: Optional[float] = None,
+    preview: Optional[PreviewChannel] = None,
+):
+    """Stream GoPro frames with Helios depth projected onto them.
+
+    Depth is projected onto the VGGT input grid (about 518x294 for 16:9
+    video), which is all the backend's solver uses; ``full_res_depth``
+    projects onto the full GoPro grid instead. Depth is sent as uint16
+    millimetres with ``depth_codec`` (lz4 if available, else png) once the
+    backend confirms it, as float32 .npy before that or with "npy".
+    With ``keyframe_scale`` set, only frames passing the backend's keyframe
+    test (checked at that fraction of the resolution) are projected and sent.
+    Previews go to ``preview`` at its own rate and reuse the backend JPEG and
+    projected depth when the frame was sent.
+    """
     if websockets is None and not preview_only:
         raise RuntimeError("websockets package is required for live capture bridge")
+    preview = preview or PreviewChannel()
 
     calib = load_calibration(CALIBRATION_FILE)
-    K_iToF = calib["K_iToF"]
-    dist_iToF = calib["dist_iToF"]
-    K_RGB = calib["K_RGB"]
-    dist_RGB = calib["dist_RGB"]
-    R = calib["R"]
-    T = calib["T"]
+    # Built for the GoPro frame size once the first frame arrives
+    projector: Optional[DepthProjector] = None
+    projector_rgb_shape = None
 
     global _latest_frame, _latest_depth_mm
     _latest_frame = None
@@ -370,52 +423,43 @@ async def stream_gopro_helios(backend_ws_url: Optional[str] = None, preview_only
         # Preview-only
         while not _stop:
             await asyncio.sleep(0.01)
+            if not preview.due():
+                continue
             with _latest_frame_lock:
                 frame = None if _latest_frame is None else _latest_frame.copy()
             if frame is None:
                 continue
 
-            depth_img = None
             with _latest_depth_lock:
                 depth_flat_mm = None if _latest_depth_mm is None else _latest_depth_mm.copy()
 
+            jpg = encode_jpeg(frame)
+            depth_jpg = None
             if depth_flat_mm is not None and depth_flat_mm.ndim == 2:
-                depth = depth_flat_mm.copy()
-                depth[~np.isfinite(depth)] = 0
-                depth = np.clip(depth, 0, 8300)
-                if depth.max() > 0:
-                    depth_norm = (depth / depth.max() * 255.0).astype(np.uint8)
-                else:
-                    depth_norm = np.zeros(depth.shape, dtype=np.uint8)
-                depth_img = depth_norm
-
-            ok_jpg, jpg = cv2.imencode(".jpg", frame)
-            depth_jpeg_b64 = None
-            if depth_img is not None:
-                ok_djpg, d_jpg = cv2.imencode(".jpg", depth_img)
-                if ok_djpg:
-                    depth_jpeg_b64 = base64.b64encode(d_jpg).decode("ascii")
-
-            if ok_jpg:
-                msg = {
-                    "type": "rgbd",
-                    "rgb_jpeg_b64": base64.b64encode(jpg).decode("ascii"),
-                }
-                if depth_jpeg_b64 is not None:
-                    msg["depth_jpeg_b64"] = depth_jpeg_b64
-                sys.stdout.write(json.dumps(msg) + "\n")
-                sys.stdout.flush()
+                depth_jpg = depth_preview_jpeg(depth_flat_mm)
+            if jpg is not None:
+                preview.send(jpg, depth_jpg, rgbd=True)
     else:
         url = backend_ws_url or get_backend_ws_url()
 
         async with websockets.connect(url) as ws:  # type: ignore[attr-defined]
             await ws.send("config:use_depth_maps:1")
             await ws.send("config:live_stream:1")
+            depth_link = None if depth_codec == "npy" else DepthCodecNegotiation(depth_codec)
+            # RGB and depth go out as one typed frame once the backend
+            # supports it, as two legacy messages until then.
+            framing = TypedFraming()
+            keyframes = KeyframePreFilter(keyframe_scale) if keyframe_scale else None
+            window, recv_task = await _open_flow_control(ws, depth_link=depth_link, framing=framing, keyframes=keyframes)
+            last_send = 0.0
+            # Images sent so far; matches the backend's sequence numbers
+            sent_images = 0
 
             while not _stop:
                 await asyncio.sleep(0.0)
                 with _latest_frame_lock:
                     frame = None if _latest_frame is None else _latest_frame.copy()
+                captured_at = time.time()
                 if frame is None:
                     await asyncio.sleep(0.01)
                     continue
@@ -426,53 +470,56 @@ async def stream_gopro_helios(backend_ws_url: Optional[str] = None, preview_only
                     await asyncio.sleep(0.01)
                     continue
 
-                depth_proj_mm = project_depth_onto_rgb(
-                    depth_flat_mm,
-                    K_iToF,
-                    dist_iToF,
-                    K_RGB,
-                    dist_RGB,
-                    R,
-                    T,
-                    frame.shape,
-                )
-
-                # Send RGB JPEG then depth .npy bytes to backend. JPEG
-                # keeps each message comfortably under the default 1 MiB
-                # frame size limit used by many WebSocket servers.
-                ok_jpg_backend, jpg_backend = cv2.imencode(
-                    ".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-                )
-                if ok_jpg_backend:
-                    await ws.send(jpg_backend.tobytes())
-
-                buf = io.BytesIO()
-                np.save(buf, depth_proj_mm.astype(np.float32))
-                await ws.send(buf.getvalue())
-
-                # Previews: RGB plus grayscale depth intensity
-                ok_jpg_preview, jpg_preview = cv2.imencode(".jpg", frame)
-                depth = depth_proj_mm.copy()
-                depth[~np.isfinite(depth)] = 0
-                depth = np.clip(depth, 0, 8300)
-                depth_jpeg_b64 = None
-                if depth.size > 0 and depth.max() > 0:
-                    depth_norm = (depth / depth.max() * 255.0).astype(np.uint8)
-                else:
-                    depth_norm = np.zeros(depth.shape, dtype=np.uint8)
-                ok_djpg, d_jpg = cv2.imencode(".jpg", depth_norm)
-                if ok_djpg:
-                    depth_jpeg_b64 = base64.b64encode(d_jpg).decode("ascii")
-
-                if ok_jpg_preview:
-                    msg = {
-                        "type": "rgbd",
-                        "rgb_jpeg_b64": base64.b64encode(jpg_preview).decode("ascii"),
-                    }
-                    if depth_jpeg_b64 is not None:
-                        msg["depth_jpeg_b64"] = depth_jpeg_b64
-                    sys.stdout.write(json.dumps(msg) + "\n")
-                    sys.stdout.flush()
+                # Project and send only when the backend has granted a credit
+                # and we are not ahead of its pace; otherwise skip this frame
+                # and preview the raw Helios depth instead.
+                now = time.monotonic()
+                depth_proj_mm = None
+                jpg = None
+                if (
+                    now - last_send >= window.send_interval()
+                    and (keyframes is None or keyframes.is_candidate(frame))
+                    and window.try_acquire()
+                ):
+                    if projector is None or projector_rgb_shape != frame.shape[:2]:
+                        projector_rgb_shape = frame.shape[:2]
+                        if full_res_depth:
+                            projector = DepthProjector(calib, frame.shape)
+                        else:
+                            projector = DepthProjector.for_vggt_grid(calib, frame.shape)
+                    depth_proj_mm = projector.project(depth_flat_mm)
+
+                    # Send RGB JPEG then the depth frame to the backend. JPEG
+                    # keeps each message comfortably under the default 1 MiB
+                    # frame size limit used by many WebSocket servers.
+                    jpg = encode_jpeg(frame)
+                    if jpg is not None:
+                        if depth_link is not None:
+                            depth_bytes = depth_link.encode(depth_proj_mm, sent_images)
+                        else:
+                            buf = io.BytesIO()
+                            np.save(buf, depth_proj_mm.astype(np.float32))
+                            depth_bytes = buf.getvalue()
+                        if framing.enabled:
+                            await ws.send(pack_frame(sent_images, jpg, depth_bytes, captured_at))
+                        else:
+                            await ws.send(jpg)
+                            await ws.send(depth_bytes)
+                        if keyframes is not None:
+                            keyframes.sent(sent_images, frame)
+                        sent_images += 1
+                        last_send = now
+                    else:
+                        window.release()
+
+                # Previews: RGB plus grayscale depth intensity, reusing what
+                # was just encoded and projected for the backend
+                if preview.due():
+                    if jpg is None:
+                        jpg = encode_jpeg(frame)
+                    depth_jpg = depth_preview_jpeg(depth_proj_mm if depth_proj_mm is not None else depth_flat_mm)
+                    if jpg is not None:
+                        preview.send(jpg, depth_jpg, rgbd=True)
 
                 # Throttle to ~30 fps
                 await asyncio.sleep(1.0 / 30.0)
@@ -481,6 +528,7 @@ async def stream_gopro_helios(backend_ws_url: Optional[str] = None, preview_only
                 await ws.send("done")
             except Exception:
                 pass
+            recv_task.cancel()
 
     # Cleanup
     try:
@@ -503,12 +551,36 @@ def main():  # pragma: no cover - entrypoint
     parser.add_argument("--mode", choices=["gopro", "gopro_helios"], required=True)
     parser.add_argument("--backend-url", type=str, default=None, help="Backend WebSocket URL (overrides BACKEND_WS_URL env)")
     parser.add_argument("--preview-only", action="store_true", help="Preview-only mode (no backend streaming)")
+    parser.add_argument("--full-res-depth", action="store_true", help="Project depth onto the full GoPro grid instead of the VGGT input grid")
+    parser.add_argument("--depth-codec", choices=("npy",) + DEPTH_CODECS, default=None, help="Depth transport codec (default: lz4 if installed, else png)")
+    parser.add_argument("--keyframe-filter", action="store_true", help="Send only frames that pass the backend's keyframe test")
+    parser.add_argument("--keyframe-scale", type=float, default=0.25, help="Resolution scale for the keyframe pre-filter (default: 0.25)")
+    parser.add_argument("--preview-format", choices=PREVIEW_FORMATS, default="binary", help="Preview encoding on stdout (default: binary)")
+    parser.add_argument("--preview-fps", type=float, default=10.0, help="Preview rate, independent of capture (0 = every frame)")
     args = parser.parse_args()
+    keyframe_scale = args.keyframe_scale if args.keyframe_filter else None
+
+    preview = PreviewChannel(args.preview_fps, args.preview_format, sys.stdout.buffer)
+    # stdout carries previews only; log output goes to stderr so it cannot
+    # corrupt the binary stream
+    sys.stdout = sys.stderr
 
     if args.mode == "gopro":
-        asyncio.run(stream_gopro_only(args.backend_url, preview_only=args.preview_only))
+        asyncio.run(stream_gopro_only(
+            args.backend_url,
+            preview_only=args.preview_only,
+            keyframe_scale=keyframe_scale,
+            preview=preview,
+        ))
     else:
-        asyncio.run(stream_gopro_helios(args.backend_url, preview_only=args.preview_only))
+        asyncio.run(stream_gopro_helios(
+            args.backend_url,
+            preview_only=args.preview_only,
+            full_res_depth=args.full_res_depth,
+            depth_codec=args.depth_codec,
+            keyframe_scale=keyframe_scale,
+            preview=preview,
+        ))
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -7,66 +7,279 @@ import time
 import asyncio
 import sys
 import io
+import json
+from typing import NamedTuple
 
 import numpy as np
 import torch
 from tqdm.auto import tqdm
-import cv2
 import matplotlib.pyplot as plt
-import open3d as o3d
 
 import vggt_slam.slam_utils as utils
 from vggt_slam.solver import Solver
+from vggt_slam.loop_closure import ImageRetrieval
+from vggt_slam.map import StaleExportError
+from vggt_slam.pointcloud_io import PLY_VERTEX_DTYPE, colors_to_uint8, ply_header
+from vggt_slam import instrumentation
+from vggt_slam.synthetic import StubImageRetrieval, SyntheticVGGT
 
 from vggt.models.vggt import VGGT
 
-from depth_projection import load_calibration, project_depth_onto_rgb, CALIBRATION_FILE
-
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, WebSocket
-from fastapi.responses import FileResponse
+from depth_projection import get_projector
+from solver_executor import IngestExecutor, SolverExecutor
+from frame_store import FrameStore, decode_image
+from pipeline import UploadPipeline
+from upload_protocol import (
+    KEYFRAME_DISPARITY_STATUS,
+    TYPED_FRAMES_CONFIG,
+    TYPED_FRAMES_STATUS,
+    format_ack,
+    format_window,
+    is_typed_frame,
+    parse_frame,
+)
+from sessions import SessionManager, SessionLimitError
+from submap_codec import SUBMAP_FORMATS, encode_submap
+from depth_codec import DEPTH_CODEC_CONFIG, DEPTH_CODEC_STATUS, available_codecs, decode_depth, depth_header, is_depth_frame
+import metrics
+from tracing import TraceBuffer
+import profiler
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, WebSocket, Query, Header
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from contextlib import asynccontextmanager
-import tempfile
 import os
 
-solver = None  
 model = None 
-accumulated_images = {}  
-accepted_sequences = set()
+# Per-client reconstruction state; each session owns its own Solver
+session_manager: SessionManager | None = None
+# Dedicated thread for all reconstruction work. Shared by every session, so
+# sessions take turns on the GPU and each solver is only touched from here.
+solver_executor: SolverExecutor | None = None
+# Pool for per-frame decode and depth projection, shared by every session.
+# Several frames are in flight at once; keyframe selection still consumes
+# them one by one in the order they were received.
+ingest_executor: IngestExecutor | None = None
+INGEST_WORKERS = int(os.environ.get("VGGT_INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
 SUBMAP_SIZE = 16
-temp_dir = "/tmp/vggt_images"
-os.makedirs(temp_dir, exist_ok=True)
+# Optional directory to spill received frames to for inspection; frames are
+# otherwise kept in memory only.
+FRAME_SPILL_DIR = os.environ.get("VGGT_FRAME_SPILL_DIR") or None
+# Session cap and optional idle expiry. Sessions stay available after their
+# uploader disconnects (for export and reconnects) until evicted.
+MAX_SESSIONS = int(os.environ.get("VGGT_MAX_SESSIONS", "4"))
+SESSION_IDLE_TTL = float(os.environ["VGGT_SESSION_IDLE_TTL"]) if os.environ.get("VGGT_SESSION_IDLE_TTL") else None
+# Session used by /process_image
+HTTP_SESSION_ID = "http"
+# Frames posted through /process_image, until they are batched
+http_frame_store = FrameStore(spill_dir=FRAME_SPILL_DIR)
+
+# Inference backend: "vggt" loads the checkpoint, "synthetic" uses a scripted
+# CPU stand-in for VGGT and the retrieval encoder (benchmarks, load tests).
+MODEL_KIND = os.environ.get("VGGT_MODEL", "vggt")
+VGGT_CHECKPOINT = os.environ.get("VGGT_CHECKPOINT", "checkpoints/model.pt")
+
+# Upload pipeline sizing. Frames queue between ingest and keyframe selection,
+# batches between keyframe selection and reconstruction. What happens when the
+# batch queue is full is set by the overflow policy (block, coalesce,
+# drop_oldest); clients can override it per session.
+FRAME_QUEUE_SIZE = int(os.environ.get("VGGT_FRAME_QUEUE_SIZE", "64"))
+BATCH_QUEUE_SIZE = int(os.environ.get("VGGT_BATCH_QUEUE_SIZE", "2"))
+OVERFLOW_POLICY = os.environ.get("VGGT_OVERFLOW_POLICY", "block")
+
+# Maximum unacknowledged image frames per flow-controlled client. Kept within
+# the frame queue so ingest never has to buffer beyond it.
+FLOW_WINDOW = min(int(os.environ.get("VGGT_FLOW_WINDOW", "8")), FRAME_QUEUE_SIZE)
+
+# Mean optical-flow displacement (pixels, at the uploaded resolution) a frame
+# needs relative to the last keyframe to be kept. Announced to clients so
+# they can skip frames that would be rejected anyway.
+KEYFRAME_MIN_DISPARITY = float(os.environ.get("VGGT_KEYFRAME_MIN_DISPARITY", "97"))
+
+# Relative change in the depth-derived global scale below which the map keeps
+# its current scale. The estimate is re-taken after every batch; applying every
+# small update would rebuild all depth submaps and invalidate their exports.
+SCALE_TOLERANCE = float(os.environ.get("VGGT_SCALE_TOLERANCE", "1e-3"))
+
+# Leading bytes of a .npy payload; used to tell depth maps apart from images
+NPY_MAGIC = b"\x93NUMPY"
+
+# Smallest change in a submap's H_world_map (max absolute element difference)
+# that is pushed to local-frame viewers after an optimization.
+TRANSFORM_TOLERANCE = float(os.environ.get("VGGT_TRANSFORM_TOLERANCE", "1e-4"))
+
+# Progressive level of detail for viewers that opt in: a preview with every
+# PREVIEW_STRIDE-th pixel per axis right after inference (0 or 1 disables it),
+# then the full submap in chunks of at most LOD_CHUNK_POINTS points, each an
+# evenly spread subset so the cloud densifies as chunks arrive.
+PREVIEW_STRIDE = int(os.environ.get("VGGT_PREVIEW_STRIDE", "4"))
+LOD_CHUNK_POINTS = int(os.environ.get("VGGT_LOD_CHUNK_POINTS", "262144"))
+
+
+class ViewerSubscription(NamedTuple):
+    session: str | None  # None = every session
+    format: str  # one of SUBMAP_FORMATS
+    local: bool  # points in submap frames plus H_world_map updates
+    lod: bool  # coarse preview first, then the full submap in chunks
+
+
+class SubmapResult(NamedTuple):
+    """The newest submap of a batch, as built on the solver thread."""
+    unique_id: str
+    submap_id: int
+    points: np.ndarray  # world frame, globally scaled
+    local_points: np.ndarray  # the same points in the submap's own frame
+    colors: np.ndarray  # uint8
+    H_world_map: np.ndarray
+    scale: float
+    transforms: dict  # submap id -> H_world_map of earlier submaps that moved
+    stride: int = 1  # > 1 for a coarse preview sent before the full submap
+
+
+# WebSocket clients receiving completed submaps
+viewer_sockets: dict[WebSocket, ViewerSubscription] = {}
+
+
+# Metrics served on /metrics. Stage timings come from instrumentation spans,
+# both the solver's own (solver.*, graph.*, map.*) and the upload pipeline's.
+METRICS_ENABLED = os.environ.get("VGGT_METRICS", "1") not in ("0", "false", "False")
+metrics_registry = metrics.Registry()
+STAGE_SECONDS = metrics_registry.histogram(
+    "vggt_stage_duration_seconds", "Time spent per pipeline stage.", ("stage",)
+)
+FRAMES_TOTAL = metrics_registry.counter(
+    "vggt_frames_total", "Image frames received on /ws/upload, by keyframe decision.", ("result",)
+)
+BYTES_RECEIVED = metrics_registry.counter(
+    "vggt_upload_bytes_total", "Bytes received on /ws/upload.", ("kind",)
+)
+BATCHES_TOTAL = metrics_registry.counter(
+    "vggt_batches_total", "Frame batches, by outcome.", ("result",)
+)
+SUBMAP_BYTES_SENT = metrics_registry.counter(
+    "vggt_submap_bytes_sent_total", "Encoded submap bytes sent to viewers and uploaders.", ("format",)
+)
+
+
+def _queue_depths() -> dict:
+    depths = {}
+    for session in session_manager.sessions() if session_manager else []:
+        if session.pipeline is not None:
+            for queue, depth in session.pipeline.queue_depths().items():
+                depths[(session.id, queue)] = depth
+    return depths
+
+
+metrics_registry.gauge(
+    "vggt_queue_depth", "Items waiting in each upload pipeline queue.", ("session", "queue"), callback=_queue_depths
+)
+metrics_registry.gauge(
+    "vggt_viewers_connected", "Connected /ws/submaps viewers.", callback=lambda: len(viewer_sockets)
+)
+metrics_registry.gauge(
+    "vggt_sessions", "Upload sessions held by the session manager.", callback=lambda: len(session_manager) if session_manager else 0
+)
+metrics_registry.gauge(
+    "vggt_submaps", "Submaps in each session's map.", ("session",),
+    callback=lambda: {(s.id,): s.solver.map.get_num_submaps() for s in (session_manager.sessions() if session_manager else [])},
+)
+
+if METRICS_ENABLED:
+    instrumentation.add_observer(lambda name, start, duration: STAGE_SECONDS.observe(duration, stage=name))
+
+# Recent spans kept for /debug/trace, as a number of events; 0 (the default)
+# disables tracing so spans only pay for the metrics observer.
+TRACE_EVENTS = int(os.environ.get("VGGT_TRACE_EVENTS", "0"))
+trace_buffer = TraceBuffer(TRACE_EVENTS) if TRACE_EVENTS > 0 else None
+if trace_buffer is not None:
+    instrumentation.add_observer(trace_buffer)
 
-# WebSocket clients receiving completed submap PLYs
-viewer_sockets: set[WebSocket] = set()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global solver, model
+    global model, solver_executor, ingest_executor, session_manager
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"Using device: {device}")
 
-    solver = Solver(
-        init_conf_threshold=25.0,
-        use_point_map=False,
-        use_sim3=True,
-        gradio_mode=False,
-        vis_stride = 1,
-        vis_point_size = 0.003,
-        vis_mode=False
-    )
-
-   
-
-    model = VGGT()
-    model.load_state_dict(torch.load("checkpoints/model.pt"))
+    if MODEL_KIND not in ("vggt", "synthetic"):
+        raise ValueError(f"Unknown VGGT_MODEL {MODEL_KIND!r}, expected 'vggt' or 'synthetic'")
+    print(f"Using model: {MODEL_KIND}")
+
+    # Loaded once and shared by every session's solver
+    image_retrieval = StubImageRetrieval() if MODEL_KIND == "synthetic" else ImageRetrieval()
+
+    def make_solver():
+        return Solver(
+            init_conf_threshold=25.0,
+            use_point_map=False,
+            use_sim3=True,
+            gradio_mode=False,
+            vis_stride = 1,
+            vis_point_size = 0.003,
+            vis_mode=False,
+            image_retrieval=image_retrieval,
+        )
+
+    session_manager = SessionManager(make_solver, max_sessions=MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL)
+
+    if MODEL_KIND == "synthetic":
+        model = SyntheticVGGT()
+    else:
+        model = VGGT()
+        model.load_state_dict(torch.load(VGGT_CHECKPOINT))
 
     model.eval()
     model = model.to(device)
-    yield
+
+    solver_executor = SolverExecutor()
+    ingest_executor = IngestExecutor(max_workers=INGEST_WORKERS)
+    try:
+        yield
+    finally:
+        solver_executor.shutdown(wait=False)
+        ingest_executor.shutdown(wait=False)
 
 app = FastAPI(lifespan=lifespan)
 
 
+def decode_upload_image(data_bytes: bytes):
+    """Ingest worker: decode one uploaded image; returns ``(img, decode_ms)``."""
+    t0 = time.perf_counter()
+    img = decode_image(data_bytes)
+    decode_s = time.perf_counter() - t0
+    instrumentation.record("upload.decode", t0, decode_s)
+    return img, decode_s * 1000.0
+
+
+def check_disparity(flow_tracker, img):
+    """Keyframe check for one frame; returns ``(enough_disparity, keyframe_ms)``.
+
+    The tracker keeps the previous keyframe, so calls for one session must
+    not overlap and must come in frame order.
+    """
+    t0 = time.perf_counter()
+    enough_disparity = flow_tracker.compute_disparity(img, KEYFRAME_MIN_DISPARITY, False)
+    keyframe_s = time.perf_counter() - t0
+    instrumentation.record("upload.keyframe", t0, keyframe_s)
+    return enough_disparity, keyframe_s * 1000.0
+
+
+def decode_upload_depth(data_bytes: bytes, rgb_shape=None) -> np.ndarray:
+    """Ingest worker: decode a depth payload, projecting it onto the VGGT grid
+    of an ``rgb_shape`` image when given (raw sensor depth)."""
+    t0 = time.perf_counter()
+    if is_depth_frame(data_bytes):
+        _, depth_arr = decode_depth(data_bytes)
+    else:
+        depth_arr = np.load(io.BytesIO(data_bytes))
+    if rgb_shape is not None:
+        # Straight onto the VGGT input grid, which is all the solver uses;
+        # calibration and rays are shared by every session.
+        depth_arr = get_projector(rgb_shape, vggt=True).project(depth_arr)
+    instrumentation.record("upload.depth", t0, time.perf_counter() - t0)
+    return depth_arr
+
+
 async def send_keepalive(websocket: WebSocket):
     """Send periodic ping messages to keep WebSocket connection alive during processing"""
     try:
@@ -77,35 +290,187 @@ async def send_keepalive(websocket: WebSocket):
         pass
 
 
-async def broadcast_ply_to_viewers(ply_data: bytes, unique_id: str) -> None:
-    """Send a completed submap PLY to all connected viewer WebSockets.
-
-    Uses the same filename + binary protocol as the uploader connection.
+class EncodedSubmap:
+    """A finished submap, encoded at most once per wire format and frame."""
+
+    def __init__(self, result: SubmapResult):
+        self.result = result
+        self.unique_id = result.unique_id
+        self.is_preview = result.stride > 1
+        self._encoded: dict[tuple[str, bool], bytes] = {}
+        self._chunks: dict[tuple[str, bool], list[bytes]] = {}
+
+    async def get(self, fmt: str, local: bool = False) -> bytes:
+        key = (fmt, local)
+        if key not in self._encoded:
+            points = self.result.local_points if local else self.result.points
+            self._encoded[key] = await asyncio.to_thread(self._encode, points, self.result.colors, fmt)
+        return self._encoded[key]
+
+    async def get_chunks(self, fmt: str, local: bool = False) -> list[bytes]:
+        """The submap split into chunks of evenly spread points."""
+        key = (fmt, local)
+        if key not in self._chunks:
+            self._chunks[key] = await asyncio.to_thread(self._encode_chunks, fmt, local)
+        return self._chunks[key]
+
+    @staticmethod
+    def _encode(points, colors, fmt: str) -> bytes:
+        with instrumentation.span("export.serialize"):
+            return encode_submap(points, colors, fmt)
+
+    def _encode_chunks(self, fmt: str, local: bool) -> list[bytes]:
+        points = self.result.local_points if local else self.result.points
+        n = points.shape[0]
+        count = max(1, -(-n // LOD_CHUNK_POINTS))
+        if count == 1:
+            return [self._encode(points, self.result.colors, fmt)]
+        # Chunk i takes every count-th point of a fixed shuffle, so every
+        # chunk covers the whole submap at a lower density.
+        order = np.random.default_rng(0).permutation(n)
+        return [
+            self._encode(points[idx], self.result.colors[idx], fmt)
+            for idx in (np.sort(order[i::count]) for i in range(count))
+        ]
+
+    def header(self, session_id: str | None) -> str:
+        """``submap:`` message that precedes a local-frame submap.
+
+        A viewer maps local points to the world as
+        ``scale * dehomogenize(H_world_map @ [x, y, z, 1])``.
+        """
+        return "submap:" + json.dumps({
+            "id": self.unique_id,
+            "submap": self.result.submap_id,
+            "session": session_id,
+            "H_world_map": self.result.H_world_map.tolist(),
+            "scale": self.result.scale,
+        })
+
+
+def _wants_session(sub: ViewerSubscription, session_id: str | None) -> bool:
+    return sub.session is None or sub.session == session_id
+
+
+async def broadcast_transforms_to_viewers(transforms: dict, scale: float, session_id: str | None) -> None:
+    """Push moved submap homographies (and the global scale) to local-frame viewers.
+
+    A loop closure costs one small ``transforms:`` message instead of
+    re-sending the points of every submap it moved.
     """
     if not viewer_sockets:
         return
 
+    msg = "transforms:" + json.dumps({
+        "session": session_id,
+        "scale": scale,
+        "H_world_map": {str(k): np.asarray(H).tolist() for k, H in transforms.items()},
+    })
     dead: list[WebSocket] = []
-    for ws in list(viewer_sockets):
+    for ws, sub in list(viewer_sockets.items()):
+        if not sub.local or not _wants_session(sub, session_id):
+            continue
         try:
-            await ws.send_text(f"filename:{unique_id}")
-            await ws.send_bytes(ply_data)
+            await ws.send_text(msg)
         except Exception:
             dead.append(ws)
 
     for ws in dead:
+        viewer_sockets.pop(ws, None)
+
+
+async def broadcast_submap_to_viewers(submap: EncodedSubmap, session_id: str | None = None) -> None:
+    """Send a completed submap to all connected viewer WebSockets.
+
+    Uses the same filename + binary protocol as the uploader connection,
+    in each viewer's negotiated format. Viewers that follow a single
+    session only receive that session's submaps. Local-frame viewers get
+    a ``submap:`` header with the submap's transform first.
+
+    Level-of-detail viewers get previews as ``preview:<json>`` + bytes and
+    the full submap as a series of ``chunk:<json>`` + bytes (same id), where
+    the first chunk replaces the preview and later ones add to it. Other
+    viewers never see previews.
+    """
+    if not viewer_sockets:
+        return
+
+    dead: list[WebSocket] = []
+    for ws, sub in list(viewer_sockets.items()):
+        if not _wants_session(sub, session_id):
+            continue
+        if submap.is_preview and not sub.lod:
+            continue
+        if sub.lod and not submap.is_preview:
+            payloads = await submap.get_chunks(sub.format, sub.local)
+        else:
+            payloads = [await submap.get(sub.format, sub.local)]
         try:
-            viewer_sockets.discard(ws)
+            if sub.local:
+                await ws.send_text(submap.header(session_id))
+            for index, data in enumerate(payloads):
+                if submap.is_preview:
+                    await ws.send_text("preview:" + json.dumps({"id": submap.unique_id, "stride": submap.result.stride}))
+                elif sub.lod:
+                    await ws.send_text("chunk:" + json.dumps({"id": submap.unique_id, "index": index, "count": len(payloads)}))
+                else:
+                    await ws.send_text(f"filename:{submap.unique_id}")
+                await ws.send_bytes(data)
+                SUBMAP_BYTES_SENT.inc(len(data), format=sub.format)
         except Exception:
-            pass
+            dead.append(ws)
+
+    for ws in dead:
+        viewer_sockets.pop(ws, None)
+
+
+async def send_submap_result(websocket: WebSocket, submap: EncodedSubmap, return_ply: bool, fmt: str, session_id: str) -> None:
+    """Deliver a finished submap to viewers and, optionally, the uploader."""
+    # Broadcast to any connected viewers
+    with instrumentation.span("export.broadcast"):
+        await broadcast_submap_to_viewers(submap, session_id)
+
+    if return_ply:
+        # Send filename first, then the binary data back
+        # to the uploader connection.
+        data = await submap.get(fmt)
+        await websocket.send_text(f"filename:{submap.unique_id}")
+        await websocket.send_bytes(data)
+        SUBMAP_BYTES_SENT.inc(len(data), format=fmt)
+        print(f"Sent {fmt} submap to uploader: submap_{submap.unique_id} ({len(data)} bytes)")
+    else:
+        print(f"Processed batch {submap.unique_id}, submap returned only to viewers (live stream mode)")
 
 
 @app.websocket("/ws/submaps")
-async def websocket_submaps(websocket: WebSocket):
-    """Viewer WebSocket for receiving completed submap PLYs.
+async def websocket_submaps(
+    websocket: WebSocket,
+    session: str | None = Query(None),
+    format: str = Query("ply"),
+    frames: str = Query("world"),
+    lod: bool = Query(False),
+):
+    """Viewer WebSocket for receiving completed submaps.
+
+    ``?session=<id>`` restricts the stream to one upload session;
+    ``?format=qpc`` selects the compact quantized format (see submap_codec);
+    ``?frames=local`` sends points in submap frames, each preceded by a
+    ``submap:`` header, and pushes ``transforms:`` updates when the pose
+    graph moves earlier submaps; ``?lod=1`` streams a coarse preview of
+    each submap right after inference, then the full submap in chunks.
     """
     await websocket.accept()
-    viewer_sockets.add(websocket)
+    if format not in SUBMAP_FORMATS:
+        await websocket.send_text(f"error:Unknown submap format {format}, using ply")
+        format = "ply"
+    elif format != "ply":
+        await websocket.send_text(f"status:format:{format}")
+    local = frames == "local"
+    if local:
+        await websocket.send_text("status:frames:local")
+    if lod:
+        await websocket.send_text("status:lod:1")
+    viewer_sockets[websocket] = ViewerSubscription(session, format, local, lod)
     try:
         # Keep the connection open
         while True:
@@ -113,122 +478,339 @@ async def websocket_submaps(websocket: WebSocket):
     except Exception:
         pass
     finally:
-        try:
-            viewer_sockets.discard(websocket)
-        except Exception:
-            pass
+        viewer_sockets.pop(websocket, None)
 
 
 @app.post("/process_image")
 async def process_image(file: UploadFile = File(...), sequence: int = Form(0)):
-    os.makedirs(temp_dir, exist_ok=True)
-    # Save uploaded image with consistent naming
-    image_path = os.path.join(temp_dir, f"frame_{sequence:06d}.png")
-    with open(image_path, 'wb') as f:
-        f.write(await file.read())
-    
-    accumulated_images[sequence] = image_path 
+    data = await file.read()
+    img = decode_image(data)
+    if img is None:
+        raise HTTPException(status_code=400, detail=f"Could not decode image {sequence}")
+
+    try:
+        session = session_manager.acquire(HTTP_SESSION_ID)
+    except SessionLimitError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    session_manager.release(session)
+    solver = session.solver
+
+    http_frame_store.add_image(sequence, img, data)
     # Check if we have at least SUBMAP_SIZE images
-    if len(accumulated_images) >= SUBMAP_SIZE:
+    if len(http_frame_store) >= SUBMAP_SIZE:
         # Sort by sequence
-        sorted_sequences = sorted(accumulated_images.keys())
         batch = []
-        for seq in sorted_sequences:
-            img_path = accumulated_images[seq]
-            img = cv2.imread(img_path)
-            enough_disparity = solver.flow_tracker.compute_disparity(img, 50, False)
+        for seq in http_frame_store.sequences():
+            # Every frame looked at is either in the batch or rejected, so it
+            # leaves the store; it never holds more than SUBMAP_SIZE frames.
+            frame = http_frame_store.pop(seq)
+            enough_disparity = solver.flow_tracker.compute_disparity(frame.image, 50, False)
             if enough_disparity:
-                print(f"{image_path} {sequence} Added to batch")
-                batch.append(img_path)
+                print(f"Frame {seq} Added to batch")
+                batch.append(frame)
                 if len(batch) == SUBMAP_SIZE + 1:
                     break
     
     return {"message": f"Image {sequence} received. Waiting for more."}
 
 @app.websocket("/ws/upload")
-async def websocket_upload(websocket: WebSocket):
+async def websocket_upload(websocket: WebSocket, session: str | None = Query(None)):
+    """Upload WebSocket; ``?session=<id>`` resumes an existing session."""
     await websocket.accept()
+    try:
+        upload_session = session_manager.acquire(session)
+    except SessionLimitError as e:
+        print(f"Rejecting upload: {e}")
+        await websocket.send_text(f"error:{e}")
+        await websocket.close(code=1013)
+        return
+    solver = upload_session.solver
+    # Tell the client which session to resume or export
+    await websocket.send_text(f"status:session:{upload_session.id}")
+    await websocket.send_text(f"{KEYFRAME_DISPARITY_STATUS}{KEYFRAME_MIN_DISPARITY:g}")
+
     sequence_counter = 0
     last_receive_time = time.time()
-    processing_task = None
-    pending_batch = None 
-    keepalive_task = None  
+    frame_store = FrameStore(spill_dir=FRAME_SPILL_DIR)
+    pipeline = UploadPipeline(
+        frame_queue_size=FRAME_QUEUE_SIZE,
+        batch_queue_size=BATCH_QUEUE_SIZE,
+        overflow_policy=OVERFLOW_POLICY,
+        max_coalesced_frames=2 * SUBMAP_SIZE + 1,
+    )
+    upload_session.pipeline = pipeline
     use_captured_depth_session = False
     depth_is_raw = False
     return_ply = True
-    expecting_depth = False
+    submap_format = "ply"
+    # Global scale last sent to local-frame viewers
+    viewer_scale = None
+    flow_control = False
     last_image_seq = None
-    calib = None
 
-    try:
-        while True:
-            # Check if there's an ongoing processing task
-            if processing_task and processing_task.done():
-                # Processing is complete, optionally send results
-                try:
-                    ply_file, unique_id = processing_task.result()
-
-                    # Cancel keepalive task if it exists
-                    if 'keepalive_task' in locals() and keepalive_task and not keepalive_task.done():
-                        keepalive_task.cancel()
-                        try:
-                            await keepalive_task
-                        except asyncio.CancelledError:
-                            pass
-
-
-                    with open(ply_file, 'rb') as f:
-                        ply_data = f.read()
-
-                    # Broadcast to any connected viewers 
-                    await broadcast_ply_to_viewers(ply_data, unique_id)
-
-                    if return_ply:
-                        # Send filename first, then the binary data back
-                        # to the uploader connection.
-                        await websocket.send_text(f"filename:{unique_id}")
-                        await websocket.send_bytes(ply_data)
-                        print(f"Sent PLY file to uploader: submap_{unique_id}.ply")
-                    else:
-                        print(f"Processed batch {unique_id}, PLY returned only to viewers (live stream mode)")
+    async def notify(text: str) -> None:
+        """Best-effort status message to the uploader."""
+        try:
+            await websocket.send_text(text)
+        except Exception:
+            pass
 
-                    # Remove temporary PLY file after use
+    # Depth that arrived (as a typed frame) before its image was decided
+    pending_depth: dict[int, np.ndarray] = {}
+    # Decodes still in flight on the ingest pool, by sequence number, so depth
+    # can be projected for its image's shape without waiting for keyframe
+    # selection to reach it
+    image_jobs: dict[int, asyncio.Future] = {}
+    rgb_shape = None
+
+    def store_depth(seq: int, depth_arr: np.ndarray, newest_seq: int | None) -> None:
+        frame = frame_store.get(seq)
+        if frame is None:
+            if newest_seq is None or seq > newest_seq:
+                pending_depth[seq] = depth_arr
+            # Otherwise the image was rejected by keyframe selection and
+            # its depth is not needed
+            return
+        frame_store.set_depth(seq, depth_arr)
+        print(f"Stored depth map for frame {seq}, shape={depth_arr.shape}")
+
+    def take_batch(newest_seq):
+        """Cut the next SUBMAP_SIZE + 1 frame batch from the store, if ready."""
+        seqs = frame_store.sequences()
+        if len(seqs) < SUBMAP_SIZE + 1:
+            return None
+        used_seqs = seqs[:SUBMAP_SIZE + 1]
+        # With captured depth, hold the batch until the last frame's depth
+        # arrives (or a newer image shows it is not coming).
+        if use_captured_depth_session and newest_seq == used_seqs[-1] and frame_store.get(used_seqs[-1]).depth_mm is None:
+            return None
+
+        batch = [frame_store.get(seq) for seq in used_seqs]
+        print(f"Batch complete with {len(batch)} images: {used_seqs}")
+        # Remove all images that were used in this batch EXCEPT the last one (overlap).
+        # The batch keeps its own references to the frame data.
+        for seq in used_seqs[:-1]:
+            frame_store.pop(seq)
+        return batch
+
+    async def enqueue_batch(batch) -> None:
+        lost = await pipeline.batch_queue.put(batch)
+        if lost is not None:
+            # Never lose frames silently: report exactly which were dropped
+            seqs = ",".join(str(frame.seq) for frame in lost)
+            print(f"Batch queue full, dropped a batch; lost frames [{seqs}]")
+            BATCHES_TOTAL.inc(result="dropped")
+            await notify(f"status:dropped_batch:{seqs}")
+        print(f"Queued batch for processing (queue depths: {pipeline.queue_depths()})")
+
+    async def ack_frame(seq: int, accepted: bool, stage_ms: dict) -> None:
+        if not flow_control:
+            return
+        if pipeline.last_batch_ms is not None:
+            stage_ms["last_batch"] = pipeline.last_batch_ms
+        await notify(format_ack(seq, accepted, stage_ms, pipeline.queue_depths()))
+
+    async def keyframe_stage() -> None:
+        newest_seq = None
+        try:
+            while True:
+                item = await pipeline.frame_queue.get()
+                if item is None:
+                    break
+                kind, seq, payload, timings = item
+                if kind == "depth":
+                    # Decoded and projected on the ingest pool; awaited here
+                    # so depth is stored in the same order it was received
                     try:
-                        os.remove(ply_file)
-                        print(f"Deleted temporary PLY file: {ply_file}")
-                    except OSError as e:
-                        print(f"Failed to delete temporary PLY file {ply_file}: {e}")
+                        store_depth(seq, await payload, newest_seq)
+                    except Exception as e:
+                        print(f"Failed to handle depth map for frame {seq}: {e}")
+                    enough_disparity = None
+                else:
+                    job, encoded, timestamp = payload
+                    # Frames decode in parallel, but the tracker is stateful,
+                    # so they are committed to it strictly in arrival order
+                    timings["queue"] = (time.perf_counter() - timings.pop("queued_at")) * 1000.0
+                    img, decode_ms = await job
+                    image_jobs.pop(seq, None)
+                    timings["decode"] = decode_ms
+                    if img is None:
+                        print(f"Warning: Could not decode image {seq}")
+                        FRAMES_TOTAL.inc(result="undecodable")
+                        # Return the credit; the frame never enters the pipeline
+                        await ack_frame(seq, False, timings)
+                        continue
+                    print(f"Received image {seq}, shape={img.shape}")
+                    newest_seq = seq if newest_seq is None else max(newest_seq, seq)
+                    # Run disparity check ONCE when the frame arrives. Off the
+                    # event loop so the socket keeps being read meanwhile.
+                    enough_disparity, timings["keyframe"] = await ingest_executor.run(
+                        check_disparity, solver.flow_tracker, img
+                    )
+                    print(f"Image {seq}: initial disparity check = {enough_disparity}")
+                    depth_arr = pending_depth.pop(seq, None)
+                    if enough_disparity:
+                        frame_store.add_image(seq, img, encoded, timestamp)
+                        FRAMES_TOTAL.inc(result="accepted")
+                        if depth_arr is not None:
+                            store_depth(seq, depth_arr, newest_seq)
+                    else:
+                        print(f"Image {seq} rejected due to low disparity")
+                        FRAMES_TOTAL.inc(result="rejected")
+                    # Depth whose image never showed up within the frame window
+                    for stale in [s for s in pending_depth if s < newest_seq - FRAME_QUEUE_SIZE]:
+                        del pending_depth[stale]
+
+                with instrumentation.span("upload.batch_build"):
+                    batch = take_batch(newest_seq)
+                if batch is not None:
+                    await enqueue_batch(batch)
+
+                # Acknowledge only once any resulting batch is queued, so a
+                # blocked batch queue withholds credits from the client.
+                if enough_disparity is not None:
+                    await ack_frame(seq, enough_disparity, timings)
+
+            # Process any remaining accepted images as a final partial batch
+            final_batch = [frame_store.get(seq) for seq in frame_store.sequences()]
+            frame_store.clear()
+            if len(final_batch) > 0:
+                print(f"Queueing final partial batch with {len(final_batch)} images")
+                await enqueue_batch(final_batch)
+        except Exception:
+            print("Error in keyframe stage:")
+            print(traceback.format_exc())
+        finally:
+            await pipeline.batch_queue.close()
 
-                    processing_task = None
+    async def reconstruct_stage() -> None:
+        loop = asyncio.get_running_loop()
 
-                    # Check if there's a pending batch to process now
-                    if pending_batch is not None:
-                        processing_task = asyncio.create_task(process_batch_async(pending_batch, solver, model, accumulated_images))
-                        pending_batch = None
-                        print("Started processing pending batch")
-                        keepalive_task = asyncio.create_task(send_keepalive(websocket))
+        def _queue_preview(preview):
+            # Called on the solver thread; the preview is queued
+            # ahead of the full result so viewers see it first.
+            asyncio.run_coroutine_threadsafe(pipeline.export_queue.put(preview), loop)
 
+        try:
+            while True:
+                batch = await pipeline.batch_queue.get()
+                if batch is None:
+                    break
+                pipeline.reconstructing = True
+                t0 = time.perf_counter()
+                wants_preview = any(sub.lod and _wants_session(sub, upload_session.id) for sub in viewer_sockets.values())
+                on_preview = _queue_preview if wants_preview else None
+                try:
+                    # VGGT inference, then alignment/graph, on the solver thread
+                    result = await solver_executor.run(new_process_submap, batch, solver, model, on_preview)
+                    pipeline.last_batch_ms = (time.perf_counter() - t0) * 1000.0
+                    instrumentation.record("upload.reconstruct", t0, pipeline.last_batch_ms / 1000.0)
+                    BATCHES_TOTAL.inc(result="reconstructed")
                 except Exception as e:
-                    print("Error sending processed results:")
+                    BATCHES_TOTAL.inc(result="failed")
+                    print("Error in background processing:")
                     print(traceback.format_exc())
                     if return_ply:
-                        await websocket.send_text(f"error:{str(e)}")
-                    processing_task = None
+                        await notify(f"error:{str(e)}")
+                    continue
+                finally:
+                    pipeline.reconstructing = False
+                await pipeline.export_queue.put(result)
+        finally:
+            await pipeline.export_queue.put(None)
+
+    async def export_stage() -> None:
+        nonlocal viewer_scale
+        while True:
+            result = await pipeline.export_queue.get()
+            if result is None:
+                break
+            pipeline.exporting = True
+            try:
+                if result.stride > 1:
+                    await broadcast_submap_to_viewers(EncodedSubmap(result), upload_session.id)
+                    continue
+                with instrumentation.span("export.send"):
+                    # Move earlier submaps before showing the new one
+                    if result.transforms or result.scale != viewer_scale:
+                        await broadcast_transforms_to_viewers(result.transforms, result.scale, upload_session.id)
+                        viewer_scale = result.scale
+                    await send_submap_result(websocket, EncodedSubmap(result), return_ply, submap_format, upload_session.id)
+            except Exception:
+                print("Error sending processed results:")
+                print(traceback.format_exc())
+            finally:
+                pipeline.exporting = False
+
+    async def ingest_image(seq: int, data_bytes: bytes, timestamp: float | None = None) -> None:
+        nonlocal last_image_seq
+        BYTES_RECEIVED.inc(len(data_bytes), kind="image")
+        # Decoding starts right away on the ingest pool; the queue holds the
+        # pending result, so up to FRAME_QUEUE_SIZE frames can be in flight.
+        job = ingest_executor.submit(decode_upload_image, data_bytes)
+        image_jobs[seq] = job
+        # Blocks when keyframe selection falls behind, which stops reading
+        # from the socket and pushes backpressure to the client.
+        timings = {"queued_at": time.perf_counter()}
+        await pipeline.frame_queue.put(("image", seq, (job, data_bytes, timestamp), timings))
+        last_image_seq = seq
+
+    async def prepare_depth(seq: int, data_bytes: bytes) -> np.ndarray:
+        nonlocal rgb_shape
+        shape = None
+        if depth_is_raw:
+            # Projection needs the image size: from the image itself when it
+            # is still being decoded or kept, else from the session's last one
+            job = image_jobs.get(seq)
+            frame = frame_store.get(seq)
+            if job is not None:
+                img, _ = await job
+                if img is not None:
+                    rgb_shape = img.shape[:2]
+            elif frame is not None:
+                rgb_shape = frame.image.shape[:2]
+            if rgb_shape is None:
+                raise ValueError("raw depth arrived before any image of this session")
+            shape = rgb_shape
+        return await ingest_executor.run(decode_upload_depth, data_bytes, shape)
+
+    async def ingest_depth(seq: int | None, data_bytes: bytes) -> None:
+        if not use_captured_depth_session or seq is None:
+            print("Ignoring depth map: session is not using captured depth")
+            return
+        BYTES_RECEIVED.inc(len(data_bytes), kind="depth")
+        job = asyncio.ensure_future(prepare_depth(seq, data_bytes))
+        await pipeline.frame_queue.put(("depth", seq, job, None))
+
+    stage_tasks = [
+        asyncio.create_task(keyframe_stage()),
+        asyncio.create_task(reconstruct_stage()),
+        asyncio.create_task(export_stage()),
+    ]
+    # Keep the connection alive while batches are being reconstructed
+    keepalive_task = asyncio.create_task(send_keepalive(websocket))
 
+    try:
+        while True:
+            if stage_tasks[0].done():
+                print("Keyframe stage stopped - closing connection")
+                break
             try:
-                if processing_task is None:
-                    message = await asyncio.wait_for(websocket.receive(), timeout=5.0)
-                    last_receive_time = time.time()
-                else:
-                    message = await websocket.receive()
+                message = await asyncio.wait_for(websocket.receive(), timeout=5.0)
             except asyncio.TimeoutError:
-                if time.time() - last_receive_time > 30.0:
+                if pipeline.is_idle() and time.time() - last_receive_time > 30.0:
                     print("WebSocket timeout - closing connection")
                     break
                 continue
             except Exception:
                 print("WebSocket connection closed by client or no more data")
                 break
+            last_receive_time = time.time()
+            session_manager.touch(upload_session)
+
+            if message.get("type") == "websocket.disconnect":
+                print("WebSocket connection closed by client")
+                break
 
             # Handle text vs binary messages
             data_text = message.get("text") if isinstance(message, dict) else None
@@ -261,6 +843,46 @@ async def websocket_upload(websocket: WebSocket):
                     return_ply = not (flag.strip() in ("1", "true", "True"))
                     print(f"Return PLY over WebSocket: {return_ply}")
                     continue
+                if data_text.startswith("config:flow_control:"):
+                    flag = data_text.split(":")[-1]
+                    flow_control = flag.strip() in ("1", "true", "True")
+                    if flow_control:
+                        await notify(format_window(FLOW_WINDOW))
+                    print(f"Credit-based flow control for this session: {flow_control}")
+                    continue
+                if data_text.startswith("config:submap_format:"):
+                    fmt = data_text.split(":")[-1].strip()
+                    if fmt in SUBMAP_FORMATS:
+                        submap_format = fmt
+                        await notify(f"status:format:{fmt}")
+                        print(f"Submap format for this session: {fmt}")
+                    else:
+                        await notify(f"error:Unknown submap format {fmt}, expected one of {SUBMAP_FORMATS}")
+                    continue
+                if data_text == TYPED_FRAMES_CONFIG:
+                    # Typed frames are recognised by their magic either way;
+                    # this tells the client it may use them.
+                    await notify(TYPED_FRAMES_STATUS)
+                    print("Typed binary frames enabled for this session")
+                    continue
+                if data_text.startswith(DEPTH_CODEC_CONFIG):
+                    codec = data_text[len(DEPTH_CODEC_CONFIG):].strip()
+                    if codec in available_codecs():
+                        # Encoded depth frames describe themselves; this only
+                        # confirms that the server can decode them.
+                        await notify(f"{DEPTH_CODEC_STATUS}{codec}")
+                        print(f"Depth codec for this session: {codec}")
+                    else:
+                        await notify(f"error:Unsupported depth codec {codec}, expected one of {available_codecs()}")
+                    continue
+                if data_text.startswith("config:overflow_policy:"):
+                    policy = data_text.split(":")[-1].strip()
+                    try:
+                        pipeline.set_overflow_policy(policy)
+                        print(f"Batch overflow policy for this session: {policy}")
+                    except ValueError as e:
+                        await notify(f"error:{e}")
+                    continue
                 # Unknown text message; ignore but keep connection alive
                 print(f"Ignoring text message on WebSocket: {data_text}")
                 continue
@@ -269,226 +891,61 @@ async def websocket_upload(websocket: WebSocket):
                 # Nothing useful received
                 continue
 
-            if use_captured_depth_session and expecting_depth and last_image_seq is not None:
-                depth_path = os.path.join(temp_dir, f"frame_{last_image_seq:06d}_depth_proj_mm.npy")
+            if is_typed_frame(data_bytes):
                 try:
-                    if depth_is_raw:
-                        # Load raw depth from NPY bytes
-                        depth_raw = np.load(io.BytesIO(data_bytes))
-
-                        # Load corresponding RGB frame to get target shape
-                        rgb_path = os.path.join(temp_dir, f"frame_{last_image_seq:06d}.png")
-                        rgb_img = cv2.imread(rgb_path)
-                        if rgb_img is None:
-                            raise RuntimeError(f"Could not read RGB image for projection: {rgb_path}")
-
-                        # Load calibration once
-                        if calib is None:
-                            calib = load_calibration(CALIBRATION_FILE)
-
-                        depth_proj_mm = project_depth_onto_rgb(
-                            depth_raw,
-                            calib["K_iToF"],
-                            calib["dist_iToF"],
-                            calib["K_RGB"],
-                            calib["dist_RGB"],
-                            calib["R"],
-                            calib["T"],
-                            rgb_img.shape,
-                        )
-
-                        np.save(depth_path, depth_proj_mm.astype(np.float32))
-                        print(f"Projected and saved depth map for frame {last_image_seq}: {depth_path}")
-                    else:
-                        # Already projected depth; save bytes directly
-                        with open(depth_path, 'wb') as f:
-                            f.write(data_bytes)
-                            f.flush()
-                            os.fsync(f.fileno())
-                        print(f"Saved depth map for frame {last_image_seq}: {depth_path}")
-                except Exception as e:
-                    print(f"Failed to handle depth map for frame {last_image_seq}: {e}")
-                expecting_depth = False
-                continue
-
-            # Otherwise, treat this binary payload as an RGB image frame.
-            image_path = os.path.join(temp_dir, f"frame_{sequence_counter:06d}.png") 
-            with open(image_path, 'wb') as f:
-                f.write(data_bytes)
-                f.flush() 
-                os.fsync(f.fileno()) 
-
-            # Verify the image can be read and check its properties
-            if os.path.exists(image_path) and os.path.getsize(image_path) > 0:
-                test_img = cv2.imread(image_path)
-                if test_img is not None:
-                    print(f"Saved image {sequence_counter}: {image_path}, shape={test_img.shape}")
-                    # Run disparity check ONCE when the frame arrives
-                    enough_disparity = solver.flow_tracker.compute_disparity(test_img, 97, False)
-                    print(f"Image {sequence_counter}: initial disparity check = {enough_disparity}")
-                    if enough_disparity:
-                        accumulated_images[sequence_counter] = image_path
-                        accepted_sequences.add(sequence_counter)
-                        print(f"Added image {sequence_counter} to accumulated_images and accepted_sequences")
-                        if use_captured_depth_session:
-                            last_image_seq = sequence_counter
-                            expecting_depth = True
-                    else:
-                        print(f"Image {sequence_counter} rejected due to low disparity")
-                else:
-                    print(f"Warning: Could not read saved image {sequence_counter}")
+                    frame = parse_frame(data_bytes)
+                except ValueError as e:
+                    print(f"Ignoring malformed frame: {e}")
                     continue
+                # Sequence numbers come from the client; later legacy
+                # images continue after the highest one seen.
+                sequence_counter = max(sequence_counter, frame.seq + 1)
+                if frame.image is not None:
+                    await ingest_image(frame.seq, frame.image, frame.timestamp or None)
+                if frame.depth is not None:
+                    await ingest_depth(frame.seq, frame.depth)
+                continue
 
-            # Build batches only from frames that have already passed disparity once
-            if len(accepted_sequences) >= SUBMAP_SIZE + 1:
-                print(f"Have {len(accepted_sequences)} accepted images, attempting to build batch...")
-                sorted_accepted = sorted(accepted_sequences)
-                batch = []
-                used_seqs = []
-
-                for seq in sorted_accepted:
-                    img_path = accumulated_images.get(seq)
-                    if img_path is None:
+            if data_bytes.startswith(NPY_MAGIC) or is_depth_frame(data_bytes):
+                # Depth map: encoded frames name their image, .npy payloads
+                # belong to the most recent one.
+                depth_seq = last_image_seq
+                if is_depth_frame(data_bytes):
+                    try:
+                        _, depth_seq, _ = depth_header(data_bytes)
+                    except ValueError as e:
+                        print(f"Ignoring malformed depth frame: {e}")
                         continue
+                await ingest_depth(depth_seq, data_bytes)
+                continue
 
-                    # Verify file exists and is readable before including in batch
-                    if os.path.exists(img_path) and os.path.getsize(img_path) > 0:
-                        img = cv2.imread(img_path)
-                        if img is not None and img.size > 0:
-                            batch.append(img_path)
-                            used_seqs.append(seq)
-                            print(f"Added to batch {seq}: {img_path} (batch size: {len(batch)})")
-                            if len(batch) == SUBMAP_SIZE + 1:
-                                print(f"Batch complete with {len(batch)} images!")
-                                break
-                        else:
-                            print(f"Warning: Could not read image {img_path}, removing from accumulated and accepted_sequences")
-                            accumulated_images.pop(seq, None)
-                            accepted_sequences.discard(seq)
-                    else:
-                        print(f"Warning: Image file {img_path} not found or empty, removing from accumulated and accepted_sequences")
-                        accumulated_images.pop(seq, None)
-                        accepted_sequences.discard(seq)
-
-                # Only remove images from state if we successfully created a batch
-                if len(batch) == SUBMAP_SIZE + 1:
-                    # Remove all images that were used in this batch EXCEPT the last one (overlap)
-                    overlap_seq = used_seqs[-1]
-                    for seq in used_seqs[:-1]:
-                        accumulated_images.pop(seq, None)
-                        accepted_sequences.discard(seq)
-                        print(f"Removed processed image {seq} from accumulated and accepted_sequences")
-
-                    print(f"Kept overlap image {overlap_seq}: {accumulated_images.get(overlap_seq)}")
-
-                    if processing_task is None:
-                        processing_task = asyncio.create_task(process_batch_async(batch, solver, model, accumulated_images))
-                        print("Started processing batch")
-                        # Start a keepalive task to prevent WebSocket timeout during long processing
-                        keepalive_task = asyncio.create_task(send_keepalive(websocket))
-                    else:
-                        # Processing ongoing, queue this batch
-                        if pending_batch is None:
-                            pending_batch = batch
-                            print("Queued batch for processing")
-                        else:
-                            print("Already have a pending batch, skipping this one")
-                else:
-                    print(f"Could not build complete batch from accepted images. Got {len(batch)}, need {SUBMAP_SIZE + 1}")
-
+            # Otherwise, treat this binary payload as an RGB image frame.
+            await ingest_image(sequence_counter, data_bytes)
             sequence_counter += 1
 
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
-        if processing_task and not processing_task.done():
-            processing_task.cancel()
-            try:
-                await processing_task
-            except asyncio.CancelledError:
-                pass
-        
-        if 'keepalive_task' in locals() and keepalive_task and not keepalive_task.done():
-            keepalive_task.cancel()
-            try:
-                await keepalive_task
-            except asyncio.CancelledError:
-                pass
-
-        # Process any remaining accepted images as a final partial batch
+        # Ingest is finished; let the downstream stages drain everything that
+        # was accepted, including the final partial batch.
+        if not stage_tasks[0].done():
+            await pipeline.frame_queue.put(None)
+        await asyncio.gather(*stage_tasks, return_exceptions=True)
+        print(f"Upload session finished, batch queue stats: {pipeline.batch_queue.stats}")
+
+        keepalive_task.cancel()
         try:
-            if accepted_sequences:
-                remaining_seqs = sorted(accepted_sequences)
-                final_batch = []
-                for seq in remaining_seqs:
-                    img_path = accumulated_images.get(seq)
-                    if not img_path:
-                        continue
-                    if os.path.exists(img_path) and os.path.getsize(img_path) > 0:
-                        img = cv2.imread(img_path)
-                        if img is not None and img.size > 0:
-                            final_batch.append(img_path)
-
-                if len(final_batch) > 0:
-                    print(f"Processing final partial batch with {len(final_batch)} images")
-                    try:
-                        ply_file, unique_id = await process_batch_async(final_batch, solver, model, accumulated_images)
-                        # Attempt to send the final result if the WebSocket is still open
-                        try:
-                            with open(ply_file, 'rb') as f:
-                                ply_data = f.read()
-
-                            # Always broadcast final submap to any connected viewers
-                            await broadcast_ply_to_viewers(ply_data, unique_id)
-
-                            if return_ply:
-                                await websocket.send_text(f"filename:{unique_id}")
-                                await websocket.send_bytes(ply_data)
-                                print(f"Sent final partial PLY file to uploader: submap_{unique_id}.ply")
-                            else:
-                                print(f"Final partial batch {unique_id} processed; PLY returned only to viewers (live stream mode)")
-
-                            # Remove temporary PLY file after sending or discarding
-                            try:
-                                os.remove(ply_file)
-                                print(f"Deleted temporary final PLY file: {ply_file}")
-                            except OSError as e:
-                                print(f"Failed to delete temporary final PLY file {ply_file}: {e}")
-                        except Exception as send_err:
-                            print(f"Could not send final partial batch result: {send_err}")
-                    except Exception as final_err:
-                        print(f"Error while processing final partial batch: {final_err}")
-        except Exception as e:
-            print(f"Error during final batch handling: {e}")
+            await keepalive_task
+        except asyncio.CancelledError:
+            pass
 
         # TO-DO: Have camera poses save to a tmp txt file and sent to the front end for display
         # solver.map.write_poses_to_file("/home/sailuh/Desktop/Electron Visualizer/RealtimePointCloudBuilderAndViewer/conf_values_test/posestest.txt")
 
-        try:
-            # Remove all temp images
-            for filename in os.listdir(temp_dir):
-                # Remove RGB images
-                if filename.startswith("frame_") and filename.endswith(".png"):
-                    filepath = os.path.join(temp_dir, filename)
-                    try:
-                        os.remove(filepath)
-                        print(f"Cleaned up temp image: {filename}")
-                    except OSError:
-                        pass 
-                # Remove depth maps
-                if filename.startswith("frame_") and filename.endswith("_depth_proj_mm.npy"):
-                    filepath = os.path.join(temp_dir, filename)
-                    try:
-                        os.remove(filepath)
-                        print(f"Cleaned up temp depth map: {filename}")
-                    except OSError:
-                        pass 
-        except Exception as e:
-            print(f"Error during temp file cleanup: {e}")
-
-        # Clear in-memory tracking structures for this session
-        accumulated_images.clear()
-        accepted_sequences.clear()
+        # Release in-memory frames; the map stays with the session
+        frame_store.clear()
+        upload_session.pipeline = None
+        session_manager.release(upload_session)
 
         try:
             await websocket.close()
@@ -499,74 +956,43 @@ async def websocket_upload(websocket: WebSocket):
                 raise
 
 
-async def process_batch_async(batch, solver, model, accumulated_images):
-    """Process a batch of images asynchronously
-    
-    Each batch contains SUBMAP_SIZE + 1 images:
-    - The first image overlaps with the previous batch (except for the very first batch)
-    - SUBMAP_SIZE new images
-    - The last image will be kept for overlap with the next batch
-    """
-    try:
-        # Determine depth map paths for this batch (if they exist on disk).
-        depth_paths = []
-        for img_path in batch:
-            basename = os.path.basename(img_path)
-            try:
-                seq_str = basename.split('_')[1].split('.')[0]
-                seq = int(seq_str)
-                depth_path = os.path.join(temp_dir, f"frame_{seq:06d}_depth_proj_mm.npy")
-                depth_paths.append(depth_path if os.path.exists(depth_path) else None)
-            except Exception:
-                depth_paths.append(None)
-
-        ply_file, unique_id = new_process_submap(batch, solver, model, depth_paths)
-        return ply_file, unique_id
-    except Exception as e:
-        print("Error in background processing:")
-        print(traceback.format_exc())
-        raise
-
+@instrumentation.timed("solver.process_submap")
+def new_process_submap(frames, solver, model, on_preview=None):
+    """Reconstruct one batch and return the newest submap's export data.
 
-def new_process_submap(images, solver, model, depth_paths=None):
-    def get_seq(path):
-        basename = os.path.basename(path)
-        seq_str = basename.split('_')[1].split('.')[0]
-        return int(seq_str)
-    
-    seqs = [get_seq(p) for p in images]
+    Runs on the solver thread and returns a ``SubmapResult``; encoding is
+    left to the export stage so it overlaps with the next batch. If
+    ``on_preview`` is given, it is called with a coarse ``SubmapResult``
+    (same id) as soon as the new submap's points exist, before graph
+    optimization and depth refinement.
+    """
+    frames = sorted(frames, key=lambda f: f.seq)
+    seqs = [f.seq for f in frames]
     print("Batch seqs:", seqs)
-    
-    images = sorted(images, key=get_seq)
-    print(images)
-
-    # Align depth paths order with sorted images, if provided
-    ordered_depth_paths = None
-    if depth_paths is not None:
-        depth_by_seq = {}
-        for img_path, d_path in zip(images, depth_paths):
-            try:
-                seq = get_seq(img_path)
-                depth_by_seq[seq] = d_path
-            except Exception:
-                continue
-        ordered_depth_paths = []
-        for img_path in images:
-            try:
-                seq = get_seq(img_path)
-                ordered_depth_paths.append(depth_by_seq.get(seq))
-            except Exception:
-                ordered_depth_paths.append(None)
 
-    predictions = solver.run_predictions(images, model, 1)
+    images = [f.image for f in frames]
+    # Depth is read here, on the solver thread, so a depth map that arrived
+    # after the batch was queued is still picked up.
+    depth_maps = [f.depth_mm for f in frames]
+    if all(d is None for d in depth_maps):
+        depth_maps = None
+
+    predictions = solver.run_predictions(images, model, 1, frame_ids=seqs)
 
-    if ordered_depth_paths is not None:
-        solver.add_points(predictions, ordered_depth_paths)
+    if depth_maps is not None:
+        solver.add_points(predictions, depth_maps)
     else:
         solver.add_points(predictions)
 
+    unique_id = str(uuid.uuid4())[:8]  # Short UUID for filename (e.g., 'a1b2c3d4')
+    if on_preview is not None and PREVIEW_STRIDE > 1:
+        try:
+            on_preview(build_submap_result(solver, unique_id, stride=PREVIEW_STRIDE))
+        except Exception as e:
+            print("Warning: submap preview failed:", e)
+
     solver.graph.optimize()
-    solver.map.update_submap_homographies(solver.graph)
+    moved_submaps = solver.map.update_submap_homographies(solver.graph, TRANSFORM_TOLERANCE)
 
     global_scale = None
     if hasattr(solver, "get_global_depth_scale"):
@@ -574,35 +1000,47 @@ def new_process_submap(images, solver, model, depth_paths=None):
 
     if global_scale is not None and hasattr(solver.map, "set_global_scale"):
         try:
-            solver.map.set_global_scale(global_scale * 1e-3)
+            solver.map.set_global_scale(global_scale * 1e-3, SCALE_TOLERANCE)
         except Exception:
             pass
 
     # Refinement will apply across all submaps that have
-    # depth_paths stored.
-    if depth_paths is not None and any(p is not None for p in depth_paths):
+    # depth maps stored.
+    if depth_maps is not None:
         if hasattr(solver.map, "refine_points_with_depth"):
             try:
                 solver.map.refine_points_with_depth()
             except Exception as e:
                 print("Warning: refine_points_with_depth failed:", e)
 
-    all_submaps = list(solver.map.ordered_submaps_by_key()) 
-    submap = all_submaps[-1] 
-    pcd = submap.get_points_in_world_frame()
+    # Earlier submaps moved by this optimization (e.g. after a loop closure)
+    latest_id = solver.map.get_largest_key()
+    transforms = {
+        key: np.asarray(solver.map.get_submap(key).get_reference_homography())
+        for key in moved_submaps
+        if key != latest_id
+    }
+    return build_submap_result(solver, unique_id, transforms=transforms)
+
+
+@instrumentation.timed("export.build_submap")
+def build_submap_result(solver, unique_id, stride=1, transforms=None):
+    """Collect the newest submap's points, every ``stride``-th pixel per axis."""
+    submap = solver.map.get_latest_submap()
+    local_pcd = submap.get_points_in_local_frame(stride=stride)
+    H_world_map = np.asarray(submap.get_reference_homography())
+    pcd = submap.get_points_in_world_frame(stride=stride)
     pcd = pcd.reshape(-1, 3)
     # Apply global scale on export
     scale = getattr(solver.map, "global_scale", 1.0)
     pcd = pcd * scale
 
-    colors = submap.get_points_colors()
-    if colors.max() > 1.0:
-        colors = colors / 255.0
-
+    colors = colors_to_uint8(submap.get_points_colors(stride=stride))
 
     if pcd.shape[0] != colors.shape[0]:
         n = min(pcd.shape[0], colors.shape[0])
         pcd = pcd[:n]
+        local_pcd = local_pcd[:n]
         colors = colors[:n]
 
     if pcd.size == 0:
@@ -611,38 +1049,147 @@ def new_process_submap(images, solver, model, depth_paths=None):
     finite_mask = np.isfinite(pcd).all(axis=1)
     if not finite_mask.all():
         pcd = pcd[finite_mask]
+        local_pcd = local_pcd[finite_mask]
         colors = colors[finite_mask]
 
     if pcd.size == 0:
         raise Exception("All points were non-finite after filtering")
 
-    pcd_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(pcd))
-    pcd_cloud.colors = o3d.utility.Vector3dVector(colors)
-    # voxel_size = 0.003
-    # pcd_cloud = pcd_cloud.voxel_down_sample(voxel_size=voxel_size)
+    return SubmapResult(
+        unique_id=unique_id,
+        submap_id=submap.get_id(),
+        points=pcd,
+        local_points=local_pcd,
+        colors=colors,
+        H_world_map=H_world_map,
+        scale=float(scale),
+        transforms=transforms or {},
+        stride=stride,
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint (text exposition format)."""
+    return Response(metrics_registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/debug/trace")
+async def get_trace(batches: int | None = Query(None, ge=1)):
+    """Recent spans as Chrome trace JSON (chrome://tracing, ui.perfetto.dev).
+
+    ``?batches=N`` keeps only the spans since the last N batches started.
+    Requires VGGT_TRACE_EVENTS > 0.
+    """
+    if trace_buffer is None:
+        raise HTTPException(status_code=404, detail="Tracing is disabled; set VGGT_TRACE_EVENTS to enable it")
+    return trace_buffer.chrome_trace(batches)
 
-    unique_id = str(uuid.uuid4())[:8]  # Short UUID for filename (e.g., 'a1b2c3d4')
 
-    # Create PLY in a temporary file
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".ply")
-    ply_file = tmp_file.name
-    tmp_file.close()
-    success = o3d.io.write_point_cloud(ply_file, pcd_cloud)
-    if not success:
-        raise Exception("Failed to create PLY")
-    return ply_file, unique_id
+def _process_memory() -> dict:
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    usage[key.lower() + "_bytes"] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    if torch.cuda.is_available():
+        usage["cuda_allocated_bytes"] = torch.cuda.memory_allocated()
+        usage["cuda_reserved_bytes"] = torch.cuda.memory_reserved()
+    return usage
+
+
+@app.get("/debug/memory")
+async def get_memory(session: str | None = Query(None)):
+    """Bytes held per session, submap and field, plus process totals."""
+    sessions = [session_manager.get(session)] if session else session_manager.sessions()
+    if session and sessions[0] is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session}")
+    reports = await solver_executor.run(lambda: {s.id: s.memory_report() for s in sessions})
+    return {
+        "sessions": reports,
+        "total": sum(r["total"] for r in reports.values()),
+        "process": _process_memory(),
+    }
+
+
+# Longest /debug/profile run allowed
+MAX_PROFILE_SECONDS = float(os.environ.get("VGGT_MAX_PROFILE_SECONDS", "120"))
+
+
+@app.get("/debug/profile")
+async def get_profile(
+    seconds: float = Query(10.0, gt=0),
+    interval_ms: float = Query(5.0, ge=0.5),
+):
+    """Sample every thread for ``seconds`` and return collapsed stacks.
+
+    Pipe the output into flamegraph.pl or load it in speedscope. Frames in
+    Solver, Submap and h_solve are suffixed with ``[hot]``.
+    """
+    if seconds > MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be at most {MAX_PROFILE_SECONDS:g}")
+    try:
+        counts = await asyncio.to_thread(profiler.sample, seconds, interval_ms / 1000.0)
+    except profiler.ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(profiler.collapse(counts))
+
+
+@app.get("/sessions")
+async def list_sessions():
+    """List upload sessions with their submap counts and memory use."""
+    if session_manager is None:
+        raise HTTPException(status_code=503, detail="Solver not initialized")
+    return {
+        "max_sessions": session_manager.max_sessions,
+        "sessions": await solver_executor.run(lambda: [s.describe() for s in session_manager.sessions()]),
+    }
+
+
+def map_etag(session_id: str, version: int) -> str:
+    return f'"{session_id}-{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """True if an If-None-Match header lists ``etag`` (weak comparison) or is ``*``."""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
 
 
 @app.get("/export_merged_ply")
-async def export_merged_ply():
+async def export_merged_ply(session: str | None = None, if_none_match: str | None = Header(None)):
     """Export the current merged, scaled point cloud as a single PLY file.
+
+    Exports ``session`` if given, otherwise the most recently used session.
+    The file is streamed: the header's vertex count is taken from the
+    confidence masks up front, then each submap is sent as it is encoded.
+
+    The ETag is the session and map version; a matching If-None-Match gets
+    304 without touching the map. Encoded submaps are cached by the map, so
+    re-exporting an unchanged or mostly unchanged map is cheap.
+
+    If depth refinement rebuilds a submap while the export is streaming, the
+    transfer is aborted (short of Content-Length) rather than completed with
+    points that do not match the header; the client should retry.
     """
-    global solver
-    if solver is None:
+    if session_manager is None:
         raise HTTPException(status_code=503, detail="Solver not initialized")
 
-    graph_map = getattr(solver, "map", None)
-    if graph_map is None or not hasattr(graph_map, "write_points_to_file"):
+    upload_session = session_manager.get(session) if session else session_manager.latest()
+    if upload_session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session}" if session else "No sessions available to export")
+
+    graph_map = getattr(upload_session.solver, "map", None)
+    if graph_map is None or not hasattr(graph_map, "export_snapshot"):
         raise HTTPException(status_code=500, detail="Map is not available")
 
     try:
@@ -653,21 +1200,36 @@ async def export_merged_ply():
     if num_submaps == 0:
         raise HTTPException(status_code=400, detail="No submaps available to export")
 
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".ply")
-    tmp_path = tmp_file.name
-    tmp_file.close()
+    if if_none_match is not None and etag_matches(if_none_match, map_etag(upload_session.id, graph_map.version)):
+        return Response(status_code=304, headers={"ETag": map_etag(upload_session.id, graph_map.version)})
 
     try:
-        graph_map.write_points_to_file(tmp_path)
+        # Read the map on the solver thread so it is never observed mid-update
+        entries, scale, version = await solver_executor.run(graph_map.export_snapshot)
     except Exception as e:
-        try:
-            os.remove(tmp_path)
-        except OSError:
-            pass
         raise HTTPException(status_code=500, detail=f"Failed to write merged point cloud: {e}")
 
-    return FileResponse(
-        path=tmp_path,
+    num_points = sum(entry[2] for entry in entries)
+    header = ply_header(num_points)
+
+    async def ply_chunks():
+        yield header
+        # One submap at a time, each transformed and encoded on the solver
+        # thread between batches, so peak memory is one submap.
+        for entry in entries:
+            try:
+                yield await solver_executor.run(graph_map.encode_export_chunk, entry, scale, ".ply")
+            except StaleExportError as e:
+                print(f"Aborting merged PLY export: {e}")
+                raise
+
+    return StreamingResponse(
+        ply_chunks(),
         media_type="application/octet-stream",
-        filename="merged_pointcloud.ply",
+        headers={
+            "Content-Disposition": 'attachment; filename="merged_pointcloud.ply"',
+            "Content-Length": str(len(header) + num_points * PLY_VERTEX_DTYPE.itemsize),
+            "ETag": map_etag(upload_session.id, version),
+            "Cache-Control": "no-cache",
+        },
     )
@@ -0,0 +1,161 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+
+# What a full BatchQueue does with a new batch:
+# - "block":       wait for the reconstruct stage to take one (backpressure to ingest)
+# - "coalesce":    merge the new batch into the newest queued one (larger submap)
+# - "drop_oldest": discard the oldest queued batch, keep the overlap chain intact
+#                  and report exactly which frames were lost
+OVERFLOW_POLICIES = ("block", "coalesce", "drop_oldest")
+
+
+class BatchQueue:
+    """Bounded FIFO of frame batches between keyframe selection and reconstruction.
+
+    A batch is a list of frames where ``batch[0]`` overlaps with the last
+    frame of the previous batch. Every policy preserves that invariant so
+    the solver can always align a new submap against the previous one.
+    """
+
+    def __init__(self, maxsize: int = 2, policy: str = "block", max_coalesced_frames: int = 33):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_coalesced_frames = max_coalesced_frames
+        self._items: Deque[List[Any]] = deque()
+        self._cond = asyncio.Condition()
+        self._closed = False
+        self.stats: Dict[str, int] = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "dropped_frames": 0,
+            "blocked": 0,
+        }
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def _full(self) -> bool:
+        return len(self._items) >= self.maxsize
+
+    def _try_coalesce(self, batch: List[Any]) -> bool:
+        newest = self._items[-1]
+        tail = batch[1:] if batch and newest and batch[0] is newest[-1] else batch
+        if len(newest) + len(tail) > self.max_coalesced_frames:
+            return False
+        newest.extend(tail)
+        self.stats["coalesced"] += 1
+        return True
+
+    def _drop_oldest(self, successor: List[Any]) -> List[Any]:
+        dropped = self._items.popleft()
+        # The successor overlapped with the dropped batch's last frame; give it
+        # the dropped batch's first frame instead, which the solver has seen.
+        # That frame is carried forward, so only the rest are lost.
+        if dropped and successor:
+            successor[0] = dropped[0]
+        lost = dropped[1:]
+        self.stats["dropped"] += 1
+        self.stats["dropped_frames"] += len(lost)
+        return lost
+
+    async def put(self, batch: List[Any]) -> Optional[List[Any]]:
+        """Enqueue ``batch`` according to the overflow policy.
+
+        Returns the frames lost by dropping a batch to make room, if any, so
+        the caller can account for them. Frames are not necessarily
+        consecutive: after chained drops, frames kept in between belong to
+        batches still queued.
+        """
+        async with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchQueue is closed")
+
+            dropped = None
+            if self._full():
+                if self.policy == "coalesce" and self._try_coalesce(batch):
+                    self._cond.notify_all()
+                    return None
+                if self.policy == "drop_oldest":
+                    successor = self._items[1] if len(self._items) > 1 else batch
+                    dropped = self._drop_oldest(successor)
+                else:
+                    self.stats["blocked"] += 1
+                    await self._cond.wait_for(lambda: not self._full() or self._closed)
+                    if self._closed:
+                        raise RuntimeError("BatchQueue is closed")
+
+            self._items.append(batch)
+            self.stats["enqueued"] += 1
+            self._cond.notify_all()
+            return dropped
+
+    async def get(self) -> Optional[List[Any]]:
+        """Dequeue the oldest batch, or return None once closed and drained."""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._items or self._closed)
+            if not self._items:
+                return None
+            batch = self._items.popleft()
+            self._cond.notify_all()
+            return batch
+
+    async def close(self) -> None:
+        """Stop accepting batches; ``get`` drains what is left, then returns None."""
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class UploadPipeline:
+    """Queues and bookkeeping for one /ws/upload session.
+
+    Stages, each a separate task connected by bounded queues:
+    ingest/decode -> keyframe selection -> reconstruction (VGGT inference
+    followed by alignment/graph, on the solver thread) -> export/broadcast.
+    Ingest blocks when ``frame_queue`` is full, which stops reading from
+    the socket and pushes backpressure to the client.
+    """
+
+    def __init__(
+        self,
+        frame_queue_size: int = 64,
+        batch_queue_size: int = 2,
+        overflow_policy: str = "block",
+        max_coalesced_frames: int = 33,
+        export_queue_size: int = 2,
+    ):
+        self.frame_queue: asyncio.Queue = asyncio.Queue(maxsize=frame_queue_size)
+        self.batch_queue = BatchQueue(batch_queue_size, overflow_policy, max_coalesced_frames)
+        self.export_queue: asyncio.Queue = asyncio.Queue(maxsize=export_queue_size)
+        self.reconstructing = False
+        self.exporting = False
+        # Wall time of the most recent reconstruction, reported in frame acks
+        self.last_batch_ms: Optional[float] = None
+
+    def set_overflow_policy(self, policy: str) -> None:
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.batch_queue.policy = policy
+
+    def is_idle(self) -> bool:
+        return (
+            self.frame_queue.empty()
+            and self.batch_queue.qsize() == 0
+            and self.export_queue.empty()
+            and not self.reconstructing
+            and not self.exporting
+        )
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {
+            "frames": self.frame_queue.qsize(),
+            "batches": self.batch_queue.qsize(),
+            "exports": self.export_queue.qsize(),
+        }
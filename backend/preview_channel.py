@@ -0,0 +1,75 @@
+"""Preview frames from the capture bridge to the viewer over stdout.
+
+``binary`` (default) writes one length-prefixed record per preview:
+
+    offset  size  field
+    0       4     magic b"VPV1"
+    4       1     version (1)
+    5       1     type (1 rgb, 2 rgb + depth)
+    6       2     reserved
+    8       4     uint32 RGB JPEG length
+    12      4     uint32 depth JPEG length (0 when there is no depth preview)
+    16      ...   RGB JPEG, then depth JPEG
+
+``json`` is the older format: one JSON object per line with base64 JPEGs
+(``{"type": "rgb", "jpeg_b64": ...}`` or ``{"type": "rgbd",
+"rgb_jpeg_b64": ..., "depth_jpeg_b64": ...}``).
+
+Previews are rate limited independently of the capture loop; callers check
+``due()`` before encoding anything for the preview.
+"""
+
+import base64
+import json
+import struct
+import sys
+import time
+from typing import BinaryIO, Optional
+
+PREVIEW_MAGIC = b"VPV1"
+PREVIEW_VERSION = 1
+PREVIEW_RGB = 1
+PREVIEW_RGBD = 2
+PREVIEW_FORMATS = ("binary", "json")
+_PREVIEW_HEADER = struct.Struct("<4sBBHII")
+
+
+def pack_preview(rgb_jpeg: bytes, depth_jpeg: Optional[bytes] = None, rgbd: bool = False) -> bytes:
+    kind = PREVIEW_RGBD if rgbd or depth_jpeg is not None else PREVIEW_RGB
+    depth_jpeg = depth_jpeg or b""
+    header = _PREVIEW_HEADER.pack(PREVIEW_MAGIC, PREVIEW_VERSION, kind, 0, len(rgb_jpeg), len(depth_jpeg))
+    return header + bytes(rgb_jpeg) + bytes(depth_jpeg)
+
+
+class PreviewChannel:
+    """Rate-limited preview writer; ``fps <= 0`` previews every frame."""
+
+    def __init__(self, fps: float = 10.0, fmt: str = "binary", stream: Optional[BinaryIO] = None):
+        if fmt not in PREVIEW_FORMATS:
+            raise ValueError(f"Unknown preview format {fmt!r}, expected one of {PREVIEW_FORMATS}")
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.fmt = fmt
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self._last = float("-inf")
+        self.sent = 0
+
+    def due(self) -> bool:
+        return time.monotonic() - self._last >= self.interval
+
+    def send(self, rgb_jpeg: bytes, depth_jpeg: Optional[bytes] = None, rgbd: bool = False) -> None:
+        """Write one preview. ``rgbd`` marks an RGB-D stream even when this
+        preview has no depth."""
+        self._last = time.monotonic()
+        if self.fmt == "binary":
+            data = pack_preview(rgb_jpeg, depth_jpeg, rgbd)
+        elif rgbd or depth_jpeg is not None:
+            msg = {"type": "rgbd", "rgb_jpeg_b64": base64.b64encode(rgb_jpeg).decode("ascii")}
+            if depth_jpeg is not None:
+                msg["depth_jpeg_b64"] = base64.b64encode(depth_jpeg).decode("ascii")
+            data = (json.dumps(msg) + "\n").encode("ascii")
+        else:
+            msg = {"type": "rgb", "jpeg_b64": base64.b64encode(rgb_jpeg).decode("ascii")}
+            data = (json.dumps(msg) + "\n").encode("ascii")
+        self.stream.write(data)
+        self.stream.flush()
+        self.sent += 1
@@ -0,0 +1,111 @@
+"""In-process statistical sampler producing collapsed stacks.
+
+Samples the Python stacks of every thread (event loop, solver thread, encode
+workers, capture threads) from a background thread, with no external
+profiler attached. The output is one line per distinct stack,
+``thread;outer;...;inner count``, the input format of flamegraph.pl,
+speedscope and inferno.
+
+Frames in the reconstruction hot paths (``Solver`` and ``Submap`` methods,
+and everything in ``h_solve``) get a ``[hot]`` suffix so they stand out in a
+flame graph and can be grepped for.
+"""
+
+import ast
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+HOT_QUALNAME_PREFIXES = ("Solver.", "Submap.")
+HOT_MODULES = ("h_solve",)
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def _class_ranges(filename: str) -> List[Tuple[int, int, str]]:
+    """``(first_line, last_line, qualname)`` of every class defined in ``filename``."""
+    try:
+        with open(filename, encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename)
+    except (OSError, SyntaxError, ValueError):
+        return []
+    ranges = []
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                name = prefix + child.name
+                ranges.append((child.lineno, child.end_lineno, name))
+                visit(child, name + ".")
+    visit(tree, "")
+    return ranges
+
+
+def _qualname(code) -> str:
+    qualname = getattr(code, "co_qualname", None)
+    if qualname is not None:
+        return qualname
+    # Before Python 3.11 code objects only carry the bare name; recover the
+    # enclosing class from the definition's position in the source file.
+    owner = None
+    for first, last, name in _class_ranges(code.co_filename):
+        if first <= code.co_firstlineno <= last and (owner is None or first >= owner[0]):
+            owner = (first, name)
+    return f"{owner[1]}.{code.co_name}" if owner else code.co_name
+
+
+def _frame_label(code) -> str:
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    qualname = _qualname(code)
+    label = f"{module}:{qualname}"
+    if module in HOT_MODULES or qualname.startswith(HOT_QUALNAME_PREFIXES):
+        label += "[hot]"
+    # ';' separates frames and ' ' separates the count in collapsed stacks
+    return label.replace(";", ":").replace(" ", "_")
+
+
+def sample(seconds: float, interval: float = 0.005) -> Dict[Tuple[str, ...], int]:
+    """Sample all threads for ``seconds``; returns stack -> sample count.
+
+    Only one profile runs at a time; ``ProfilerBusyError`` is raised otherwise.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError("A profile is already running")
+    try:
+        me = threading.get_ident()
+        labels = {}  # code object -> label, computed once per code object
+        counts: Dict[Tuple[str, ...], int] = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)).replace(" ", "_").replace(";", ":"))
+                counts[tuple(reversed(stack))] += 1
+            time.sleep(interval)
+        return counts
+    finally:
+        _profile_lock.release()
+
+
+def collapse(counts: Dict[Tuple[str, ...], int]) -> str:
+    lines = [f"{';'.join(stack)} {n}" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1])]
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,148 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from vggt_slam.map import nbytes
+
+
+class SessionLimitError(RuntimeError):
+    """Raised when every session slot, or the requested session, is held by a connected client."""
+
+
+class Session:
+    """Reconstruction state owned by one capture rig.
+
+    Each session has its own ``Solver`` (and with it its own ``GraphMap``,
+    ``PoseGraph`` and ``FrameTracker``); the VGGT and retrieval models are
+    shared between sessions.
+    """
+
+    def __init__(self, session_id: str, solver):
+        self.id = session_id
+        self.solver = solver
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        # Number of open connections using this session. Sessions with
+        # connected clients are never evicted.
+        self.connections = 0
+        # UploadPipeline of the connected uploader, if any (for queue metrics)
+        self.pipeline = None
+
+    def touch(self) -> None:
+        self.last_active = time.time()
+
+    def memory_report(self, record: bool = True) -> Dict[str, Any]:
+        """The map's memory report plus what the solver holds outside it.
+
+        Reads solver state, so call it on the solver thread.
+        """
+        report = self.solver.map.memory_report(self.solver.graph, record=record)
+        # Every depth-scale ratio seen so far; this list is never trimmed
+        samples = getattr(self.solver, "depth_scale_samples", [])
+        report["depth_scale_samples"] = nbytes(list(samples))
+        report["total"] += report["depth_scale_samples"]
+        return report
+
+    def memory_bytes(self) -> Dict[str, int]:
+        """Approximate memory held by the session, per kind of data."""
+        report = self.memory_report(record=False)
+        usage = dict(report["fields"])
+        usage["export_cache"] = report["export_cache"]
+        usage["depth_scale_samples"] = report["depth_scale_samples"]
+        usage["total"] = report["total"]
+        return usage
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "connections": self.connections,
+            "submaps": self.solver.map.get_num_submaps(),
+            "created_at": self.created_at,
+            "idle_seconds": round(time.time() - self.last_active, 1),
+            "memory_bytes": self.memory_bytes(),
+        }
+
+
+class SessionManager:
+    """Creates, looks up and evicts upload sessions.
+
+    At most ``max_sessions`` sessions are kept. When a new one is needed and
+    the limit is reached, the least recently used session without a
+    connected client is evicted; if every session is connected,
+    ``SessionLimitError`` is raised. Idle sessions older than ``idle_ttl``
+    seconds are evicted as well (disabled when None).
+
+    Only used from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, solver_factory: Callable[[], Any], max_sessions: int = 4, idle_ttl: Optional[float] = None):
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+        self.solver_factory = solver_factory
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self._sessions.get(session_id)
+
+    def latest(self) -> Optional[Session]:
+        """The most recently used session, if any."""
+        if not self._sessions:
+            return None
+        return next(reversed(self._sessions.values()))
+
+    def sessions(self) -> List[Session]:
+        return list(self._sessions.values())
+
+    def acquire(self, session_id: Optional[str] = None) -> Session:
+        """Attach a connection to ``session_id``, creating the session if needed."""
+        self._expire_idle()
+        session = self._sessions.get(session_id) if session_id else None
+        if session is not None and session.connections > 0:
+            raise SessionLimitError(f"Session {session_id} already has a connected client")
+        if session is None:
+            self._make_room()
+            session = Session(session_id or uuid.uuid4().hex[:8], self.solver_factory())
+            self._sessions[session.id] = session
+            print(f"Created session {session.id} ({len(self._sessions)}/{self.max_sessions})")
+        self._sessions.move_to_end(session.id)
+        session.connections += 1
+        session.touch()
+        return session
+
+    def release(self, session: Session) -> None:
+        """Detach a connection; the session stays available until evicted."""
+        session.connections = max(session.connections - 1, 0)
+        session.touch()
+
+    def touch(self, session: Session) -> None:
+        if session.id in self._sessions:
+            self._sessions.move_to_end(session.id)
+        session.touch()
+
+    def evict(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        print(f"Evicted session {session_id} ({session.solver.map.get_num_submaps()} submaps)")
+        return True
+
+    def _make_room(self) -> None:
+        while len(self._sessions) >= self.max_sessions:
+            victim = next((s for s in self._sessions.values() if s.connections == 0), None)
+            if victim is None:
+                raise SessionLimitError(f"All {self.max_sessions} sessions are in use")
+            self.evict(victim.id)
+
+    def _expire_idle(self) -> None:
+        if self.idle_ttl is None:
+            return
+        now = time.time()
+        for session in list(self._sessions.values()):
+            if session.connections == 0 and now - session.last_active > self.idle_ttl:
+                self.evict(session.id)
@@ -0,0 +1,62 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class SolverExecutor:
+    """Single-threaded executor that owns all Solver state.
+
+    VGGT inference, pose graph optimization, depth refinement and PLY
+    export are blocking and touch shared Solver/GraphMap/PoseGraph
+    objects. Running them on one dedicated worker thread keeps the
+    asyncio event loop free for ingest and broadcast, and serializes
+    access to the solver so no locking is needed inside vggt_slam.
+
+    Work is handed off with ``await executor.run(fn, *args)``; the
+    result (or exception) is handed back to the awaiting coroutine.
+    """
+
+    def __init__(self, name: str = "solver"):
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run ``fn(*args, **kwargs)`` on the solver thread and await the result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+class IngestExecutor:
+    """Thread pool for per-frame upload work.
+
+    Image decoding and depth decoding/projection are independent per frame
+    and release the GIL in OpenCV and NumPy, so several frames can be in
+    flight at once. ``submit`` starts the work immediately and returns an
+    awaitable; keeping those in a FIFO and awaiting them in order gives
+    parallel execution with in-order results.
+
+    The keyframe check also runs here but mutates the session's
+    ``flow_tracker``; the upload handler awaits each check before starting
+    the next one, so calls for one session never overlap. Work that touches
+    other solver state belongs on the ``SolverExecutor``.
+    """
+
+    def __init__(self, max_workers: int = 4, name: str = "ingest"):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> "asyncio.Future[Any]":
+        """Schedule ``fn(*args, **kwargs)`` on the pool; must be called from the event loop."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await self.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,106 @@
+"""Wire formats for submaps sent to viewers and uploaders.
+
+``ply`` (default) is a binary PLY file. ``qpc`` is a compact quantized
+point cloud, negotiated per connection:
+
+    offset  size       field
+    0       4          magic b"VQPC"
+    4       1          version (1)
+    5       1          flags (bit 0: payload is LZ4-frame compressed)
+    6       2          reserved
+    8       4          uint32 point count N
+    12      12         float32[3] bounding box center
+    24      12         float32[3] quantization step per axis
+    36      ...        payload
+
+The (optionally compressed) payload is N int16 xyz triplets followed by N
+uint8 rgb triplets, all little-endian. A point is recovered as
+``center + q * step``; the error per axis is at most ``step / 2``, i.e.
+1/65534 of the submap's bounding box extent on that axis.
+"""
+
+import struct
+from typing import Tuple
+
+import numpy as np
+
+from vggt_slam.pointcloud_io import colors_to_uint8, encode_ply
+
+try:
+    import lz4.frame  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    lz4 = None  # type: ignore
+
+
+SUBMAP_FORMATS = ("ply", "qpc")
+
+QPC_MAGIC = b"VQPC"
+QPC_VERSION = 1
+QPC_FLAG_LZ4 = 0x01
+_QPC_HEADER = struct.Struct("<4sBBHI3f3f")
+_QMAX = 32767
+
+
+def encode_qpc(points: np.ndarray, colors: np.ndarray, compress: bool = True) -> bytes:
+    """Quantize a point cloud to int16 against its bounding box and pack it."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    colors = colors_to_uint8(colors)
+    if points.shape[0] != colors.shape[0]:
+        raise ValueError(f"Got {points.shape[0]} points but {colors.shape[0]} colors")
+
+    n = points.shape[0]
+    if n:
+        lo = points.min(axis=0)
+        hi = points.max(axis=0)
+    else:
+        lo = hi = np.zeros(3)
+    center = ((lo + hi) / 2.0).astype(np.float32)
+    step = ((hi - lo) / (2.0 * _QMAX)).astype(np.float32)
+    # Degenerate axes (all points equal) still need a non-zero step
+    step[step <= 0] = 1.0
+
+    q = np.rint((points - center) / step)
+    np.clip(q, -_QMAX, _QMAX, out=q)
+    payload = q.astype("<i2").tobytes() + colors.tobytes()
+
+    flags = 0
+    if compress and lz4 is not None:
+        payload = lz4.frame.compress(payload)
+        flags |= QPC_FLAG_LZ4
+
+    header = _QPC_HEADER.pack(QPC_MAGIC, QPC_VERSION, flags, 0, n, *center, *step)
+    return header + payload
+
+
+def decode_qpc(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Reference decoder: returns float32 points (N, 3) and uint8 colors (N, 3)."""
+    if len(data) < _QPC_HEADER.size:
+        raise ValueError("Truncated qpc header")
+    magic, version, flags, _, n, cx, cy, cz, sx, sy, sz = _QPC_HEADER.unpack_from(data)
+    if magic != QPC_MAGIC:
+        raise ValueError("Not a qpc submap")
+    if version != QPC_VERSION:
+        raise ValueError(f"Unsupported qpc version {version}")
+
+    payload = data[_QPC_HEADER.size:]
+    if flags & QPC_FLAG_LZ4:
+        if lz4 is None:
+            raise RuntimeError("lz4 is required to decode this submap")
+        payload = lz4.frame.decompress(payload)
+    if len(payload) != n * 9:
+        raise ValueError(f"Expected {n * 9} payload bytes, got {len(payload)}")
+
+    q = np.frombuffer(payload, dtype="<i2", count=n * 3).reshape(n, 3)
+    colors = np.frombuffer(payload, dtype=np.uint8, offset=n * 6).reshape(n, 3)
+    center = np.array([cx, cy, cz], dtype=np.float32)
+    step = np.array([sx, sy, sz], dtype=np.float32)
+    points = q.astype(np.float32) * step + center
+    return points, colors
+
+
+def encode_submap(points: np.ndarray, colors: np.ndarray, fmt: str = "ply") -> bytes:
+    if fmt == "ply":
+        return encode_ply(points, colors)
+    if fmt == "qpc":
+        return encode_qpc(points, colors)
+    raise ValueError(f"Unknown submap format {fmt!r}, expected one of {SUBMAP_FORMATS}")
@@ -0,0 +1,84 @@
+"""Ring buffer of recent instrumentation spans, exported as a Chrome trace.
+
+Register a ``TraceBuffer`` as a ``vggt_slam.instrumentation`` observer and it
+keeps the most recent spans from every thread (event loop, solver thread,
+encode workers). ``chrome_trace()`` returns them in the Trace Event format,
+which loads in chrome://tracing and https://ui.perfetto.dev, so overlapping
+stages of consecutive batches can be seen side by side.
+"""
+
+import collections
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Span that marks one batch going through the solver; used to cut the
+# buffer down to the last N batches.
+BATCH_SPAN = "upload.reconstruct"
+
+# Spans that await other work on the event loop. They overlap whatever else
+# the loop runs meanwhile, so each is drawn on its own track instead of
+# pretending to nest inside the event loop thread.
+ASYNC_SPANS = ("upload.reconstruct", "export.broadcast", "export.send")
+
+
+class TraceBuffer:
+    def __init__(self, max_events: int = 20000):
+        self._events = collections.deque(maxlen=max_events)
+        self._thread_names: Dict[int, str] = {}
+        # perf_counter() timestamps are shifted to microseconds since this
+        # origin so traces from one process line up across downloads.
+        self._origin = time.perf_counter()
+
+    def __call__(self, name: str, start: float, duration: float) -> None:
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+        # deque.append is atomic, so no lock is needed on the hot path
+        self._events.append((name, start, duration, tid))
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def clear(self) -> None:
+        self._events.clear()
+
+    def chrome_trace(self, batches: Optional[int] = None) -> dict:
+        """Trace Event JSON; with ``batches``, only spans since the start of
+        the ``batches``-th most recent batch."""
+        events = list(self._events)
+        if batches is not None and batches > 0:
+            starts = [start for name, start, _, _ in events if name == BATCH_SPAN]
+            if starts:
+                cutoff = sorted(starts)[-batches:][0]
+                events = [e for e in events if e[1] + e[2] >= cutoff]
+
+        pid = os.getpid()
+        trace: List[dict] = []
+        tracks = {}
+        for name, start, duration, tid in events:
+            if name in ASYNC_SPANS:
+                tid = ASYNC_SPANS.index(name) + 1
+                tracks[tid] = f"async {name}"
+            else:
+                tracks[tid] = self._thread_names.get(tid, str(tid))
+            trace.append({
+                "name": name,
+                "cat": name.split(".", 1)[0],
+                "ph": "X",
+                "ts": round((start - self._origin) * 1e6, 3),
+                "dur": round(duration * 1e6, 3),
+                "pid": pid,
+                "tid": tid,
+            })
+        for tid, track in tracks.items():
+            trace.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": track},
+            })
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
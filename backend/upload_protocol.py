@@ -0,0 +1,245 @@
+"""Shared pieces of the /ws/upload protocol used by the backend and its clients.
+
+Flow control (opt-in with ``config:flow_control:1``):
+
+- the server answers with ``flow:window:<n>``: the client may have at most
+  ``n`` image frames sent but not yet acknowledged;
+- every image frame is acknowledged once it has left keyframe selection with
+  ``ack:<json>``, e.g.
+  ``{"seq": 12, "accepted": true, "credits": 1, "stage_ms": {...}, "queues": {...}}``.
+  ``credits`` is the number of sends the client gets back.
+
+Depth payloads that follow an image never consume credits.
+
+Typed frames (opt-in with ``config:framing:typed``, confirmed with
+``status:framing:typed``): each binary message starts with a 24-byte header
+
+    offset  size  field
+    0       4     magic b"VUF1"
+    4       1     version (1)
+    5       1     type (1 image, 2 depth, 3 image + depth)
+    6       1     depth encoding (0 none, 1 float32 .npy, 2 depth_codec frame)
+    7       1     reserved
+    8       4     uint32 sequence number (chosen by the client)
+    12      8     float64 capture timestamp (seconds, client clock; 0 if unknown)
+    20      4     uint32 image length in bytes (0 for depth-only frames)
+    24      ...   encoded image, then depth
+
+so depth no longer has to follow its image: the server matches them by
+sequence number. Untyped (legacy) messages are still accepted.
+
+Keyframe threshold: right after ``status:session:<id>`` the server announces
+``status:keyframe_disparity:<pixels>``, the mean optical-flow displacement a
+frame needs to be accepted, so clients can pre-filter frames the same way
+(see ``keyframe_filter``).
+"""
+
+import asyncio
+import json
+import struct
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+
+FLOW_CONTROL_CONFIG = "config:flow_control:1"
+FLOW_WINDOW_PREFIX = "flow:window:"
+ACK_PREFIX = "ack:"
+
+KEYFRAME_DISPARITY_STATUS = "status:keyframe_disparity:"
+
+TYPED_FRAMES_CONFIG = "config:framing:typed"
+TYPED_FRAMES_STATUS = "status:framing:typed"
+FRAME_MAGIC = b"VUF1"
+FRAME_VERSION = 1
+FRAME_IMAGE = 1
+FRAME_DEPTH = 2
+FRAME_RGBD = 3
+DEPTH_NONE = 0
+DEPTH_NPY = 1
+DEPTH_ENCODED = 2
+_FRAME_HEADER = struct.Struct("<4sBBBBIdI")
+
+
+class UploadFrame(NamedTuple):
+    kind: int  # FRAME_IMAGE, FRAME_DEPTH or FRAME_RGBD
+    seq: int
+    timestamp: float
+    image: Optional[bytes]
+    depth: Optional[bytes]
+    depth_encoding: int
+
+
+def is_typed_frame(data: bytes) -> bool:
+    return data[:4] == FRAME_MAGIC
+
+
+def pack_frame(
+    seq: int,
+    image: Optional[bytes] = None,
+    depth: Optional[bytes] = None,
+    timestamp: float = 0.0,
+    depth_encoding: Optional[int] = None,
+) -> bytes:
+    """Frame an encoded image, a depth payload or both under one header."""
+    if image is None and depth is None:
+        raise ValueError("A frame needs an image, a depth payload or both")
+    kind = FRAME_RGBD if image is not None and depth is not None else (FRAME_IMAGE if depth is None else FRAME_DEPTH)
+    if depth is None:
+        depth_encoding = DEPTH_NONE
+    elif depth_encoding is None:
+        depth_encoding = DEPTH_NPY if depth[:6] == b"\x93NUMPY" else DEPTH_ENCODED
+    image = image or b""
+    header = _FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, kind, depth_encoding, 0, seq, timestamp, len(image))
+    return b"".join((header, image, depth or b""))
+
+
+def parse_frame(data: bytes) -> UploadFrame:
+    if len(data) < _FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    magic, version, kind, depth_encoding, _, seq, timestamp, image_len = _FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a typed upload frame")
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    if kind not in (FRAME_IMAGE, FRAME_DEPTH, FRAME_RGBD):
+        raise ValueError(f"Unknown frame type {kind}")
+    body = memoryview(data)[_FRAME_HEADER.size:]
+    if image_len > len(body):
+        raise ValueError(f"Frame declares {image_len} image bytes but carries {len(body)}")
+    image = bytes(body[:image_len]) if kind != FRAME_DEPTH else None
+    depth = bytes(body[image_len:]) if kind != FRAME_IMAGE else None
+    if (image is not None and not image) or (depth is not None and not depth):
+        raise ValueError("Frame is missing its image or depth payload")
+    return UploadFrame(kind, seq, timestamp, image, depth, depth_encoding)
+
+
+def format_window(window: int) -> str:
+    return f"{FLOW_WINDOW_PREFIX}{int(window)}"
+
+
+def format_ack(
+    seq: int,
+    accepted: bool,
+    stage_ms: Dict[str, float],
+    queues: Optional[Dict[str, int]] = None,
+    credits: int = 1,
+) -> str:
+    msg: Dict[str, Any] = {
+        "seq": seq,
+        "accepted": accepted,
+        "credits": credits,
+        "stage_ms": {k: round(v, 2) for k, v in stage_ms.items()},
+    }
+    if queues is not None:
+        msg["queues"] = queues
+    return ACK_PREFIX + json.dumps(msg)
+
+
+class TypedFraming:
+    """Client side of the typed-frame opt-in: use ``pack_frame`` once ``enabled``."""
+
+    def __init__(self):
+        self.enabled = False
+
+    def config_message(self) -> str:
+        return TYPED_FRAMES_CONFIG
+
+    def handle_text(self, text: str) -> bool:
+        if text == TYPED_FRAMES_STATUS:
+            self.enabled = True
+            return True
+        return False
+
+
+class CreditWindow:
+    """Client-side credit accounting for a flow-controlled upload.
+
+    Until the server announces a window (older servers never do) sending
+    is unrestricted. Sends made before the announcement are charged against
+    the window once it arrives.
+
+    Besides the hard credit limit, the window adapts a send interval
+    (``send_interval()``): it backs off multiplicatively while more than
+    half the window is outstanding and speeds back up towards
+    ``min_interval`` while the server keeps up, so callers settle at the
+    server's rate instead of filling the window in bursts.
+    """
+
+    def __init__(self, min_interval: float = 0.0, max_interval: float = 2.0):
+        self.window: Optional[int] = None
+        self.in_flight = 0
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.acked = 0
+        self.accepted = 0
+        self.last_ack: Optional[Dict[str, Any]] = None
+        self._changed = asyncio.Event()
+
+    def available(self) -> bool:
+        return self.window is None or self.in_flight < self.window
+
+    def try_acquire(self) -> bool:
+        """Take a credit if one is available, without waiting."""
+        if not self.available():
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        """Return a credit that was acquired but not used for a send."""
+        self.in_flight = max(self.in_flight - 1, 0)
+        self._changed.set()
+
+    async def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a credit. Returns False if ``timeout`` expires first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.available():
+            self._changed.clear()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        self.in_flight += 1
+        return True
+
+    def send_interval(self) -> float:
+        """Seconds to wait between sends to match the server's rate."""
+        return self.interval
+
+    def _adapt_interval(self) -> None:
+        if self.window is None:
+            return
+        if self.in_flight > self.window // 2:
+            self.interval = min(self.max_interval, max(self.interval, 0.005) * 1.25)
+        else:
+            self.interval = max(self.min_interval, self.interval * 0.9)
+
+    def handle_text(self, text: str) -> bool:
+        """Consume flow-control messages. Returns True if ``text`` was one."""
+        if text.startswith(FLOW_WINDOW_PREFIX):
+            try:
+                self.window = int(text[len(FLOW_WINDOW_PREFIX):])
+            except ValueError:
+                return True
+            self._changed.set()
+            return True
+
+        if text.startswith(ACK_PREFIX):
+            try:
+                ack = json.loads(text[len(ACK_PREFIX):])
+            except ValueError:
+                return True
+            self.in_flight = max(self.in_flight - int(ack.get("credits", 1)), 0)
+            self._adapt_interval()
+            self.acked += 1
+            if ack.get("accepted"):
+                self.accepted += 1
+            self.last_ack = ack
+            self._changed.set()
+            return True
+
+        return False
@@ -5,24 +5,44 @@ Simple WebSocket test client to drive the `/ws/upload` endpoint without the fron
 - Sends all images from a directory (ordered by name) as binary frames.
 - Listens for text messages like "filename:<id>", "status:done:<id>", and binary blobs (PLY).
 - Saves any incoming binary to /tmp/received_<id>.ply (or a timestamped name if no id queued).
+- With --flow-control, uses the server's credit window and frame acks to pace sends
+  instead of sleeping a fixed --delay.
+- With --format qpc, requests the compact quantized submap format and decodes it
+  back to PLY with the reference decoder before saving.
+- With --uploaders/--viewers/--report, runs as a load generator instead: N
+  concurrent uploader sessions replay the directory (and optional depth maps)
+  at --fps while M passive /ws/submaps viewers listen. Per-frame send times,
+  per-submap arrival latency, bytes and dropped batches go to a JSON or CSV
+  report (picked by the file extension) and a summary is printed.
 
 Usage:
   python3 ws_test_client.py /path/to/images --delay 0.01
+  python3 ws_test_client.py /path/to/images --flow-control
+  python3 ws_test_client.py /path/to/images --format qpc
+  python3 ws_test_client.py /path/to/images --uploaders 4 --viewers 8 --fps 10 --report load.json
 
 Requires: pip install websockets
 """
 
 import argparse
 import asyncio
+import csv
+import json
 import os
+import statistics
 import sys
 import time
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
 
 import websockets
 
+from upload_protocol import FLOW_CONTROL_CONFIG, CreditWindow
+from submap_codec import SUBMAP_FORMATS, decode_qpc
+from vggt_slam.pointcloud_io import encode_ply
 
-async def recv_loop(ws, pending_ids):
+
+async def recv_loop(ws, pending_ids, window=None, fmt='ply'):
     """Receive loop: handles text and binary messages from server."""
     try:
         async for msg in ws:
@@ -32,13 +52,26 @@ async def recv_loop(ws, pending_ids):
                     id_tag = pending_ids.pop(0)
                 filename = id_tag or str(int(time.time() * 1000))
                 out_path = Path('/tmp') / f"received_{filename}.ply"
+                data = msg
+                if fmt == 'qpc':
+                    points, colors = decode_qpc(msg)
+                    data = encode_ply(points, colors)
+                    print(f"[recv] Decoded qpc submap: {len(points)} points, "
+                          f"{len(msg)} bytes on the wire vs {len(data)} as PLY")
                 with open(out_path, 'wb') as f:
-                    f.write(msg)
+                    f.write(data)
                 print(f"[recv] Saved binary to {out_path} (id={id_tag})")
             else:
                 # Text message
                 text = msg
-                if text.startswith('filename:'):
+                if window is not None and window.handle_text(text):
+                    if text.startswith('ack:'):
+                        ack = window.last_ack
+                        print(f"[recv] ack seq={ack.get('seq')} accepted={ack.get('accepted')} "
+                              f"stage_ms={ack.get('stage_ms')} in_flight={window.in_flight}")
+                    else:
+                        print(f"[recv] flow window: {window.window}")
+                elif text.startswith('filename:'):
                     fid = text.split(':', 1)[1]
                     pending_ids.append(fid)
                     print(f"[recv] filename announcement: {fid}")
@@ -52,20 +85,26 @@ async def recv_loop(ws, pending_ids):
         print('[recv] error in recv loop:', repr(e))
 
 
-async def send_images(ws, images, delay):
-    """Send images sequentially as binary frames."""
+async def send_images(ws, images, delay, window=None):
+    """Send images sequentially as binary frames.
+
+    With a credit window, each send waits for a credit and the pause between
+    sends follows the window's adaptive interval (never below ``delay``).
+    """
     for p in images:
         data = p.read_bytes()
+        if window is not None:
+            await window.acquire()
         try:
             await ws.send(data)
             print(f"[send] Sent {p.name} ({len(data)} bytes)")
         except Exception as e:
             print(f"[send] failed to send {p}: {e}")
             return
-        await asyncio.sleep(delay)
+        await asyncio.sleep(window.send_interval() if window is not None else delay)
 
 
-async def main(uri, images_dir, delay):
+async def main(uri, images_dir, delay, flow_control=False, fmt='ply'):
     images_dir = Path(images_dir)
     images = sorted([p for p in images_dir.iterdir() if p.is_file() and p.suffix.lower() in ('.png', '.jpg', '.jpeg')])
     if not images:
@@ -73,14 +112,20 @@ async def main(uri, images_dir, delay):
         return
 
     pending_ids = []
+    window = CreditWindow(min_interval=delay) if flow_control else None
     print(f"Connecting to {uri}...")
     try:
         async with websockets.connect(uri, max_size=None, ping_interval=None) as ws:
             print('Connected')
-            recv_task = asyncio.create_task(recv_loop(ws, pending_ids))
+            recv_task = asyncio.create_task(recv_loop(ws, pending_ids, window, fmt))
+
+            if window is not None:
+                await ws.send(FLOW_CONTROL_CONFIG)
+            if fmt != 'ply':
+                await ws.send(f"config:submap_format:{fmt}")
 
             # Send images
-            await send_images(ws, images, delay)
+            await send_images(ws, images, delay, window)
 
             # Inform server that we are done sending images so it can flush any remaining partial batch
             try:
@@ -100,10 +145,299 @@ async def main(uri, images_dir, delay):
         print('Connection error:', repr(e))
 
 
+class ClientStats:
+    """Events recorded by one load-test connection; times are seconds since the run started."""
+
+    def __init__(self, role, index):
+        self.role = role
+        self.index = index
+        self.session = None
+        self.frames = []  # (seq, t_send, send_s, bytes)
+        self.acks = {}  # seq -> t_ack, with --flow-control
+        self.submaps = {}  # unique id -> (t_arrival, bytes)
+        self.dropped_batches = []  # lost sequence numbers, one list per dropped batch
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = []
+        self.closed_at = None
+
+    @property
+    def name(self):
+        return f"{self.role}-{self.index}"
+
+
+def _elapsed(start):
+    return time.perf_counter() - start
+
+
+def _viewer_uri(upload_uri):
+    parts = urlsplit(upload_uri)
+    return urlunsplit((parts.scheme, parts.netloc, '/ws/submaps', '', ''))
+
+
+async def _load_recv(ws, stats, start, window=None):
+    pending_id = None
+    try:
+        async for msg in ws:
+            now = _elapsed(start)
+            if isinstance(msg, bytes):
+                stats.bytes_received += len(msg)
+                if pending_id is not None:
+                    stats.submaps[pending_id] = (now, len(msg))
+                    pending_id = None
+                continue
+            stats.bytes_received += len(msg)
+            if window is not None and window.handle_text(msg):
+                if msg.startswith('ack:'):
+                    stats.acks[window.last_ack.get('seq')] = now
+            elif msg.startswith('filename:'):
+                pending_id = msg.split(':', 1)[1]
+            elif msg.startswith('status:session:'):
+                stats.session = msg.split(':', 2)[2]
+            elif msg.startswith('status:dropped_batch:'):
+                seqs = msg[len('status:dropped_batch:'):]
+                stats.dropped_batches.append([int(s) for s in seqs.split(',') if s])
+            elif msg.startswith('error:'):
+                stats.errors.append(msg[len('error:'):])
+    except websockets.ConnectionClosed:
+        pass
+    except Exception as e:
+        stats.errors.append(repr(e))
+    stats.closed_at = _elapsed(start)
+
+
+async def load_uploader(stats, uri, images, depths, fps, start, flow_control=False, fmt='ply', timeout=600.0):
+    """Replay ``images`` (each followed by its depth map, if any) at ``fps`` on one session."""
+    window = CreditWindow(min_interval=0.0) if flow_control else None
+    try:
+        async with websockets.connect(uri, max_size=None, ping_interval=None) as ws:
+            recv_task = asyncio.create_task(_load_recv(ws, stats, start, window))
+            if window is not None:
+                await ws.send(FLOW_CONTROL_CONFIG)
+            if fmt != 'ply':
+                await ws.send(f"config:submap_format:{fmt}")
+            if depths:
+                # Depth maps are already on the image grid; without this the
+                # server ignores every depth message
+                await ws.send("config:use_depth_maps:1")
+
+            t0 = time.perf_counter()
+            for seq, path in enumerate(images):
+                # Fixed schedule, so a slow send is followed by a shorter pause
+                # instead of pushing every later frame back.
+                delay = t0 + seq / fps - time.perf_counter() if fps > 0 else 0.0
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if window is not None:
+                    await window.acquire()
+                data = path.read_bytes()
+                t_send = _elapsed(start)
+                await ws.send(data)
+                send_s = _elapsed(start) - t_send
+                stats.frames.append((seq, t_send, send_s, len(data)))
+                stats.bytes_sent += len(data)
+                depth = depths.get(path.stem) if depths else None
+                if depth is not None:
+                    depth_data = depth.read_bytes()
+                    await ws.send(depth_data)
+                    stats.bytes_sent += len(depth_data)
+
+            await ws.send('done')
+            # The server closes the connection once every batch is delivered
+            try:
+                await asyncio.wait_for(recv_task, timeout)
+            except asyncio.TimeoutError:
+                stats.errors.append(f"no close from server within {timeout:g}s of done")
+                recv_task.cancel()
+    except Exception as e:
+        stats.errors.append(repr(e))
+
+
+async def load_viewer(stats, uri, start, stop):
+    try:
+        async with websockets.connect(uri, max_size=None, ping_interval=None) as ws:
+            recv_task = asyncio.create_task(_load_recv(ws, stats, start))
+            await stop.wait()
+            await ws.close()
+            await recv_task
+    except Exception as e:
+        stats.errors.append(repr(e))
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+    return {
+        'count': len(values),
+        'mean': statistics.fmean(values),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'max': values[-1],
+    }
+
+
+def build_report(uploaders, viewers, duration, config):
+    """Summary plus one row per event.
+
+    A submap's latency at the uploader is measured from the send of the
+    newest frame sent before it arrived (how far the map trails the camera).
+    At a viewer it is the delay relative to the uploader receiving the same
+    submap.
+    """
+    rows = []
+    arrivals = {}
+    upload_latency = []
+    for up in uploaders:
+        send_times = [f[1] for f in up.frames]
+        for seq, t_send, send_s, nbytes in up.frames:
+            t_ack = up.acks.get(seq)
+            rows.append({
+                'kind': 'frame', 'client': up.name, 'session': up.session, 'id': seq,
+                't': t_send, 'bytes': nbytes, 'send_s': send_s,
+                'latency_s': None if t_ack is None else t_ack - t_send,
+            })
+        for uid, (t_arrival, nbytes) in up.submaps.items():
+            arrivals[uid] = t_arrival
+            before = [t for t in send_times if t <= t_arrival]
+            latency = t_arrival - before[-1] if before else None
+            if latency is not None:
+                upload_latency.append(latency)
+            rows.append({
+                'kind': 'submap', 'client': up.name, 'session': up.session, 'id': uid,
+                't': t_arrival, 'bytes': nbytes, 'send_s': None, 'latency_s': latency,
+            })
+        for seqs in up.dropped_batches:
+            rows.append({
+                'kind': 'dropped_batch', 'client': up.name, 'session': up.session,
+                'id': ' '.join(str(s) for s in seqs),
+                't': None, 'bytes': None, 'send_s': None, 'latency_s': None, 'frames': len(seqs),
+            })
+
+    viewer_latency = []
+    for viewer in viewers:
+        for uid, (t_arrival, nbytes) in viewer.submaps.items():
+            latency = t_arrival - arrivals[uid] if uid in arrivals else None
+            if latency is not None:
+                viewer_latency.append(latency)
+            rows.append({
+                'kind': 'viewer_submap', 'client': viewer.name, 'session': None, 'id': uid,
+                't': t_arrival, 'bytes': nbytes, 'send_s': None, 'latency_s': latency,
+            })
+
+    frames_sent = sum(len(u.frames) for u in uploaders)
+    summary = {
+        'duration_s': duration,
+        'frames_sent': frames_sent,
+        'achieved_fps': frames_sent / duration if duration > 0 else 0.0,
+        'bytes_sent': sum(u.bytes_sent for u in uploaders),
+        'bytes_received_uploaders': sum(u.bytes_received for u in uploaders),
+        'bytes_received_viewers': sum(v.bytes_received for v in viewers),
+        'submaps_received': sum(len(u.submaps) for u in uploaders),
+        'dropped_batches': sum(len(u.dropped_batches) for u in uploaders),
+        'dropped_frames': sum(len(seqs) for u in uploaders for seqs in u.dropped_batches),
+        'send_s': _percentiles([f[2] for u in uploaders for f in u.frames]),
+        'ack_latency_s': _percentiles([u.acks[f[0]] - f[1] for u in uploaders for f in u.frames if f[0] in u.acks]),
+        'submap_latency_s': _percentiles(upload_latency),
+        'viewer_delay_s': _percentiles(viewer_latency),
+        'errors': {c.name: c.errors for c in uploaders + viewers if c.errors},
+        'clients': [
+            {
+                'client': c.name,
+                'session': c.session,
+                'frames': len(c.frames),
+                'submaps': len(c.submaps),
+                'bytes_sent': c.bytes_sent,
+                'bytes_received': c.bytes_received,
+                'closed_at': c.closed_at,
+            }
+            for c in uploaders + viewers
+        ],
+    }
+    return {'config': config, 'summary': summary, 'events': rows}
+
+
+def write_report(path, report):
+    path = Path(path)
+    if path.suffix.lower() == '.csv':
+        fields = ['kind', 'client', 'session', 'id', 't', 'bytes', 'send_s', 'latency_s', 'frames']
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(report['events'])
+    else:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+async def run_load(uri, images_dir, uploaders, viewers, fps, depth_dir=None, flow_control=False,
+                   fmt='ply', viewer_uri=None, report_path=None, linger=5.0, timeout=600.0):
+    images_dir = Path(images_dir)
+    images = sorted([p for p in images_dir.iterdir() if p.is_file() and p.suffix.lower() in ('.png', '.jpg', '.jpeg')])
+    if not images:
+        print('No images found in', images_dir)
+        return None
+    # Depth maps are paired with images by file stem (<stem>.npy)
+    depths = {p.stem: p for p in Path(depth_dir).glob('*.npy')} if depth_dir else {}
+
+    config = {
+        'uri': uri, 'images': len(images), 'depth_maps': len(depths), 'uploaders': uploaders,
+        'viewers': viewers, 'fps': fps, 'flow_control': flow_control, 'format': fmt,
+    }
+    print(f"Load test: {uploaders} uploaders x {len(images)} frames at {fps:g} fps, {viewers} viewers")
+
+    start = time.perf_counter()
+    stop = asyncio.Event()
+    viewer_stats = [ClientStats('viewer', i) for i in range(viewers)]
+    viewer_tasks = [
+        asyncio.create_task(load_viewer(s, viewer_uri or _viewer_uri(uri), start, stop))
+        for s in viewer_stats
+    ]
+    # Let viewers subscribe before the first submap can be produced
+    await asyncio.sleep(0.5 if viewers else 0.0)
+
+    upload_stats = [ClientStats('uploader', i) for i in range(uploaders)]
+    await asyncio.gather(*(
+        load_uploader(s, uri, images, depths, fps, start, flow_control, fmt, timeout)
+        for s in upload_stats
+    ))
+    await asyncio.sleep(linger if viewers else 0.0)
+    stop.set()
+    await asyncio.gather(*viewer_tasks)
+    duration = _elapsed(start)
+
+    report = build_report(upload_stats, viewer_stats, duration, config)
+    summary = report['summary']
+    print(json.dumps({k: v for k, v in summary.items() if k != 'clients'}, indent=2))
+    if report_path:
+        write_report(report_path, report)
+        print(f"Report written to {report_path}")
+    return report
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('images_dir', help='Directory containing images to send')
     parser.add_argument('--uri', default='ws://localhost:8000/ws/upload', help='WebSocket URI')
-    parser.add_argument('--delay', type=float, default=0.01, help='Seconds between sends')
+    parser.add_argument('--delay', type=float, default=0.01, help='Seconds between sends (minimum interval with --flow-control)')
+    parser.add_argument('--flow-control', action='store_true', help='Pace sends using server credits and frame acks')
+    parser.add_argument('--format', default='ply', choices=SUBMAP_FORMATS, help='Submap format to request from the server')
+    load = parser.add_argument_group('load test')
+    load.add_argument('--uploaders', type=int, default=0, help='Concurrent uploader sessions (enables load-test mode)')
+    load.add_argument('--viewers', type=int, default=0, help='Passive /ws/submaps viewers')
+    load.add_argument('--fps', type=float, default=10.0, help='Target frames per second per uploader (0 = as fast as possible)')
+    load.add_argument('--depth-dir', help='Directory of <image stem>.npy depth maps sent after each image')
+    load.add_argument('--viewer-uri', help='Viewer WebSocket URI (default: /ws/submaps on the upload host)')
+    load.add_argument('--report', help='Write the load report to this .json or .csv file')
+    load.add_argument('--linger', type=float, default=5.0, help='Seconds viewers stay connected after the last uploader closes')
+    load.add_argument('--timeout', type=float, default=600.0, help='Seconds to wait for the server to finish after done')
     args = parser.parse_args()
-    asyncio.run(main(args.uri, args.images_dir, args.delay))
+    if args.uploaders or args.viewers or args.report:
+        asyncio.run(run_load(
+            args.uri, args.images_dir, max(args.uploaders, 1), args.viewers, args.fps,
+            depth_dir=args.depth_dir, flow_control=args.flow_control, fmt=args.format,
+            viewer_uri=args.viewer_uri, report_path=args.report, linger=args.linger, timeout=args.timeout,
+        ))
+    else:
+        asyncio.run(main(args.uri, args.images_dir, args.delay, args.flow_control, args.format))
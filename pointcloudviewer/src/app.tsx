@@ -120,9 +120,24 @@ function App() {
   useEffect(() => {
     if (!window.electron.onCaptureFrame) return;
 
+    // Binary previews arrive as JPEG bytes; show them through object URLs
+    // and release the previous one each time
+    const previewUrls: { rgb: string | null; depth: string | null } = { rgb: null, depth: null };
+    const jpegUrl = (key: 'rgb' | 'depth', bytes: Uint8Array) => {
+      const previous = previewUrls[key];
+      if (previous) URL.revokeObjectURL(previous);
+      previewUrls[key] = URL.createObjectURL(new Blob([bytes], { type: 'image/jpeg' }));
+      return previewUrls[key];
+    };
+
     window.electron.onCaptureFrame((msg: any) => {
       if (!msg || typeof msg !== 'object') return;
-      if (msg.type === 'rgb' && msg.jpeg_b64) {
+      if (msg.rgb_jpeg) {
+        setRgbPreview(jpegUrl('rgb', msg.rgb_jpeg));
+        if (msg.depth_jpeg) {
+          setDepthPreview(jpegUrl('depth', msg.depth_jpeg));
+        }
+      } else if (msg.type === 'rgb' && msg.jpeg_b64) {
         setRgbPreview(`data:image/jpeg;base64,${msg.jpeg_b64}`);
       } else if (msg.type === 'rgbd') {
         if (msg.rgb_jpeg_b64) {
@@ -36,7 +36,49 @@ const tempPlyFiles: string[] = [];
 
 // Track live capture Python bridge process
 let captureProc: ChildProcessWithoutNullStreams | null = null;
-let captureStdoutBuffer = '';
+let captureStdoutBuffer: Buffer = Buffer.alloc(0);
+
+// Binary preview records written by live_capture_bridge.py (see
+// backend/preview_channel.py): 16-byte header, RGB JPEG, optional depth JPEG.
+const PREVIEW_MAGIC = Buffer.from('VPV1', 'ascii');
+const PREVIEW_HEADER_SIZE = 16;
+const PREVIEW_RGBD = 2;
+
+// Splits complete preview records off the front of `buffer`; returns them
+// with the unconsumed remainder.
+const parsePreviewRecords = (buffer: Buffer): { frames: any[]; rest: Buffer } => {
+  const frames: any[] = [];
+  let offset = 0;
+  while (buffer.length - offset >= PREVIEW_HEADER_SIZE) {
+    if (!buffer.subarray(offset, offset + 4).equals(PREVIEW_MAGIC)) {
+      // Out of sync (stray output); skip ahead to the next record
+      const next = buffer.indexOf(PREVIEW_MAGIC, offset + 1);
+      console.error('Skipping unexpected capture bridge output');
+      if (next < 0) {
+        // Keep a possible partial magic at the end
+        offset = Math.max(offset, buffer.length - 3);
+        break;
+      }
+      offset = next;
+      continue;
+    }
+    const kind = buffer.readUInt8(offset + 5);
+    const rgbLength = buffer.readUInt32LE(offset + 8);
+    const depthLength = buffer.readUInt32LE(offset + 12);
+    const end = offset + PREVIEW_HEADER_SIZE + rgbLength + depthLength;
+    if (buffer.length < end) break;
+    const rgbStart = offset + PREVIEW_HEADER_SIZE;
+    // Copies, so the IPC message does not retain the whole stdout chunk
+    const rgb = Buffer.from(buffer.subarray(rgbStart, rgbStart + rgbLength));
+    const frame: any = { type: kind === PREVIEW_RGBD ? 'rgbd' : 'rgb', rgb_jpeg: rgb };
+    if (depthLength > 0) {
+      frame.depth_jpeg = Buffer.from(buffer.subarray(rgbStart + rgbLength, end));
+    }
+    frames.push(frame);
+    offset = end;
+  }
+  return { frames, rest: buffer.subarray(offset) };
+};
 
 // Register protocols as privileged before app is ready
 protocol.registerSchemesAsPrivileged([
@@ -140,7 +182,7 @@ ipcMain.handle('capture:start', async (_event, mode: 'gopro' | 'gopro_helios', p
     return;
   }
 
-  const args: string[] = [scriptPath, `--mode=${mode}`];
+  const args: string[] = [scriptPath, `--mode=${mode}`, '--preview-format=binary'];
 
   if (previewOnly) {
     args.push('--preview-only');
@@ -158,24 +200,16 @@ ipcMain.handle('capture:start', async (_event, mode: 'gopro' | 'gopro_helios', p
   });
 
   captureProc.stdout.on('data', (chunk: Buffer) => {
-    const text = chunk.toString('utf8');
-    captureStdoutBuffer += text;
-
-    const parts = captureStdoutBuffer.split('\n');
-    // Keep the last partial line in the buffer
-    captureStdoutBuffer = parts.pop() ?? '';
-
-    for (const line of parts) {
-      const trimmed = line.trim();
-      if (!trimmed) continue;
-      try {
-        const msg = JSON.parse(trimmed);
-        BrowserWindow.getAllWindows().forEach((win) => {
-          win.webContents.send('capture:frame', msg);
-        });
-      } catch (e) {
-        console.error('Failed to parse capture bridge output:', e);
-      }
+    const { frames, rest } = parsePreviewRecords(Buffer.concat([captureStdoutBuffer, chunk]));
+    // Keep the last partial record in the buffer
+    captureStdoutBuffer = rest;
+
+    // Only the newest preview matters if several arrived at once
+    const msg = frames[frames.length - 1];
+    if (msg) {
+      BrowserWindow.getAllWindows().forEach((win) => {
+        win.webContents.send('capture:frame', msg);
+      });
     }
   });
 
@@ -186,7 +220,7 @@ ipcMain.handle('capture:start', async (_event, mode: 'gopro' | 'gopro_helios', p
   captureProc.on('exit', (code, signal) => {
     console.log('capture bridge exited with code', code, 'signal', signal);
     captureProc = null;
-    captureStdoutBuffer = '';
+    captureStdoutBuffer = Buffer.alloc(0);
   });
 });
 